@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+import os
+import sys
+
+sys.path.insert(0,os.path.abspath('.'))
+
+from ogcserver.invalidate import main
+
+if __name__ == '__main__':
+    sys.exit(main())
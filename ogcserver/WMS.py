@@ -1,7 +1,11 @@
 """Interface for registering map styles and layers for availability in WMS Requests."""
 
+import os
 import re
 import sys
+import time
+import hashlib
+import threading
 import ConfigParser
 
 try:
@@ -10,6 +14,15 @@ except ImportError:
     from mapnik import Style, Map, load_map
 
 from ogcserver import common
+from ogcserver.cache import CapabilitiesCache, Invalidation, MemoryCache, PeriodicThread, load_cache
+from ogcserver.encoder import Encoder, load_encoder
+from ogcserver.extents import ExtentIndex
+from ogcserver.scales import ScaleIndex
+from ogcserver.mappool import MapPool
+from ogcserver.metatile import MetaTiler, load_grids
+from ogcserver.queryindex import QueryIndexes, load_query_indexes
+from ogcserver.utfgrid import UTFGridRenderer, load_utfgrid
+from ogcserver.singleflight import Refresher, SingleFlight
 from ogcserver.wms111 import ServiceHandler as ServiceHandler111
 from ogcserver.wms130 import ServiceHandler as ServiceHandler130
 from ogcserver.exceptions import OGCException, ServerConfigurationError
@@ -54,6 +67,308 @@ class BaseWMSFactory:
         self.meta_styles = {}
         self.meta_layers = {}
         self.configpath = configpath
+        self.mappool = MapPool()
+        self.encoder = Encoder()
+        self.utfgrid = UTFGridRenderer()
+        self.compressor = common.Compressor()
+        self.extents = None
+        self.scales = None
+        self.allowedcrss = []
+        self.unpruned = set()
+        self.queryindexes = QueryIndexes({})
+        self.metatiler = None
+        self.renderpool = None
+        self.singleflight = SingleFlight()
+        self.refresher = None
+        # seconds HTTP caches may serve maps stale while revalidating them
+        self.stale = 0
+        self.cache = None
+        self.memcache = None
+        self.ttls = {}
+        self.watcher = None
+        # the modification times of the datasource files, by layer, read
+        # on first use unless they are watched
+        self.mtimes = {}
+        # the last time this process invalidated cached maps, by layer
+        self.invalidated = {}
+        self.configtime = None
+        self.xmlfiles = []
+        self.conf = None
+        self.fingerprint = ''
+        self.capabilities = CapabilitiesCache()
+        # bumped whenever the capabilities documents may have changed
+        self.generation = 0
+
+    def configure(self, conf):
+        """ Apply the [server] settings of ogcserver.conf to the objects
+            shared by all requests served from this factory.
+        """
+        if conf.has_option_with_value('server', 'mappoolsize'):
+            self.mappool.maxsize = int(conf.get('server', 'mappoolsize'))
+        if conf.has_option_with_value('server', 'coalescerequests'):
+            if not conf.getboolean('server', 'coalescerequests'):
+                self.singleflight = None
+        self.encoder = load_encoder(conf)
+        self.utfgrid = load_utfgrid(conf)
+        self.compressor = common.load_compressor(conf)
+        grids = load_grids(conf)
+        if grids:
+            self.metatiler = MetaTiler(grids)
+            if conf.has_option_with_value('server', 'metatilestoresize'):
+                self.metatiler.maxtiles = int(conf.get('server', 'metatilestoresize'))
+        self.conf = conf
+        # only the cache needs it right away, the validators of maps
+        # compute it on first use
+        self.fingerprint = None
+        if conf.has_option_with_value('server', 'cachedir'):
+            self.fingerprint = self._fingerprint(conf)
+        self.configtime = self._configtime()
+        for section in conf.sections():
+            if section.startswith('layer_') and conf.has_option_with_value(section, 'ttl'):
+                self.ttls[section[len('layer_'):]] = int(conf.get(section, 'ttl'))
+        ttl = self.ttls and self._ttl or None
+        self.cache = load_cache(conf, self.fingerprint, ttl)
+        if conf.has_option_with_value('server', 'memorycachemaxbytes'):
+            invalidated = self.cache and self.cache.invalidated or None
+            self.memcache = MemoryCache(int(conf.get('server', 'memorycachemaxbytes')), ttl, self.compressor, invalidated)
+        if self.cache and conf.has_option_with_value('server', 'stalewhilerevalidate'):
+            concurrency = 2
+            if conf.has_option_with_value('server', 'refreshconcurrency'):
+                concurrency = int(conf.get('server', 'refreshconcurrency'))
+            self.refresher = Refresher(concurrency)
+            self.stale = int(conf.get('server', 'stalewhilerevalidate'))
+        if conf.has_option_with_value('service', 'allowedepsgcodes'):
+            self.allowedcrss = ['epsg:%s' % code.strip() for code in conf.get('service', 'allowedepsgcodes').split(',')]
+            if self.metatiler:
+                self.allowedcrss.extend([grid.crs for grid in self.metatiler.grids if grid.crs not in self.allowedcrss])
+        for section in conf.sections():
+            if section.startswith('layer_') and conf.has_option_with_value(section, 'pruneextent'):
+                if not conf.getboolean(section, 'pruneextent'):
+                    self.unpruned.add(section[len('layer_'):])
+        # both are cheap until requests need the extents of a CRS or the
+        # index of a layer
+        self.extents = self._indexextents()
+        self.queryindexes = load_query_indexes(conf, self.layers)
+        self.mtimes = None
+        self.generation += 1
+        if conf.has_option_with_value('server', 'watchdatasources'):
+            self.mtimes = self._datasourcetimes()
+            self.watcher = PeriodicThread(self._checkdatasources, int(conf.get('server', 'watchdatasources')))
+
+    def prepare_capabilities(self, conf):
+        """ Build the WMS capabilities documents in a background thread,
+            so that the first GetCapabilities requests find them cached.
+            Only done when the [service] baseurl is set, otherwise the
+            online resource of the documents is taken from the requests.
+
+            @return: The thread building the documents, which has to be
+                     done before this process forks, or None.
+        """
+        if not conf.has_option_with_value('service', 'baseurl'):
+            return None
+        onlineresource = conf.get('service', 'baseurl')
+        def build():
+            for version in ('1.1.1', '1.3.0'):
+                try:
+                    ServiceHandlerFactory(conf, self, onlineresource, version).GetCapabilities({})
+                except Exception, e:
+                    sys.stderr.write('Warning: the WMS %s capabilities could not be built: %s\n' % (version, e))
+        thread = threading.Thread(target=build)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def invalidate(self, layernames, crs=None, bbox=None):
+        """ Remove the cached responses showing some layers, after their
+            data changed.
+
+            @param crs: The CRS of bbox, as in 'epsg:4326'.
+            @type crs: String or CRS.
+
+            @param bbox: Only remove the responses intersecting this
+                         (minx, miny, maxx, maxy) box.
+            @type bbox: Sequence of floats.
+
+            @return: The number of responses removed from the response
+                     cache.
+        """
+        names = set(['__all__'])
+        sources = set()
+        for name in layernames:
+            layer = self.layers.get(name) or self.meta_layers.get(name)
+            if not layer:
+                raise OGCException('Layer "%s" not defined.' % name, 'LayerNotDefined')
+            sources.add(getattr(layer, 'wms_source', name))
+        names.update(sources)
+        # meta layers render the data of the layer they were made from
+        for name, layer in self.meta_layers.items():
+            if getattr(layer, 'wms_source', name) in sources:
+                names.add(name)
+        grids = self.metatiler and self.metatiler.grids or ()
+        selection = Invalidation(names, crs, bbox, grids)
+        removed = 0
+        # from the back to the front, so that no tier is filled again
+        # from a stale one behind it
+        if self.cache:
+            removed = self.cache.invalidate(selection)
+        if self.metatiler:
+            self.metatiler.invalidate(selection)
+        if self.memcache:
+            self.memcache.invalidate(selection)
+        now = time.time()
+        for name in names:
+            self.invalidated[name] = now
+        return removed
+
+    def validators(self, key, layernames):
+        """ The entity tag and modification time of the map answering a
+            request, known without rendering it, so that conditional GETs
+            are answered before anything is rendered.  The tag is a digest
+            of the fingerprint, the modification time and the request key.
+
+            @param key: Identifies the map, see _requestKey of the service
+                        handlers.
+            @type key: Tuple.
+
+            @return: An (entity tag, modification time) tuple, the time is
+                     None if it is not known.
+        """
+        if self.fingerprint is None:
+            self.fingerprint = self._fingerprint(self.conf)
+        modified = self.lastmodified(layernames)
+        etag = '"%s"' % hashlib.md5('%s:%s:%r' % (self.fingerprint, modified, key)).hexdigest()
+        return etag, modified
+
+    def lastmodified(self, layernames):
+        """ The last time the maps of some layers may have changed: that
+            of the mapfiles and configuration, of the files of their data,
+            of the last invalidation of their cached maps and, for layers
+            with a ttl, of the start of the current ttl period.  All but the
+            invalidations made without a shared cache are the same in every
+            process.
+
+            @return: Seconds since the epoch, or None if none is known.
+        """
+        names = set(['__all__'])
+        for name in layernames:
+            names.add(name)
+            if name in self.meta_layers:
+                names.add(getattr(self.meta_layers[name], 'wms_source', name))
+        if self.mtimes is None:
+            self.mtimes = self._datasourcetimes()
+        times = [self.configtime]
+        for name in names:
+            times.append(self.mtimes.get(name))
+            times.append(self.invalidated.get(name))
+        if self.cache:
+            times.append(self.cache.invalidated())
+        ttl = self._ttl(layernames)
+        if ttl:
+            now = int(time.time())
+            # maps older than their ttl are rendered again
+            times.append(now - now % ttl)
+        modified = max(times)
+        if modified is None:
+            return None
+        return int(modified)
+
+    def _ttl(self, layernames):
+        """ The shortest ttl of the [layer_<name>] sections of the layers,
+            or None if none of them has one.
+        """
+        if '__all__' in layernames:
+            layernames = self.layers.keys()
+        ttls = []
+        for name in layernames:
+            if name in self.meta_layers:
+                name = getattr(self.meta_layers[name], 'wms_source', name)
+            if name in self.ttls:
+                ttls.append(self.ttls[name])
+        return ttls and min(ttls) or None
+
+    def _indexextents(self):
+        """ Index the extents of the layers in every CRS served, leaving
+            out those whose pruneextent is off.
+        """
+        layers = {}
+        for name, layer in self.layers.items() + self.meta_layers.items():
+            if getattr(layer, 'wms_source', name) not in self.unpruned:
+                layers[name] = layer
+        return ExtentIndex(layers, self.allowedcrss)
+
+    def _datasourcetimes(self):
+        """ The last modification time of the files of every layer with a
+            file based datasource, such as a shapefile.
+        """
+        mtimes = {}
+        for layer in self.layers.values():
+            try:
+                params = layer.datasource.params()
+                path = params['file']
+            except Exception:
+                continue
+            try:
+                path = os.path.join(params['base'], path)
+            except Exception:
+                pass
+            try:
+                shape = params['type'] == 'shape'
+            except Exception:
+                shape = False
+            paths = [path]
+            if shape:
+                # the path of a shapefile may leave out the .shp extension
+                root = re.sub('\.shp$', '', path)
+                paths = [root + '.shp', root + '.shx', root + '.dbf']
+            mtime = None
+            for path in paths:
+                try:
+                    mtime = max(mtime, os.stat(path).st_mtime)
+                except OSError:
+                    pass
+            mtimes[layer.name] = mtime
+        return mtimes
+
+    def _checkdatasources(self):
+        mtimes = self._datasourcetimes()
+        changed = [name for name, mtime in mtimes.items() if mtime != self.mtimes.get(name)]
+        self.mtimes = mtimes
+        if changed:
+            # the data may have grown beyond its former extent
+            self.extents = self._indexextents()
+            for name in changed:
+                if name in self.queryindexes:
+                    self.queryindexes.reset(name)
+            self.generation += 1
+            self.invalidate(changed)
+
+    def _configtime(self):
+        """ The last modification time of the mapfiles and configuration
+            file, or None if none of them is a file.
+        """
+        configtime = None
+        for path in self.xmlfiles + [self.configpath]:
+            try:
+                configtime = max(configtime, os.stat(path).st_mtime)
+            except (TypeError, OSError):
+                pass
+        return configtime
+
+    def _fingerprint(self, conf):
+        """ A digest of the mapfiles and configuration that changes
+            whenever either of them does.  For layers and styles defined in
+            python code only their names are taken into account.
+        """
+        digest = hashlib.md5()
+        for xmlfile in self.xmlfiles:
+            digest.update(open(xmlfile, 'rb').read())
+        for section in sorted(conf.sections()):
+            digest.update('[%s]' % section)
+            for item in sorted(conf.items(section, raw=True)):
+                digest.update('%s=%s' % item)
+        for layer in self.ordered_layers:
+            digest.update('%s:%s' % (layer.name, ','.join(layer.wmsextrastyles)))
+        return digest.hexdigest()
 
     def loadXML(self, xmlfile, strict=False):
         config = ConfigParser.SafeConfigParser()
@@ -66,6 +381,7 @@ class BaseWMSFactory:
 
         tmp_map = Map(0,0)
         load_map(tmp_map, xmlfile, strict)
+        self.xmlfiles.append(xmlfile)
         # parse map level attributes
         if tmp_map.background:
             self.map_attributes['bgcolor'] = tmp_map.background
@@ -98,6 +414,7 @@ class BaseWMSFactory:
                     self.meta_styles[meta_layer_name] = meta_s
                     meta_lyr = common.copy_layer(lyr)
                     meta_lyr.meta_style = meta_layer_name
+                    meta_lyr.wms_source = lyr.name
                     meta_lyr.name = meta_layer_name
                     meta_lyr.wmsextrastyles = ()
                     meta_lyr.defaultstyle = meta_layer_name
@@ -130,6 +447,7 @@ class BaseWMSFactory:
                         self.meta_styles[meta_layer_name] = meta_s
                         meta_lyr = common.copy_layer(lyr)
                         meta_lyr.meta_style = meta_layer_name
+                        meta_lyr.wms_source = lyr.name
                         print meta_layer_name
                         meta_lyr.name = meta_layer_name
                         meta_lyr.wmsextrastyles = ()
@@ -199,3 +517,8 @@ class BaseWMSFactory:
             for style in list(layer.styles) + list(layer.wmsextrastyles):
                 if style not in self.styles.keys() + self.aggregatestyles.keys():
                     raise ServerConfigurationError('Layer "%s" refers to undefined style "%s".' % (layer.name, style))
+        layers = dict(self.layers)
+        layers.update(self.meta_layers)
+        styles = dict(self.styles)
+        styles.update(self.meta_styles)
+        self.scales = ScaleIndex(layers, styles)
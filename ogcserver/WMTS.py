@@ -0,0 +1,307 @@
+"""WMTS 1.0.0 (KVP and RESTful) and TMS 1.0.0 tile services for the configured tile grids."""
+
+import re
+
+from lxml import etree as ElementTree
+
+from ogcserver.common import ParameterDefinition, Response, WMSBaseServiceHandler, \
+                   CRS, ColorFactory, conditional_headers, get_projection, wgs84_bounds, to_unicode
+from ogcserver.exceptions import OGCException, ServerConfigurationError
+from ogcserver.utfgrid import UTFGRID_FORMAT
+
+FORMATS = {'png': 'image/png', 'png8': 'image/png8', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp',
+           'json': UTFGRID_FORMAT}
+EXTENSIONS = {'image/png': 'png', 'image/png8': 'png8', 'image/jpeg': 'jpg', 'image/webp': 'webp',
+              UTFGRID_FORMAT: 'json'}
+
+OWS = '{http://www.opengis.net/ows/1.1}'
+WMTS = '{http://www.opengis.net/wmts/1.0}'
+XLINK = '{http://www.w3.org/1999/xlink}'
+
+def ServiceHandlerFactory(conf, mapfactory, onlineresource, version):
+    return ServiceHandler(conf, mapfactory, onlineresource)
+
+class ServiceHandler(WMSBaseServiceHandler):
+
+    SERVICE_PARAMS = {
+        'GetCapabilities': {
+            'acceptversions': ParameterDefinition(False, str)
+        },
+        'GetTile': {
+            'layer': ParameterDefinition(True, str),
+            'style': ParameterDefinition(False, str, ''),
+            'format': ParameterDefinition(True, str, allowedvalues=('image/png','image/png8', 'image/jpeg', 'image/webp', UTFGRID_FORMAT)),
+            'tilematrixset': ParameterDefinition(True, str),
+            'tilematrix': ParameterDefinition(True, int),
+            'tilerow': ParameterDefinition(True, int),
+            'tilecol': ParameterDefinition(True, int)
+        }
+    }
+
+    capabilitiesxmltemplate = """<?xml version="1.0" encoding="UTF-8"?>
+    <Capabilities version="1.0.0" xmlns="http://www.opengis.net/wmts/1.0"
+                                  xmlns:ows="http://www.opengis.net/ows/1.1"
+                                  xmlns:xlink="http://www.w3.org/1999/xlink"
+                                  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+                                  xsi:schemaLocation="http://www.opengis.net/wmts/1.0 http://schemas.opengis.net/wmts/1.0/wmtsGetCapabilities_response.xsd">
+      <ows:ServiceIdentification>
+        <ows:ServiceType>OGC WMTS</ows:ServiceType>
+        <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+      </ows:ServiceIdentification>
+      <ows:OperationsMetadata>
+        <ows:Operation name="GetCapabilities">
+          <ows:DCP>
+            <ows:HTTP>
+              <ows:Get xlink:type="simple"/>
+            </ows:HTTP>
+          </ows:DCP>
+        </ows:Operation>
+        <ows:Operation name="GetTile">
+          <ows:DCP>
+            <ows:HTTP>
+              <ows:Get xlink:type="simple"/>
+            </ows:HTTP>
+          </ows:DCP>
+        </ows:Operation>
+      </ows:OperationsMetadata>
+      <Contents>
+      </Contents>
+    </Capabilities>
+    """
+
+    def __init__(self, conf, mapfactory, opsonlineresource, resturl=None):
+        self.conf = conf
+        self.mapfactory = mapfactory
+        self.opsonlineresource = opsonlineresource
+        self.resturl = resturl
+        if not mapfactory.metatiler:
+            raise ServerConfigurationError('No tile matrix sets configured, add a [grid_<name>] section.')
+        self.grids = mapfactory.metatiler.grids
+        self.allowedepsgcodes = [grid.crs for grid in self.grids]
+
+    def GetCapabilities(self, params):
+        capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
+        for element in capetree.findall('%sOperationsMetadata//%sGet' % (OWS, OWS)):
+            element.set(XLINK + 'href', self.opsonlineresource)
+            constraint = ElementTree.SubElement(element, OWS + 'Constraint', name='GetEncoding')
+            ElementTree.SubElement(ElementTree.SubElement(constraint, OWS + 'AllowedValues'), OWS + 'Value').text = 'KVP'
+
+        identification = capetree.find(OWS + 'ServiceIdentification')
+        for option, tag in (('title', 'Title'), ('abstract', 'Abstract')):
+            if self.conf.has_option_with_value('service', option):
+                element = ElementTree.Element(OWS + tag)
+                element.text = to_unicode(self.conf.get('service', option))
+                identification.insert(0, element)
+
+        contents = capetree.find(WMTS + 'Contents')
+        for layer in self.mapfactory.ordered_layers:
+            layere = ElementTree.SubElement(contents, WMTS + 'Layer')
+            ElementTree.SubElement(layere, OWS + 'Title').text = to_unicode(getattr(layer, 'title', layer.name) or layer.name)
+            env = layer.envelope()
+            bounds = wgs84_bounds(layer.srs, env)
+            if bounds:
+                wgs84bbox = ElementTree.SubElement(layere, OWS + 'WGS84BoundingBox')
+                ElementTree.SubElement(wgs84bbox, OWS + 'LowerCorner').text = '%s %s' % bounds[:2]
+                ElementTree.SubElement(wgs84bbox, OWS + 'UpperCorner').text = '%s %s' % bounds[2:]
+            ElementTree.SubElement(layere, OWS + 'Identifier').text = to_unicode(layer.name)
+            defaultstyle = default_style(layer)
+            for stylename in [defaultstyle] + [s for s in layer.wmsextrastyles if s != defaultstyle]:
+                style = ElementTree.SubElement(layere, WMTS + 'Style')
+                if stylename == defaultstyle:
+                    style.set('isDefault', 'true')
+                ElementTree.SubElement(style, OWS + 'Identifier').text = to_unicode(stylename)
+            extensions = self._extensions(layer)
+            for format in sorted(extensions.keys()):
+                ElementTree.SubElement(layere, WMTS + 'Format').text = format
+            for grid in self.grids:
+                link = ElementTree.SubElement(layere, WMTS + 'TileMatrixSetLink')
+                ElementTree.SubElement(link, WMTS + 'TileMatrixSet').text = grid.name
+            if self.resturl:
+                for format, extension in sorted(extensions.items()):
+                    ElementTree.SubElement(layere, WMTS + 'ResourceURL', format=format, resourceType='tile',
+                        template='%s/wmts/1.0.0/%s/{Style}/{TileMatrixSet}/{TileMatrix}/{TileRow}/{TileCol}.%s' % (self.resturl, layer.name, extension))
+
+        for grid in self.grids:
+            geographic = get_projection('+init=%s' % grid.crs).geographic
+            if geographic:
+                # meters per degree at the equator
+                metersperunit = 6378137 * 2 * 3.141592653589793 / 360
+            else:
+                metersperunit = 1
+            tilematrixset = ElementTree.SubElement(contents, WMTS + 'TileMatrixSet')
+            ElementTree.SubElement(tilematrixset, OWS + 'Identifier').text = grid.name
+            ElementTree.SubElement(tilematrixset, OWS + 'SupportedCRS').text = 'urn:ogc:def:crs:%s::%s' % tuple(grid.crs.upper().split(':'))
+            for z, resolution in enumerate(grid.resolutions):
+                cols, rows = grid.size(z)
+                top = grid.extent[1] + rows * resolution * grid.tilesize
+                tilematrix = ElementTree.SubElement(tilematrixset, WMTS + 'TileMatrix')
+                ElementTree.SubElement(tilematrix, OWS + 'Identifier').text = str(z)
+                # 0.28mm, the standardized rendering pixel size
+                ElementTree.SubElement(tilematrix, WMTS + 'ScaleDenominator').text = repr(resolution * metersperunit / 0.00028)
+                if geographic:
+                    # latitude first, as the axis order of geographic CRSs
+                    ElementTree.SubElement(tilematrix, WMTS + 'TopLeftCorner').text = '%r %r' % (top, grid.extent[0])
+                else:
+                    ElementTree.SubElement(tilematrix, WMTS + 'TopLeftCorner').text = '%r %r' % (grid.extent[0], top)
+                ElementTree.SubElement(tilematrix, WMTS + 'TileWidth').text = str(grid.tilesize)
+                ElementTree.SubElement(tilematrix, WMTS + 'TileHeight').text = str(grid.tilesize)
+                ElementTree.SubElement(tilematrix, WMTS + 'MatrixWidth').text = str(cols)
+                ElementTree.SubElement(tilematrix, WMTS + 'MatrixHeight').text = str(rows)
+
+        return Response('text/xml', '<?xml version="1.0" encoding="UTF-8"?>\n' + ElementTree.tostring(capetree, encoding='UTF-8', pretty_print=True))
+
+    def GetTile(self, params):
+        grid = self._grid(params['tilematrixset'])
+        z = params['tilematrix']
+        if z < 0 or z >= len(grid.resolutions):
+            raise OGCException('TileMatrix "%s" is not defined.' % z, 'TileOutOfRange')
+        # WMTS counts rows from the top, grids from the bottom
+        cols, rows = grid.size(z)
+        return self._tile(params['layer'], params['style'], grid, z, params['tilecol'], rows - params['tilerow'] - 1, params['format'],
+                          conditional_headers(params))
+
+    def _grid(self, name):
+        for grid in self.grids:
+            if grid.name == name:
+                return grid
+        raise OGCException('TileMatrixSet "%s" is not defined.' % name, 'InvalidParameterValue')
+
+    def _extensions(self, layer):
+        """ The formats tiles of a layer are published in, UTFGrids only
+            for queryable layers and where mapnik renders them, WebP only
+            where mapnik encodes it.
+        """
+        extensions = dict(EXTENSIONS)
+        if not (layer.queryable and self.mapfactory.utfgrid.available):
+            del extensions[UTFGRID_FORMAT]
+        if not self.mapfactory.encoder.webp:
+            del extensions['image/webp']
+        return extensions
+
+    def _tile(self, layername, style, grid, z, col, row, format, headers=None):
+        """ Serve a tile by its address in the grid, which keys it in the
+            caches and selects its metatile, rendered on a miss.  Its BBOX
+            is never matched against the grids again, which might find
+            another grid of the same CRS and resolutions.
+
+            @param headers: The conditional headers of the request, see
+                            common.conditional_headers.
+            @type headers: Dict.
+        """
+        cols, rows = grid.size(z)
+        if col < 0 or row < 0 or col >= cols or row >= rows:
+            raise OGCException('Tile %s/%s/%s is outside of the TileMatrixSet.' % (z, col, row), 'TileOutOfRange')
+        layer = self.mapfactory.layers.get(layername) or self.mapfactory.meta_layers.get(layername)
+        if not layer:
+            raise OGCException('Layer "%s" not defined.' % layername, 'LayerNotDefined')
+        # the default style is requested the way WMS clients do, so that
+        # both services share their cached tiles
+        if style in ('default', default_style(layer)):
+            style = ''
+        params = {'layers': [layername],
+                  'styles': [style],
+                  'crs': CRS(*grid.crs.split(':')),
+                  'bbox': grid.tilebbox(z, col, row),
+                  'width': grid.tilesize,
+                  'height': grid.tilesize,
+                  'format': format,
+                  'transparent': format == 'image/jpeg' and 'FALSE' or 'TRUE',
+                  'bgcolor': ColorFactory('0xFFFFFF'),
+                  'HTTP_USER_AGENT': ''}
+        params.update(headers or {})
+        self._checkFormat(params)
+        return self._map(params, (grid, z, col, row))
+
+    def TileMapService(self):
+        root = ElementTree.Element('TileMapService', version='1.0.0', services=self.resturl + '/tms/')
+        ElementTree.SubElement(root, 'Title').text = to_unicode(self.conf.has_option_with_value('service', 'title') and self.conf.get('service', 'title') or 'OGCServer TMS')
+        tilemaps = ElementTree.SubElement(root, 'TileMaps')
+        for layer in self.mapfactory.ordered_layers:
+            for grid in self.grids:
+                for extension in sorted(FORMATS.keys()):
+                    if FORMATS[extension] not in self._extensions(layer):
+                        continue
+                    name = '%s@%s@%s' % (layer.name, grid.name, extension)
+                    ElementTree.SubElement(tilemaps, 'TileMap', title=to_unicode(layer.name), srs=grid.crs.upper(),
+                                           profile='none', href='%s/tms/1.0.0/%s/' % (self.resturl, name))
+        return Response('text/xml', '<?xml version="1.0" encoding="UTF-8"?>\n' + ElementTree.tostring(root, encoding='UTF-8', pretty_print=True))
+
+    def TileMap(self, layername, grid, extension):
+        root = ElementTree.Element('TileMap', version='1.0.0', tilemapservice=self.resturl + '/tms/1.0.0/')
+        ElementTree.SubElement(root, 'Title').text = to_unicode(layername)
+        ElementTree.SubElement(root, 'SRS').text = grid.crs.upper()
+        ElementTree.SubElement(root, 'BoundingBox', minx=repr(grid.extent[0]), miny=repr(grid.extent[1]),
+                               maxx=repr(grid.extent[2]), maxy=repr(grid.extent[3]))
+        ElementTree.SubElement(root, 'Origin', x=repr(grid.extent[0]), y=repr(grid.extent[1]))
+        ElementTree.SubElement(root, 'TileFormat', width=str(grid.tilesize), height=str(grid.tilesize),
+                               extension=extension, **{'mime-type': FORMATS[extension]})
+        tilesets = ElementTree.SubElement(root, 'TileSets', profile='none')
+        for z, resolution in enumerate(grid.resolutions):
+            ElementTree.SubElement(tilesets, 'TileSet', order=str(z), href='%s/tms/1.0.0/%s@%s@%s/%s' % (self.resturl, layername, grid.name, extension, z),
+                                   **{'units-per-pixel': repr(resolution)})
+        return Response('text/xml', '<?xml version="1.0" encoding="UTF-8"?>\n' + ElementTree.tostring(root, encoding='UTF-8', pretty_print=True))
+
+RESTPREFIXES = ('/wmts/', '/tms/')
+
+WMTSTILE = re.compile('^/wmts/1\.0\.0/([^/]+)/([^/]*)/([^/]+)/(\d+)/(\d+)/(\d+)\.(\w+)$')
+TMSTILEMAP = re.compile('^/tms/1\.0\.0/([^/@]+)@([^/@]+)@(\w+)/?$')
+TMSTILE = re.compile('^/tms/1\.0\.0/([^/@]+)@([^/@]+)@(\w+)/(\d+)/(\d+)/(\d+)\.\w+$')
+
+def default_style(layer):
+    """ The default style of a layer.  The meta layers of named rules are
+        not registered with register_layer, they only have a defaultstyle.
+    """
+    if hasattr(layer, 'wmsdefaultstyle'):
+        return layer.wmsdefaultstyle
+    return layer.defaultstyle
+
+def path_request(path):
+    """ 'GetTile' for the paths of RESTful tiles, None for the others. """
+    if WMTSTILE.match(path) or TMSTILE.match(path):
+        return 'GetTile'
+    return None
+
+def dispatch_path(conf, mapfactory, resturl, path, headers=None):
+    """ Answer a RESTful WMTS or TMS request, identified by the path alone.
+
+        @param resturl: The URL the paths are relative to, used in the
+                        capabilities documents.
+        @type resturl: String.
+
+        @param path: The path of the request below resturl, starting with
+                     one of RESTPREFIXES.
+        @type path: String.
+
+        @param headers: The conditional headers of the request, see
+                        common.conditional_headers.
+        @type headers: Dict.
+    """
+    handler = ServiceHandler(conf, mapfactory, resturl + '?', resturl)
+    found = WMTSTILE.match(path)
+    if found:
+        layername, style, gridname, z, row, col, extension = found.groups()
+        grid = handler._grid(gridname)
+        z = int(z)
+        if extension not in FORMATS or z >= len(grid.resolutions):
+            raise OGCException('No such tile "%s".' % path, 'TileOutOfRange')
+        cols, rows = grid.size(z)
+        return handler._tile(layername, style, grid, z, int(col), rows - int(row) - 1, FORMATS[extension], headers)
+    found = TMSTILE.match(path)
+    if found:
+        layername, gridname, extension, z, col, row = found.groups()
+        grid = handler._grid(gridname)
+        z = int(z)
+        if extension not in FORMATS or z >= len(grid.resolutions):
+            raise OGCException('No such tile "%s".' % path, 'TileOutOfRange')
+        return handler._tile(layername, '', grid, z, int(col), int(row), FORMATS[extension], headers)
+    if path in ('/wmts/1.0.0/WMTSCapabilities.xml', '/wmts/WMTSCapabilities.xml'):
+        return handler.GetCapabilities({})
+    if path in ('/tms/', '/tms/1.0.0', '/tms/1.0.0/'):
+        return handler.TileMapService()
+    found = TMSTILEMAP.match(path)
+    if found:
+        layername, gridname, extension = found.groups()
+        if extension not in FORMATS:
+            raise OGCException('Unknown tile format "%s".' % extension)
+        return handler.TileMap(layername, handler._grid(gridname), extension)
+    raise OGCException('Unknown resource "%s".' % path)
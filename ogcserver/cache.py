@@ -0,0 +1,1108 @@
+"""Server side caches of encoded map responses."""
+
+import os
+import re
+import sys
+import math
+import time
+import errno
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from ast import literal_eval
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# uses of a disk cache entry counted for lfu eviction, beyond which its
+# count is halved
+MAXHITS = 65536
+
+# seconds an MBTiles write waits for those of other processes, as when
+# several ogcserver-seed processes fill the same file
+BUSY_TIMEOUT = 60
+
+from ogcserver.common import Response, gzip_content
+from ogcserver.encoder import AUTO_FORMAT, MAXBLANKS, content_type as format_content_type, sniff_content_type
+from ogcserver.extents import transform_extent
+from ogcserver.exceptions import ServerConfigurationError
+
+class PeriodicThread:
+
+    def __init__(self, function, interval, delayed=False):
+        """ Calls function every interval seconds in a daemon thread, or
+            as soon as it is woken up.
+
+            @param delayed: Whether the first call waits an interval too,
+                            so that short lived processes never make it.
+            @type delayed: Boolean.
+        """
+        self.function = function
+        self.interval = interval
+        self.delayed = delayed
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        # the thread does not survive a fork, so it is started on first
+        # use in every process
+        if self.thread and self.pid == os.getpid():
+            return
+        self.lock.acquire()
+        try:
+            if not self.thread or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._loop)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def _loop(self):
+        if self.delayed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+        while True:
+            try:
+                self.function()
+            except Exception:
+                pass
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+class Invalidation:
+
+    def __init__(self, layernames, crs=None, bbox=None, grids=()):
+        """ Selects the cached responses to remove after the data of some
+            layers changed.
+
+            @param layernames: The names under which requests show the
+                               layers, as they appear in the request keys.
+            @type layernames: Collection of strings.
+
+            @param crs: The CRS of bbox, as in 'epsg:4326'.
+            @type crs: String.
+
+            @param bbox: Only select the responses intersecting this
+                         (minx, miny, maxx, maxy) box.  None selects every
+                         response of the layers.
+            @type bbox: Sequence of floats.
+
+            @param grids: The tile grids, to locate the responses keyed by
+                          their tile address.
+            @type grids: List of TileGrids.
+        """
+        self.layernames = set(layernames)
+        self.crs = crs and str(crs).lower()
+        self.bbox = bbox
+        self.grids = dict([(grid.name, grid) for grid in grids])
+        self.bboxes = {}
+
+    def matches(self, key):
+        """ Whether the response of a request key is selected. """
+        if not self.layernames.intersection(key[0]):
+            return False
+        if self.bbox is None:
+            return True
+        address = key[3]
+        if address and isinstance(address[0], basestring):
+            grid = self.grids.get(address[0])
+            if not grid:
+                return True
+            return self.intersects(grid.crs, grid.tilebbox(*address[1:]))
+        if key[9]:
+            # the BBOX lists y before x
+            address = (address[1], address[0], address[3], address[2])
+        return self.intersects(key[2], address)
+
+    def intersects(self, crs, bbox):
+        region = self._bbox(crs)
+        if region is None:
+            return True
+        return not (bbox[0] > region[2] or bbox[2] < region[0] or
+                    bbox[1] > region[3] or bbox[3] < region[1])
+
+    def tilerange(self, grid, z):
+        """ @return: The (mincol, minrow, maxcol, maxrow) range, inclusive,
+                     of the tiles of zoom level z intersecting the box.
+        """
+        cols, rows = grid.size(z)
+        region = self._bbox(grid.crs)
+        if region is None:
+            return 0, 0, cols - 1, rows - 1
+        span = grid.resolutions[z] * grid.tilesize
+        return (max(0, int(math.floor((region[0] - grid.extent[0]) / span))),
+                max(0, int(math.floor((region[1] - grid.extent[1]) / span))),
+                min(cols - 1, int(math.floor((region[2] - grid.extent[0]) / span))),
+                min(rows - 1, int(math.floor((region[3] - grid.extent[1]) / span))))
+
+    def _bbox(self, crs):
+        """ The box transformed to another CRS through points along its
+            edges, or None if it cannot be transformed.
+        """
+        if crs not in self.bboxes:
+            if crs == self.crs:
+                self.bboxes[crs] = tuple(self.bbox)
+            else:
+                self.bboxes[crs] = transform_extent('+init=%s' % self.crs, '+init=%s' % crs, self.bbox)
+        return self.bboxes[crs]
+
+class DiskCache:
+
+    def __init__(self, directory, fingerprint='', maxbytes=None, eviction='lru', interval=60,
+                 ttl=None, gcinterval=3600, stale=0):
+        """ A cache of responses stored as one file per entry below a
+            directory, surviving restarts and shared by all processes using
+            the same directory.  Blank maps are stored once, below blanks/,
+            and only referred to by their entries.
+
+            @param fingerprint: Identifies the mapfile and configuration the
+                                responses were rendered with.  Entries
+                                written with another fingerprint are never
+                                returned.
+            @type fingerprint: String.
+
+            @param maxbytes: Size budget of the cache.  Once exceeded, the
+                             least recently used (lru) or least frequently
+                             used (lfu) entries are removed until the cache
+                             is back at 90% of the budget.  None lets the
+                             cache grow unbounded.  The uses counted for lfu
+                             are kept in a hits file next to each entry, so
+                             that all processes count them together.
+            @type maxbytes: Integer.
+
+            @param interval: Seconds between two checks of the cache size,
+                             made by a background thread of one of the
+                             processes sharing the directory at a time.
+            @type interval: Integer.
+
+            @param ttl: Returns the number of seconds the responses of a
+                        list of layers stay fresh, or None if they never
+                        expire.
+            @type ttl: Function.
+
+            @param gcinterval: Seconds between two removals of the expired
+                               entries, and of the blank maps no entry
+                               refers to anymore, by the background thread.
+            @type gcinterval: Integer.
+
+            @param stale: Seconds expired entries are still returned,
+                          marked as stale, while they are rendered again.
+            @type stale: Integer.
+        """
+        if eviction not in ('lru', 'lfu'):
+            raise ServerConfigurationError('Unknown cache eviction policy "%s".' % eviction)
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.maxbytes = maxbytes
+        self.eviction = eviction
+        self.interval = interval
+        self.ttl = ttl
+        self.gcinterval = gcinterval
+        self.stale = stale
+        self.maintainer = PeriodicThread(self._maintain, interval, True)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+        self.blanks = OrderedDict()
+
+    def path(self, key):
+        digest = hashlib.sha1(self.fingerprint + repr(key)).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            fh = open(path, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        now = time.time()
+        try:
+            header = fh.readline().rstrip('\n').split('\t')
+            try:
+                expires = len(header) > 1 and int(header[1]) or 0
+            except ValueError:
+                # a corrupt entry or a file that is not one, it is
+                # replaced by the next put
+                self.misses += 1
+                return None
+            expired = expires and expires + self.stale < now
+            if expired:
+                content = None
+            elif len(header) > 3:
+                # the content of blank maps is stored once for all entries
+                content = self._blank(header[3])
+            else:
+                content = fh.read()
+        finally:
+            fh.close()
+        if content is None:
+            self._unlink(path)
+            self.misses += 1
+            if expired:
+                self.expirations += 1
+            return None
+        self.hits += 1
+        if self.eviction == 'lru':
+            # access times are unreliable on noatime mounts, the
+            # modification time doubles as the last use of an entry
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        else:
+            self._hit(path)
+        response = Response(header[0], content)
+        response.stale = 0 < expires < now
+        if len(header) > 3:
+            response.blank = header[3]
+        return response
+
+    def put(self, key, response):
+        # the response is served all the same when it cannot be stored
+        try:
+            self._put(key, response)
+        except (IOError, OSError), e:
+            sys.stderr.write('Warning: the response could not be cached: %s\n' % e)
+            return
+        self.maintainer.start()
+        if self.maxbytes and not response.blank:
+            self.bytes += len(response.content)
+            if self.bytes > self.maxbytes:
+                self.maintainer.wake()
+
+    def _put(self, key, response):
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        expires = 0
+        if self.ttl:
+            ttl = self.ttl(key[0])
+            if ttl:
+                expires = int(time.time() + ttl)
+        if response.blank:
+            self._putblank(response.blank, response.content)
+        # the key is kept to select the entries to invalidate
+        header = '%s\t%d\t%r' % (response.content_type, expires, key)
+        if response.blank:
+            self._write(path, header + '\t%s\n' % response.blank)
+        else:
+            self._write(path, header + '\n', response.content)
+
+    def putmany(self, items):
+        for key, response in items:
+            self.put(key, response)
+
+    def _write(self, path, *contents):
+        # write to a temporary file and rename it, so that readers never
+        # see a partially written file
+        fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            fh = os.fdopen(fd, 'wb')
+            try:
+                for content in contents:
+                    fh.write(content)
+            finally:
+                fh.close()
+            os.rename(temppath, path)
+        except:
+            os.unlink(temppath)
+            raise
+
+    def _blankpath(self, blank):
+        return os.path.join(self.directory, 'blanks', blank + '.blank')
+
+    def _putblank(self, blank, content):
+        # written again where the background thread removed it meanwhile
+        path = self._blankpath(blank)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._write(path, content)
+        self._keepblank(blank, content)
+
+    def _blank(self, blank):
+        """ The content of a blank map, or None if it is missing. """
+        self.lock.acquire()
+        try:
+            content = self.blanks.pop(blank, None)
+            if content is not None:
+                self.blanks[blank] = content
+        finally:
+            self.lock.release()
+        if content is None:
+            try:
+                fh = open(self._blankpath(blank), 'rb')
+            except IOError:
+                return None
+            try:
+                content = fh.read()
+            finally:
+                fh.close()
+            self._keepblank(blank, content)
+        return content
+
+    def _keepblank(self, blank, content):
+        # there is one blank map per size, format and color in use, the
+        # least recently used ones are dropped as the encoder does
+        self.lock.acquire()
+        try:
+            self.blanks.pop(blank, None)
+            self.blanks[blank] = content
+            while len(self.blanks) > MAXBLANKS:
+                self.blanks.popitem(False)
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self._unlink(self.path(key))
+
+    def invalidate(self, selection):
+        """ Remove the entries selected by an Invalidation.
+
+            @return: The number of entries removed.
+        """
+        removed = 0
+        for path in self._paths():
+            try:
+                expires, key, blank = self._header(path)
+            except IOError:
+                continue
+            # entries written by older versions do not record their key
+            if (key is None or selection.matches(key)) and self._unlink(path):
+                removed += 1
+        # stamped once the entries are gone, see invalidated
+        touch(os.path.join(self.directory, 'invalidated'))
+        return removed
+
+    def invalidated(self):
+        """ The time entries were last invalidated, by any of the
+            processes sharing the directory, or 0 if they never were.
+        """
+        return mtime(os.path.join(self.directory, 'invalidated'))
+
+    def gc(self):
+        """ Remove the expired entries, once they are too old to be
+            returned as stale, and the blank maps the remaining entries do
+            not refer to.
+
+            @return: The number of entries removed.
+        """
+        now = time.time()
+        removed = 0
+        blanks = set()
+        for path in self._paths():
+            try:
+                expires, key, blank = self._header(path)
+            except IOError:
+                continue
+            if expires and expires + self.stale < now and self._unlink(path):
+                removed += 1
+            elif blank:
+                blanks.add(blank)
+        self.expirations += removed
+        self._gcblanks(blanks, now)
+        return removed
+
+    def _gcblanks(self, blanks, now):
+        try:
+            filenames = os.listdir(os.path.join(self.directory, 'blanks'))
+        except OSError:
+            return
+        for filename in filenames:
+            blank, extension = os.path.splitext(filename)
+            if extension != '.blank' or blank in blanks:
+                continue
+            path = self._blankpath(blank)
+            try:
+                # spare those just written for entries not written yet
+                if now - os.stat(path).st_mtime < self.interval:
+                    continue
+                os.unlink(path)
+            except OSError:
+                continue
+            self.lock.acquire()
+            try:
+                self.blanks.pop(blank, None)
+            finally:
+                self.lock.release()
+
+    def _paths(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                # skip the temporary files of entries being written
+                if len(filename) == 40:
+                    yield os.path.join(dirpath, filename)
+
+    def _header(self, path):
+        """ @return: The expiry time, the key and the blank map of an
+                     entry, the blank map is None for other entries.
+        """
+        fh = open(path, 'rb')
+        try:
+            header = fh.readline().rstrip('\n').split('\t')
+        finally:
+            fh.close()
+        blank = len(header) > 3 and header[3] or None
+        if len(header) < 3:
+            return 0, None, blank
+        try:
+            return int(header[1]), literal_eval(header[2]), blank
+        except (ValueError, SyntaxError):
+            return 0, None, blank
+
+    def _hit(self, path):
+        # one byte per use, appends of several processes do not overwrite
+        # one another
+        try:
+            fh = open(path + '.hits', 'ab')
+            try:
+                fh.write('.')
+            finally:
+                fh.close()
+        except IOError:
+            pass
+
+    def _hits(self, path):
+        """ The number of uses of an entry since it was last aged. """
+        try:
+            return os.stat(path + '.hits').st_size
+        except OSError:
+            return 0
+
+    def _age(self, path, hits):
+        try:
+            fh = open(path + '.hits', 'r+b')
+            try:
+                fh.truncate(hits // 2)
+            finally:
+                fh.close()
+        except IOError:
+            pass
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            return False
+        try:
+            os.unlink(path + '.hits')
+        except OSError:
+            pass
+        return True
+
+    def evict(self):
+        """ Remove entries until the cache fits in 90% of its budget. """
+        entries = []
+        total = 0
+        for path in self._paths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            total += st.st_size
+            if self.eviction == 'lru':
+                entries.append((st.st_mtime, st.st_size, path))
+            else:
+                entries.append((self._hits(path), st.st_mtime, st.st_size, path))
+        evicting = total > self.maxbytes
+        if evicting:
+            entries.sort()
+            target = self.maxbytes * 0.9
+            while entries and total > target:
+                entry = entries.pop(0)
+                if not self._unlink(entry[-1]):
+                    continue
+                total -= entry[-2]
+                self.evictions += 1
+        if self.eviction == 'lfu':
+            for entry in entries:
+                # halved on every eviction, so that entries once popular
+                # make way for those popular now
+                if entry[0] and (evicting or entry[0] > MAXHITS):
+                    self._age(entry[-1], min(entry[0], MAXHITS))
+        self.bytes = total
+
+    def _maintain(self):
+        """ Evict and remove expired entries, at most once per interval
+            across all the processes sharing the directory.  Their size
+            and the time of the last removal of expired entries are kept
+            in the maintenance file, which is locked while the entries are
+            walked.
+        """
+        try:
+            fh = open(os.path.join(self.directory, 'maintenance'), 'a+')
+        except IOError:
+            return
+        try:
+            if fcntl:
+                try:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # another process is at it
+                    return
+            fh.seek(0)
+            try:
+                total, lastgc = [int(value) for value in fh.read().split()]
+            except ValueError:
+                total, lastgc = 0, 0
+            now = time.time()
+            if now - os.fstat(fh.fileno()).st_mtime < self.interval and lastgc:
+                self.bytes = max(self.bytes, total)
+                return
+            if self.maxbytes:
+                self.evict()
+            if now - lastgc >= self.gcinterval:
+                lastgc = int(now)
+                self.gc()
+            fh.seek(0)
+            fh.truncate()
+            fh.write('%d %d\n' % (self.bytes, lastgc or int(now)))
+        finally:
+            fh.close()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+class MemoryCache:
+
+    def __init__(self, maxbytes, ttl=None, compressor=None, invalidated=None):
+        """ A cache of responses held in the memory of the server process,
+            for the hottest responses.  Its keys are made by query_key.
+
+            @param maxbytes: Budget for the content of the cached responses,
+                             compressed copies included.  The least
+                             recently used responses are dropped as soon
+                             as it is exceeded.
+            @type maxbytes: Integer.
+
+            @param ttl: Returns the number of seconds the responses of a
+                        list of layers stay fresh, or None if they never
+                        expire.
+            @type ttl: Function.
+
+            @param compressor: Compresses the responses sent compressed
+                               before they are cached, so that their
+                               compressed copy counts against maxbytes.
+            @type compressor: Compressor.
+
+            @param invalidated: Returns the time responses were last
+                                invalidated by any process, see
+                                DiskCache.invalidated.  The responses
+                                cached before it are not served.
+            @type invalidated: Function.
+        """
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.compressor = compressor
+        self.invalidated = invalidated
+        self.lock = threading.Lock()
+        self.responses = OrderedDict()
+        self.sizes = {}
+        self.expires = {}
+        self.stored = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # invalidations made by other processes only reach this one
+        # through the shared cache
+        invalidated = self.invalidated and self.invalidated() or 0
+        self.lock.acquire()
+        try:
+            if key in self.expires and self.expires[key] < time.time():
+                self._remove(key)
+            elif key in self.stored and self.stored[key] < invalidated:
+                self._remove(key)
+            response = self.responses.pop(key, None)
+            if response:
+                self.responses[key] = response
+                self.hits += 1
+            else:
+                self.misses += 1
+            return response
+        finally:
+            self.lock.release()
+
+    def put(self, key, response):
+        # stale responses are being rendered again, the fresh one is kept
+        if response.stale:
+            return
+        if self.compressor:
+            self.compressor.precompress(response)
+        size = len(response.content) + len(response.gzipped or '')
+        if size > self.maxbytes:
+            return
+        ttl = self.ttl and self.ttl(_querylayers(key))
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self._remove(key)
+            self.responses[key] = response
+            self.sizes[key] = size
+            self.stored[key] = now
+            self.bytes += size
+            if ttl:
+                self.expires[key] = now + ttl
+            while self.bytes > self.maxbytes:
+                self._remove(next(iter(self.responses)))
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, selection):
+        """ Drop the responses showing any of the layers selected by an
+            Invalidation, whatever their BBOX.
+
+            @return: The number of responses dropped.
+        """
+        self.lock.acquire()
+        try:
+            keys = [key for key in self.responses
+                    if selection.layernames.intersection(_querylayers(key))]
+            for key in keys:
+                self._remove(key)
+        finally:
+            self.lock.release()
+        return len(keys)
+
+    def _remove(self, key):
+        if self.responses.pop(key, None):
+            self.bytes -= self.sizes.pop(key)
+        self.expires.pop(key, None)
+        self.stored.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hitratio': lookups and float(self.hits) / lookups,
+                'entries': len(self.responses),
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'evictions': self.evictions}
+
+class CapabilitiesCache:
+
+    def __init__(self, maxdocuments=16):
+        """ The capabilities documents served by a process, built once per
+            version, online resource and generation of the factory, and
+            kept both as they are and compressed with gzip.
+
+            The cache itself takes no lock, two requests missing the same
+            document at once both build it and the last one is kept.
+            Building a document takes others though, such as the one of
+            the shared projections, so no process may be forked while one
+            is built: the render pool waits for the documents built by
+            WMSFactory.prepare_capabilities before forking its workers.
+
+            @param maxdocuments: The number of documents kept, without a
+                                 baseurl the online resource follows the
+                                 Host header of the requests.
+            @type maxdocuments: Integer.
+        """
+        self.maxdocuments = maxdocuments
+        self.documents = {}
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, key, generation, build):
+        """ The capabilities document for key, built if it is missing or
+            older than generation.
+
+            @param key: The (version, onlineresource) of the document.
+            @type key: Tuple.
+
+            @param build: Returns the Response of the document.
+            @type build: Callable.
+        """
+        entry = self.documents.get(key)
+        if entry and entry[0] == generation:
+            self.hits += 1
+            return entry[1]
+        response = build()
+        response.gzipped = gzip_content(response.content)
+        self.builds += 1
+        if key not in self.documents and len(self.documents) >= self.maxdocuments:
+            self.documents = {}
+        self.documents[key] = (generation, response)
+        return response
+
+    def stats(self):
+        return {'documents': len(self.documents),
+                'hits': self.hits,
+                'builds': self.builds}
+
+class MBTilesCache:
+
+    formats = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp', 'application/json': 'json'}
+
+    def __init__(self, directory, fingerprint='', ttl=None, gcinterval=3600, stale=0):
+        """ A cache of grid-aligned tiles stored in one MBTiles (SQLite)
+            file per layer set, tile grid and format, below a directory.
+
+            Only requests matching a configured tile grid are cached, their
+            keys carry a (gridname, zoom, column, row) tuple in place of the
+            BBOX (see MetaTiler.tilekey).  Grid rows are counted from the
+            bottom, like MBTiles rows.
+
+            @param fingerprint: Identifies the mapfile and configuration the
+                                tiles were rendered with.  A new set of
+                                files is used whenever it changes.
+            @type fingerprint: String.
+
+            @param ttl: Returns the number of seconds the tiles of a list
+                        of layers stay fresh, or None if they never expire.
+            @type ttl: Function.
+
+            @param gcinterval: Seconds between two removals of the expired
+                               tiles by the background thread.
+            @type gcinterval: Integer.
+
+            @param stale: Seconds expired tiles are still returned, marked
+                          as stale, while they are rendered again.
+            @type stale: Integer.
+        """
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.ttl = ttl
+        self.stale = stale
+        self.maintainer = PeriodicThread(self.gc, gcinterval)
+        self.lock = threading.Lock()
+        self.tilesets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        tileset, address = self._tileset(key)
+        if not tileset:
+            return None
+        content, expires = tileset.read(*address)
+        now = time.time()
+        if content is None or (expires and expires + self.stale < now):
+            self.misses += 1
+            return None
+        self.hits += 1
+        content_type = tileset.content_type
+        if content_type == AUTO_FORMAT:
+            # the format of each tile was chosen on its own
+            content_type = sniff_content_type(content)
+        response = Response(content_type, content)
+        response.stale = bool(expires) and expires < now
+        return response
+
+    def put(self, key, response):
+        self.putmany([(key, response)])
+
+    def putmany(self, items):
+        """ Store several responses, writing the tiles of each file in a
+            single transaction.
+        """
+        batches = {}
+        for key, response in items:
+            tileset, address = self._tileset(key)
+            if tileset:
+                batches.setdefault(tileset, []).append(address + (response.content,))
+        for tileset, tiles in batches.items():
+            tileset.write(tiles)
+        if self.ttl and batches:
+            self.maintainer.start()
+
+    def delete(self, key):
+        tileset, address = self._tileset(key)
+        if tileset:
+            tileset.delete(*address)
+
+    def invalidate(self, selection):
+        """ Remove the tiles selected by an Invalidation.
+
+            @return: The number of tiles removed.
+        """
+        removed = 0
+        for path, setkey in self._files():
+            if setkey and not selection.layernames.intersection(setkey[0]):
+                continue
+            grid = setkey and selection.grids.get(setkey[3])
+            db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+            try:
+                # files of older versions do not record their key
+                if not grid or selection.bbox is None:
+                    removed += db.execute('DELETE FROM tiles').rowcount
+                else:
+                    for z in range(len(grid.resolutions)):
+                        mincol, minrow, maxcol, maxrow = selection.tilerange(grid, z)
+                        if mincol <= maxcol and minrow <= maxrow:
+                            removed += db.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column BETWEEN ? AND ? '
+                                                  'AND tile_row BETWEEN ? AND ?', (z, mincol, maxcol, minrow, maxrow)).rowcount
+                db.commit()
+            finally:
+                db.close()
+        touch(os.path.join(self.directory, 'invalidated'))
+        return removed
+
+    def invalidated(self):
+        """ The time tiles were last invalidated, by any of the processes
+            sharing the directory, or 0 if they never were.
+        """
+        return mtime(os.path.join(self.directory, 'invalidated'))
+
+    def gc(self):
+        """ Remove the expired tiles, once they are too old to be returned
+            as stale.
+
+            @return: The number of tiles removed.
+        """
+        removed = 0
+        for path, setkey in self._files():
+            db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+            try:
+                removed += db.execute('DELETE FROM tiles WHERE expires < ?', (int(time.time() - self.stale),)).rowcount
+                db.commit()
+            except sqlite3.OperationalError:
+                # no expires column, written by an older version
+                pass
+            finally:
+                db.close()
+        return removed
+
+    def _files(self):
+        """ Yield the path of every tile set file of the directory, with
+            the key it was created for.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.mbtiles'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+                try:
+                    result = db.execute("SELECT value FROM metadata WHERE name='ogcserver_key'").fetchone()
+                finally:
+                    db.close()
+                setkey = result and literal_eval(result[0]) or None
+            except (sqlite3.Error, ValueError, SyntaxError):
+                setkey = None
+            yield path, setkey
+
+    def _tileset(self, key):
+        address = key[3]
+        if not address or not isinstance(address[0], basestring):
+            return None, None
+        setkey = key[:3] + (address[0],) + key[4:]
+        self.lock.acquire()
+        try:
+            tileset = self.tilesets.get(setkey)
+            if not tileset:
+                layers, format = key[0], key[6]
+                # image/auto tiles are told apart by their content
+                content_type = format == AUTO_FORMAT and format or format_content_type(format)
+                digest = hashlib.sha1(self.fingerprint + repr(setkey)).hexdigest()[:8]
+                name = re.sub('[^\w.-]', '_', '%s-%s-%s-%s' % ('_'.join(layers)[:64], address[0],
+                                                                self.formats.get(content_type, 'img'), digest))
+                metadata = {'name': ','.join(layers),
+                            'type': key[7] == 'TRUE' and 'overlay' or 'baselayer',
+                            'version': '1.1',
+                            'description': 'Rendered by OGCServer',
+                            'format': self.formats.get(content_type, content_type),
+                            'ogcserver_key': repr(setkey)}
+                ttl = self.ttl and self.ttl(layers)
+                tileset = _TileSet(os.path.join(self.directory, name + '.mbtiles'), content_type, metadata, ttl)
+                self.tilesets[setkey] = tileset
+            return tileset, address[1:]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'tilesets': len(self.tilesets)}
+
+class _TileSet:
+
+    def __init__(self, path, content_type, metadata, ttl=None):
+        self.path = path
+        self.content_type = content_type
+        self.metadata = metadata
+        self.ttl = ttl
+        self.readlock = threading.Lock()
+        self.writelock = threading.Lock()
+        self.reader = None
+        self.writer = None
+        self.pid = None
+
+    def _checkfork(self):
+        # sqlite connections must not be used across a fork
+        if self.pid != os.getpid():
+            self.reader = self.writer = None
+            self.pid = os.getpid()
+
+    def read(self, z, col, row):
+        """ @return: The content of a tile and the time it expires, or
+                     (None, None) if it is missing.
+        """
+        self.readlock.acquire()
+        try:
+            self._checkfork()
+            if not self.reader:
+                if not os.path.exists(self.path):
+                    return None, None
+                # one read-only connection, shared by all request threads
+                self.reader = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+                self.reader.execute('PRAGMA query_only=ON')
+            try:
+                result = self.reader.execute('SELECT tile_data, expires FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                             (z, col, row)).fetchone()
+            except sqlite3.OperationalError:
+                # no expires column yet, it is added by the next write
+                return None, None
+        finally:
+            self.readlock.release()
+        if result:
+            return str(result[0]), result[1]
+        return None, None
+
+    def write(self, tiles):
+        self.writelock.acquire()
+        try:
+            self._checkfork()
+            if not self.writer:
+                self.writer = self._create()
+            expires = self.ttl and int(time.time() + self.ttl) or None
+            self.writer.executemany('INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, expires) VALUES (?, ?, ?, ?, ?)',
+                                    [(z, col, row, sqlite3.Binary(content), expires) for z, col, row, content in tiles])
+            self.writer.commit()
+        finally:
+            self.writelock.release()
+
+    def delete(self, z, col, row):
+        self.writelock.acquire()
+        try:
+            self._checkfork()
+            if not self.writer:
+                if not os.path.exists(self.path):
+                    return
+                self.writer = self._create()
+            self.writer.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (z, col, row))
+            self.writer.commit()
+        finally:
+            self.writelock.release()
+
+    def _create(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        # WAL lets request threads read while tiles are being written
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+        db.execute('CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)')
+        db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, expires INTEGER)')
+        if 'expires' not in [column[1] for column in db.execute('PRAGMA table_info(tiles)')]:
+            db.execute('ALTER TABLE tiles ADD COLUMN expires INTEGER')
+        db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        db.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', self.metadata.items())
+        db.commit()
+        return db
+
+def touch(path):
+    """ Set the modification time of a file to now, creating it if
+        needed.  Failures are ignored.
+    """
+    try:
+        open(path, 'a').close()
+        os.utime(path, None)
+    except (IOError, OSError):
+        pass
+
+def mtime(path):
+    """ The modification time of a file, 0 if it does not exist. """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+def _querylayers(key):
+    """ The layers requested in a key made by query_key, by the LAYERS
+        parameter of WMS or the LAYER parameter of a WMTS GetTile.
+    """
+    params = dict(key[0])
+    return params.get('layers', params.get('layer', '')).split(',')
+
+def query_key(reqparams, useragent=''):
+    """ A key identifying a request by its raw, lower cased parameters,
+        usable before the parameters are processed.
+    """
+    # the user agent is not part of the key, but MapInfo gets the WMS 1.3.0
+    # axis order for geographic CRSs reversed (see wms130._reversedAxes)
+    return (tuple(sorted([(name, str(value)) for name, value in reqparams.items()])),
+            'mapinfo' in useragent.lower())
+
+def load_cache(conf, fingerprint, ttl=None):
+    """ Create the response cache configured in the [server] section of
+        ogcserver.conf, or return None if there is none.
+
+        @param ttl: Returns the number of seconds the responses of a list of
+                    layers stay fresh, or None if they never expire.
+        @type ttl: Function.
+    """
+    if not conf.has_option_with_value('server', 'cachedir'):
+        return None
+    if conf.has_option_with_value('server', 'cachebackend'):
+        backend = conf.get('server', 'cachebackend').lower()
+    else:
+        backend = 'disk'
+    gcinterval = 3600
+    stale = 0
+    if conf.has_option_with_value('server', 'cachegcinterval'):
+        gcinterval = int(conf.get('server', 'cachegcinterval'))
+    if conf.has_option_with_value('server', 'stalewhilerevalidate'):
+        stale = int(conf.get('server', 'stalewhilerevalidate'))
+    if backend == 'mbtiles':
+        return MBTilesCache(conf.get('server', 'cachedir'), fingerprint, ttl, gcinterval, stale)
+    elif backend != 'disk':
+        raise ServerConfigurationError('Unknown cache backend "%s".' % backend)
+    maxbytes = None
+    eviction = 'lru'
+    interval = 60
+    if conf.has_option_with_value('server', 'cachemaxbytes'):
+        maxbytes = int(conf.get('server', 'cachemaxbytes'))
+    if conf.has_option_with_value('server', 'cacheeviction'):
+        eviction = conf.get('server', 'cacheeviction').lower()
+    if conf.has_option_with_value('server', 'cacheevictioninterval'):
+        interval = int(conf.get('server', 'cacheevictioninterval'))
+    return DiskCache(conf.get('server', 'cachedir'), fingerprint, maxbytes, eviction, interval, ttl, gcinterval, stale)
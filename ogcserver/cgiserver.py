@@ -11,12 +11,19 @@ environ['PYTHON_EGG_CACHE'] = gettempdir()
 import sys
 from jon import cgi
 
-from ogcserver.common import Version
+from ogcserver.cache import query_key
+from ogcserver.common import Version, CONDITIONAL_REQUESTS, cache_control, conditional_headers, entity_tag, http_date, \
+                             not_modified, variant_tag
 from ogcserver.configparser import SafeConfigParser
 from ogcserver.wms111 import ExceptionHandler as ExceptionHandler111
 from ogcserver.wms130 import ExceptionHandler as ExceptionHandler130
+from ogcserver.WMTS import RESTPREFIXES, dispatch_path, path_request
 from ogcserver.exceptions import OGCException, ServerConfigurationError
 
+# the map factories of this process by configuration file, a FastCGI
+# process creates a Handler for every request
+_mapfactories = {}
+
 class Handler(cgi.DebugHandler):
 
     def __init__(self, home_html=None):
@@ -25,20 +32,28 @@ class Handler(cgi.DebugHandler):
         # TODO - be able to supply in config as well
         self.home_html = home_html
         self.conf = conf
-        if not conf.has_option_with_value('server', 'module'):
-            raise ServerConfigurationError('The factory module is not defined in the configuration file.')
-        try:
-            mapfactorymodule = __import__(conf.get('server', 'module'))
-        except ImportError:
-            raise ServerConfigurationError('The factory module could not be loaded.')
-        if hasattr(mapfactorymodule, 'WMSFactory'):
-            self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')()
-        else:
-            raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
+        if self.configpath not in _mapfactories:
+            if not conf.has_option_with_value('server', 'module'):
+                raise ServerConfigurationError('The factory module is not defined in the configuration file.')
+            try:
+                mapfactorymodule = __import__(conf.get('server', 'module'))
+            except ImportError:
+                raise ServerConfigurationError('The factory module could not be loaded.')
+            if hasattr(mapfactorymodule, 'WMSFactory'):
+                mapfactory = getattr(mapfactorymodule, 'WMSFactory')()
+            else:
+                raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
+            mapfactory.configure(conf)
+            _mapfactories[self.configpath] = mapfactory
+        self.mapfactory = _mapfactories[self.configpath]
         if conf.has_option('server', 'debug'):
             self.debug = int(conf.get('server', 'debug'))
         else:
             self.debug = 0
+        if self.conf.has_option_with_value('server', 'maxage'):
+            self.max_age = 'max-age=%d' % int(self.conf.get('server', 'maxage'))
+        else:
+            self.max_age = None
 
     def process(self, req):
         base = False
@@ -53,6 +68,54 @@ class Handler(cgi.DebugHandler):
             # if there is no baseurl in the config file try to guess a valid one
             onlineresource = 'http://%s%s?' % (req.environ['HTTP_HOST'], req.environ['SCRIPT_NAME'])
 
+        response = None
+        memkey = None
+        etag = None
+        rest = req.environ.get('PATH_INFO', '').startswith(RESTPREFIXES)
+        conditional = rest or reqparams.get('request') in CONDITIONAL_REQUESTS
+        request = rest and path_request(req.environ['PATH_INFO']) or reqparams.get('request')
+        if rest:
+            response = self.dispatchpath(req)
+        elif self.mapfactory.memcache and reqparams.get('request') in ('GetMap', 'GetFeatureInfo', 'GetFeatureInfoBatch', 'GetTile'):
+            memkey = query_key(reqparams, req.environ.get('HTTP_USER_AGENT', ''))
+            response = self.mapfactory.memcache.get(memkey)
+        if not response:
+            response = self.dispatch(req, reqparams, base, onlineresource, memkey)
+        compressor = self.mapfactory.compressor
+        encoding = compressor.encoding(response, req.environ.get('HTTP_ACCEPT_ENCODING'))
+        cachecontrol = cache_control(self.max_age, self.mapfactory, request, response)
+        if conditional and response.conditional:
+            etag = entity_tag(response)
+            # maps are revalidated before rendering them, other responses
+            # once they are known
+            if response.notmodified or not_modified(etag, req.environ.get('HTTP_IF_NONE_MATCH'), response.modified,
+                                                    req.environ.get('HTTP_IF_MODIFIED_SINCE')):
+                req.set_header('Status', '304 Not Modified')
+                if compressor.compressible(response.content_type):
+                    req.set_header('Vary', 'Accept-Encoding')
+                req.set_header('ETag', response.variant or variant_tag(etag, encoding))
+                if response.modified is not None:
+                    req.set_header('Last-Modified', http_date(response.modified))
+                if cachecontrol:
+                    req.set_header('Cache-Control', cachecontrol)
+                return
+
+        content, encoding = compressor.compress(response, req.environ.get('HTTP_ACCEPT_ENCODING'))
+        req.set_header('Content-Type', response.content_type)
+        req.set_header('Content-Length', str(len(content)))
+        if encoding:
+            req.set_header('Content-Encoding', encoding)
+        if compressor.compressible(response.content_type):
+            req.set_header('Vary', 'Accept-Encoding')
+        if etag:
+            req.set_header('ETag', variant_tag(etag, encoding))
+            if response.modified is not None:
+                req.set_header('Last-Modified', http_date(response.modified))
+        if cachecontrol:
+            req.set_header('Cache-Control', cachecontrol)
+        req.write(content)
+
+    def dispatch(self, req, reqparams, base, onlineresource, memkey=None):
         try:
             if not reqparams.has_key('request'):
                 raise OGCException('Missing request parameter.')
@@ -60,7 +123,7 @@ class Handler(cgi.DebugHandler):
             del reqparams['request']
             if request == 'GetCapabilities' and not reqparams.has_key('service'):
                 raise OGCException('Missing service parameter.')
-            if request in ['GetMap', 'GetFeatureInfo']:
+            if request in ['GetMap', 'GetFeatureInfo', 'GetFeatureInfoBatch']:
                 service = 'WMS'
             else:
                 service = reqparams['service']
@@ -85,8 +148,13 @@ class Handler(cgi.DebugHandler):
             # stick the user agent in the request params
             # so that we can add ugly hacks for specific buggy clients
             ogcparams['HTTP_USER_AGENT'] = req.environ['HTTP_USER_AGENT']
+            # and the validators of the client's copy, for maps to be
+            # revalidated without rendering them
+            ogcparams.update(conditional_headers(req.environ))
 
             response = requesthandler(ogcparams)
+            if memkey and not response.notmodified:
+                self.mapfactory.memcache.put(memkey, response)
         except:
             version = reqparams.get('version', None)
             if not version:
@@ -98,10 +166,18 @@ class Handler(cgi.DebugHandler):
             else:
                 eh = ExceptionHandler111(self.debug,base,self.home_html)
             response = eh.getresponse(reqparams)
+        return response
 
-        req.set_header('Content-Type', response.content_type)
-        req.set_header('Content-Length', str(len(response.content)))
-        req.write(response.content)
+    def dispatchpath(self, req):
+        if self.conf.has_option_with_value('service', 'baseurl'):
+            resturl = self.conf.get('service', 'baseurl').rstrip('?')
+        else:
+            resturl = 'http://%s%s' % (req.environ['HTTP_HOST'], req.environ['SCRIPT_NAME'])
+        try:
+            return dispatch_path(self.conf, self.mapfactory, resturl, req.environ['PATH_INFO'], conditional_headers(req.environ))
+        except:
+            eh = ExceptionHandler111(self.debug)
+            return eh.getresponse({})
 
     def traceback(self, req):
         reqparams = lowerparams(req.params)
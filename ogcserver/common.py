@@ -3,8 +3,16 @@
 import re
 import sys
 import copy
+import json
+import math
+import zlib
+import hashlib
+import threading
 from sys import exc_info
+from gzip import GzipFile
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from StringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
 from lxml import etree as ElementTree
 from traceback import format_exception, format_exception_only
 
@@ -21,6 +29,13 @@ except ImportError:
     sys.stderr.write('Warning: PIL.Image not found: image based error messages will not be supported\n')
     HAS_PIL = False
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ogcserver.encoder import AUTO_FORMAT, content_type
+from ogcserver.utfgrid import UTFGRID_FORMAT
 from ogcserver.exceptions import OGCException, ServerConfigurationError
 
 
@@ -32,8 +47,19 @@ from ogcserver.exceptions import OGCException, ServerConfigurationError
 #                                    'http://www.w3.org/2001/XMLSchema-instance': 'xsi'
 #                                    })
 
-# TODO - need support for jpeg quality, and proper conversion into PIL formats
-PIL_TYPE_MAPPING = {'image/jpeg': 'jpeg', 'image/png': 'png', 'image/png8': 'png256'}
+# formats of the image based exceptions, maps are encoded by ogcserver.encoder
+PIL_TYPE_MAPPING = {'image/jpeg': 'jpeg', 'image/png': 'png', 'image/png8': 'png256', 'image/webp': 'webp', 'image/auto': 'png'}
+
+def _pil_saves(format):
+    try:
+        new('RGBA', (1, 1)).save(StringIO(), format)
+        return True
+    except Exception:
+        return False
+
+# WebP is optional in PIL builds, image based exceptions fall back to PNG
+if HAS_PIL and not _pil_saves('webp'):
+    PIL_TYPE_MAPPING['image/webp'] = 'png'
 
 class ParameterDefinition:
 
@@ -182,10 +208,255 @@ class BaseServiceHandler:
 
 class Response:
 
+    # whether an entity tag is sent
+    conditional = True
+    # whether it comes from a cache entry past its ttl
+    stale = False
+    # identifies the content shared by the blank maps of its size, format
+    # and color, see Encoder.encode
+    blank = None
+    # the content compressed with gzip, for responses that keep it
+    gzipped = None
+    # the entity tag of the content, see entity_tag
+    etag = None
+    # the time the content last changed, sent as Last-Modified, for
+    # responses whose entity tag is known before rendering them
+    modified = None
+    # whether it answers a conditional GET, see NotModified
+    notmodified = False
+    # the entity tag a 304 repeats, as the client sent it
+    variant = None
+
     def __init__(self, content_type, content):
         self.content_type = content_type
         self.content = content
 
+class NotModified(Response):
+
+    notmodified = True
+
+    def __init__(self, content_type, etag, modified=None, variant=None):
+        """ The answer to a conditional GET for a map the client holds,
+            sent as 304 Not Modified without a body.
+
+            @param variant: The tag of If-None-Match that matched, which
+                            names the content coding of the client's copy.
+            @type variant: String.
+        """
+        Response.__init__(self, content_type, '')
+        self.etag = etag
+        self.modified = modified
+        self.variant = variant
+
+def gzip_content(content, level=9):
+    """ Compress content with gzip.  The header carries no timestamp, so
+        that the same content always compresses to the same bytes.
+    """
+    buffer = StringIO()
+    gzipfile = GzipFile(fileobj=buffer, mode='wb', compresslevel=level, mtime=0)
+    gzipfile.write(content)
+    gzipfile.close()
+    return buffer.getvalue()
+
+class Compressor:
+
+    def __init__(self, level=6, minsize=1024):
+        """ Compresses text and XML responses for the clients accepting
+            gzip or deflate, as told by their Accept-Encoding header.
+            Images are sent as they are, they are compressed already.
+
+            @param level: The zlib compression level, from 1 to 9, 0 sends
+                          every response as it is.
+            @type level: Integer.
+
+            @param minsize: The size in bytes below which responses are
+                            not worth compressing.
+            @type minsize: Integer.
+        """
+        self.level = level
+        self.minsize = minsize
+
+    def compressible(self, content_type):
+        """ Whether responses of a content type are compressed for the
+            clients accepting it, so that they vary on Accept-Encoding.
+        """
+        content_type = content_type.split(';')[0].strip()
+        return bool(self.level) and (content_type.startswith('text/') or content_type.endswith('xml') or
+                                     content_type.endswith('json'))
+
+    def encoding(self, response, acceptencoding=None):
+        """ The content coding a response is sent with, without
+            compressing it, so that a 304 Not Modified response carries
+            the entity tag of the variant the client holds.
+
+            @param acceptencoding: The Accept-Encoding header of the request.
+            @type acceptencoding: String.
+
+            @return: 'gzip', 'deflate' or None for content sent as it is.
+        """
+        if not self.compressible(response.content_type) or len(response.content) < self.minsize:
+            return None
+        qualities = coding_qualities(acceptencoding)
+        for coding in ('gzip', 'deflate'):
+            # a coding refused by name is refused whatever * allows
+            if qualities.get(coding, qualities.get('*', 0)) > 0:
+                return coding
+        return None
+
+    def compress(self, response, acceptencoding=None):
+        """ The content to send for a response, compressed where the
+            client accepts it.  The gzip compressed content is kept with
+            the response, so that cached responses are only compressed
+            once.
+
+            @param acceptencoding: The Accept-Encoding header of the request.
+            @type acceptencoding: String.
+
+            @return: A (content, content encoding) tuple, the encoding is
+                     None for content sent as it is.
+        """
+        encoding = self.encoding(response, acceptencoding)
+        if encoding == 'gzip':
+            return self.gzip(response), 'gzip'
+        if encoding == 'deflate':
+            return zlib.compress(response.content, self.level), 'deflate'
+        return response.content, None
+
+    def gzip(self, response):
+        """ The gzip compressed content of a response, compressed on
+            first use and kept with it.
+        """
+        if response.gzipped is None:
+            response.gzipped = gzip_content(response.content, self.level)
+        return response.gzipped
+
+    def precompress(self, response):
+        """ Keep the gzip compressed content with a response that is
+            sent compressed to the clients accepting it, for the caches
+            holding it to account for both.
+        """
+        if self.compressible(response.content_type) and len(response.content) >= self.minsize:
+            self.gzip(response)
+
+def coding_qualities(acceptencoding):
+    """ The qualities of the content codings named by an Accept-Encoding
+        header, by coding.
+    """
+    qualities = {}
+    for item in (acceptencoding or '').split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        try:
+            quality = float(dict([part.strip().split('=', 1) for part in parts[1:] if '=' in part]).get('q', 1))
+        except ValueError:
+            quality = 0
+        if coding:
+            qualities[coding] = quality
+    return qualities
+
+def accepted_codings(acceptencoding):
+    """ The content codings accepted by an Accept-Encoding header, leaving
+        out those with a quality of 0.
+    """
+    return set([coding for coding, quality in coding_qualities(acceptencoding).items() if quality > 0])
+
+def load_compressor(conf):
+    """ Read the compresslevel and compressminsize options of the
+        [server] section of ogcserver.conf.
+    """
+    compressor = Compressor()
+    for option in ('compresslevel', 'compressminsize'):
+        if conf.has_option_with_value('server', option):
+            try:
+                value = int(conf.get('server', option))
+            except ValueError:
+                value = -1
+            if value < 0 or (option == 'compresslevel' and value > 9):
+                raise ServerConfigurationError('Invalid value for "%s" in the [server] section.' % option)
+            setattr(compressor, option[len('compress'):], value)
+    return compressor
+
+def variant_tag(etag, encoding):
+    """ The entity tag of the content of a response compressed with
+        encoding, which is another entity than the uncompressed one.
+    """
+    if not encoding:
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+# requests whose responses only depend on their parameters, the mapfile,
+# the configuration and the data
+CONDITIONAL_REQUESTS = ('GetCapabilities', 'GetMap', 'GetFeatureInfo', 'GetFeatureInfoBatch', 'GetTile')
+
+# requests for maps, which the response cache serves stale while
+# rendering them again, and so may HTTP caches
+STALE_REQUESTS = ('GetMap', 'GetTile')
+
+def cache_control(maxage, mapfactory, request, response):
+    """ The Cache-Control header of a 200 response, or None.
+
+        @param maxage: The max-age directive configured, if any.
+        @type maxage: String.
+
+        @param request: The request, or 'GetTile' for RESTful tiles.
+        @type request: String.
+    """
+    directives = maxage and [maxage] or []
+    if mapfactory.stale and request in STALE_REQUESTS and response.conditional:
+        directives.append('stale-while-revalidate=%d' % mapfactory.stale)
+    return ', '.join(directives) or None
+
+def entity_tag(response):
+    """ The strong HTTP entity tag of a response, a digest of its content.
+        It changes whenever the content does, whatever the cause, and is
+        the same in every server process.  It is kept with the response,
+        so that those served from the caches are only digested once.
+    """
+    if response.etag is None:
+        response.etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+    return response.etag
+
+# the headers of a conditional GET, as named in CGI and WSGI environs
+CONDITIONAL_HEADERS = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE')
+
+def conditional_headers(environ):
+    """ The CONDITIONAL_HEADERS a request carries, which are passed to
+        the service handlers with its parameters.
+    """
+    return dict([(name, environ[name]) for name in CONDITIONAL_HEADERS if environ.get(name)])
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+def matching_tag(etag, ifnonematch=None):
+    """ The tag of an If-None-Match header matching an entity tag, or
+        None if none does.
+    """
+    for tag in (ifnonematch or '').split(','):
+        tag = re.sub('^W/', '', tag.strip())
+        # the tags of compressed responses, see variant_tag, match too
+        if re.sub('-(gzip|deflate)"$', '"', tag) == etag:
+            return tag
+    return None
+
+def not_modified(etag, ifnonematch=None, modified=None, ifmodifiedsince=None):
+    """ Whether a conditional GET for a response with an entity tag is
+        answered with 304 Not Modified, from its If-None-Match and
+        If-Modified-Since headers.
+
+        @param modified: The time the content last changed, if known.
+        @type modified: Integer.
+    """
+    if ifnonematch:
+        # If-Modified-Since is ignored when If-None-Match is present
+        return matching_tag(etag, ifnonematch) is not None
+    if ifmodifiedsince and modified is not None:
+        try:
+            return mktime_tz(parsedate_tz(ifmodifiedsince)) >= int(modified)
+        except (TypeError, ValueError, OverflowError):
+            return False
+    return False
+
 class Version:
 
     def __init__(self, version = "1.1.1"):
@@ -230,6 +501,19 @@ class ListFactory:
         seq = string.split(',')
         return map(self.cast, seq)
 
+# the most points a GetFeatureInfoBatch request may query
+MAXBATCHPOINTS = 1000
+
+def PointListFactory(pointstring):
+    """ Parse a list of points, as in 'x1,y1;x2,y2'. """
+    points = []
+    for point in pointstring.split(';'):
+        x, y = point.split(',')
+        points.append((float(x), float(y)))
+    if len(points) > MAXBATCHPOINTS:
+        raise OGCException('At most %d points may be queried at once.' % MAXBATCHPOINTS)
+    return points
+
 def ColorFactory(colorstring):
     if re.match('^0x[a-fA-F0-9]{6}$', colorstring):
         return Color(eval('0x' + colorstring[2:4]), eval('0x' + colorstring[4:6]), eval('0x' + colorstring[6:8]))
@@ -256,12 +540,12 @@ class CRS:
 
     def inverse(self, x, y):
         if not self.proj:
-            self.proj = Projection('+init=%s:%s' % (self.namespace, self.code))
+            self.proj = get_projection('+init=%s:%s' % (self.namespace, self.code))
         return self.proj.inverse(Coord(x, y))
 
     def forward(self, x, y):
         if not self.proj:
-            self.proj = Projection('+init=%s:%s' % (self.namespace, self.code))        
+            self.proj = get_projection('+init=%s:%s' % (self.namespace, self.code))
         return self.proj.forward(Coord(x, y))
 
 class CRSFactory:
@@ -309,58 +593,392 @@ def copy_layer(obj):
 class WMSBaseServiceHandler(BaseServiceHandler):
 
     def GetMap(self, params):
-        m = self._buildMap(params)
+        self._checkFormat(params)
+        match = None
+        if self.mapfactory.metatiler:
+            # the grids list x before y
+            matchparams = params
+            if self._reversedAxes(params):
+                bbox = params['bbox']
+                matchparams = dict(params, bbox=[bbox[1], bbox[0], bbox[3], bbox[2]])
+            match = self.mapfactory.metatiler.match(matchparams)
+        return self._map(params, match)
+
+    def _checkFormat(self, params):
+        if params['format'] == AUTO_FORMAT and not self.mapfactory.encoder.auto:
+            raise OGCException('Format "%s" is not enabled on this server.' % AUTO_FORMAT, 'InvalidFormat')
+        if params['format'] == 'image/webp' and not self.mapfactory.encoder.webp:
+            raise OGCException('Format "image/webp" is not supported by the mapnik of this server.', 'InvalidFormat')
+        if params['format'] == UTFGRID_FORMAT and not self.mapfactory.utfgrid.available:
+            raise OGCException('Format "%s" is not supported by the mapnik of this server.' % UTFGRID_FORMAT, 'InvalidFormat')
+
+    def _map(self, params, match):
+        """ Serve a map from the caches, rendering it on a miss.
+
+            @param match: The (grid, zoom, column, row) address of the tile
+                          the map is, see MetaTiler.match, or None for maps
+                          not aligned to a tile grid.
+            @type match: Tuple.
+        """
+        if self.mapfactory.watcher:
+            self.mapfactory.watcher.start()
+        if match:
+            key = self.mapfactory.metatiler.tilekey(self, params, match)
+        else:
+            key = self._requestKey(params)
+        # the client's copy is checked before anything is looked up or
+        # rendered
+        etag, modified = self.mapfactory.validators(key, params['layers'])
+        ifnonematch = params.get('HTTP_IF_NONE_MATCH')
+        if not_modified(etag, ifnonematch, modified, params.get('HTTP_IF_MODIFIED_SINCE')):
+            return NotModified(content_type(params['format']), etag, modified, matching_tag(etag, ifnonematch))
+        if self.mapfactory.cache:
+            response = self.mapfactory.cache.get(key)
+            if response:
+                if not response.stale:
+                    return self._validated(response, etag, modified)
+                # served right away, the fresh map replaces it in the cache
+                if self.mapfactory.refresher:
+                    self.mapfactory.refresher.refresh(key, self._getMap, params, key, match, True)
+                # tagged by its content, which the validators do not
+                # describe anymore
+                return response
+        # identical requests arriving while one is rendering share its map
+        if self.mapfactory.singleflight:
+            response = self.mapfactory.singleflight.do(key, self._getMap, params, key, match)
+        else:
+            response = self._getMap(params, key, match)
+        return self._validated(response, etag, modified)
+
+    def _validated(self, response, etag, modified):
+        """ The response tagged with the validators of this request.  It
+            is a copy, as the response may be shared with other requests
+            and kept in the caches.
+        """
+        if response.conditional:
+            response = copy.copy(response)
+            response.etag = etag
+            response.modified = modified
+        return response
+
+    def _getMap(self, params, key, match, refresh=False):
+        if match:
+            return self.mapfactory.metatiler.gettile(self, params, match, refresh)
+        response = self._dispatch('_renderMap', params)
+        if self.mapfactory.cache:
+            self.mapfactory.cache.put(key, response)
+        return response
+
+    def InvalidateCache(self, params):
+        """ Vendor specific request removing the cached responses of some
+            layers, within a BBOX if one is given.  Only served when an
+            admintoken is set in the [server] section and passed as TOKEN.
+        """
+        if not self.conf.has_option_with_value('server', 'admintoken'):
+            raise OGCException('Operation "InvalidateCache" not supported.', 'OperationNotSupported')
+        # compare digests so that the time taken tells nothing about the token
+        if hashlib.sha256(params['token']).digest() != hashlib.sha256(self.conf.get('server', 'admintoken')).digest():
+            raise OGCException('Invalid token.')
+        bbox = params.get('bbox')
+        if bbox:
+            if not params.get('crs'):
+                raise OGCException('The CRS of the BBOX is missing.', 'InvalidCRS')
+            if len(bbox) != 4:
+                raise OGCException('Invalid BBOX.')
+            if self._reversedAxes(params):
+                bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+        removed = self.mapfactory.invalidate(params['layers'], params.get('crs'), bbox)
+        return Response('text/plain', 'Removed %d cached responses.\n' % removed)
+
+    def _dispatch(self, methodname, *args):
+        """ Call one of the rendering methods of this handler, in a worker
+            process of the render pool if one is configured.
+        """
+        if self.mapfactory.renderpool:
+            result = self.mapfactory.renderpool.apply(self, methodname, args)
+            # blank maps arrive as copies, this process keeps one of each
+            if isinstance(result, dict):
+                responses = result.values()
+            else:
+                responses = [result]
+            for response in responses:
+                if response.blank:
+                    response.content = self.mapfactory.encoder.share(response.blank, response.content)
+            return result
+        return getattr(self, methodname)(*args)
+
+    def _renderMap(self, params):
+        if params['format'] == UTFGRID_FORMAT:
+            grid, layer = self._renderGrid(params)
+            return self._encodeGrid(grid, layer)
+        im = self._render(params)
+        return self._encode(im, params)
+
+    def _renderMetaTile(self, params, tilesize, cols, rows):
+        """ Render a metatile of cols x rows tiles once and encode each of
+            its tiles separately.
+
+            @return: A dict of Responses keyed by (column, row) offsets of
+                     the tiles within the metatile, rows counted upwards
+                     from the bottom.
+        """
+        if params['format'] == UTFGRID_FORMAT:
+            im, layer = self._renderGrid(params)
+        else:
+            im = self._render(params)
+        tiles = {}
+        for dx in range(cols):
+            for dy in range(rows):
+                view = im.view(dx * tilesize, (rows - dy - 1) * tilesize, tilesize, tilesize)
+                if params['format'] == UTFGRID_FORMAT:
+                    tiles[(dx, dy)] = self._encodeGrid(view, layer)
+                else:
+                    # image/auto chooses the format of each tile on its own
+                    tiles[(dx, dy)] = self._encode(view, params)
+        return tiles
+
+    def _render(self, params):
+        """ Render the layers of a request that have data within its BBOX.
+            If none has, the image is only filled with the background.
+        """
+        layers = self._visibleLayers(params)
         im = Image(params['width'], params['height'])
-        render(m, im)
-        format = PIL_TYPE_MAPPING[params['format']]
-        return Response(params['format'].replace('8',''), im.tostring(format))
+        if layers:
+            m = self._buildMap(params, layers)
+            try:
+                render(m, im)
+            finally:
+                self._releaseMap(m)
+        else:
+            background = self._background(params)
+            if background:
+                im.background = background
+        return im
+
+    def _renderGrid(self, params):
+        """ Render the UTFGrid of the topmost queryable layer of a request
+            that has data within its BBOX.  If none has, the grid is empty.
+
+            @return: A (mapnik Grid, layer) tuple, layer being the one whose
+                     resolution the grid is encoded at.
+        """
+        requested = [layer for layer, styles in self._resolveLayers(params) if layer.queryable]
+        if not requested:
+            raise OGCException('None of the requested layers is marked queryable.', 'LayerNotQueryable')
+        layers = self._visibleLayers(params)
+        queryable = [index for index, (layer, styles) in enumerate(layers) if layer.queryable]
+        if not queryable:
+            return self.mapfactory.utfgrid.empty(params['width'], params['height']), requested[-1]
+        index = queryable[-1]
+        # the other layers stay in the Map, which is pooled with those of
+        # the image maps of the same request
+        m = self._buildMap(params, layers)
+        try:
+            grid = self.mapfactory.utfgrid.render(m, index, layers[index][0])
+        finally:
+            self._releaseMap(m)
+        return grid, layers[index][0]
+
+    def _visibleLayers(self, params):
+        """ The requested layers, as returned by _resolveLayers, without
+            those whose data lies outside the BBOX of the request or which
+            are not drawn at its scale, and with their styles trimmed to
+            the rules drawn at its scale.
+        """
+        self._checkBBox(params)
+        layers = self._resolveLayers(params)
+        crs = str(params['crs'])
+        bbox = params['bbox']
+        if self._reversedAxes(params):
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+        if self.mapfactory.scales:
+            scale = self.mapfactory.scales.denominator(crs, bbox, params['width'], params['height'])
+            layers = self.mapfactory.scales.active(layers, scale)
+        index = self.mapfactory.extents
+        extents = layers and index and index.indexed(crs)
+        if not extents:
+            return layers
+        # symbols and labels of data up to buffer_size pixels outside the
+        # map are drawn, and a pixel more allows for rounding
+        pixels = (self._bufferSize(params) or 0) + 1
+        padx = float(bbox[2] - bbox[0]) / params['width'] * pixels
+        pady = float(bbox[3] - bbox[1]) / params['height'] * pixels
+        found = index.intersecting(crs, (bbox[0] - padx, bbox[1] - pady, bbox[2] + padx, bbox[3] + pady))
+        return [(layer, styles) for layer, styles in layers
+                if layer.name in found or layer.name not in extents]
+
+    def _encode(self, image, params):
+        mimetype, content, blank = self.mapfactory.encoder.encode(image, params['format'], params['layers'])
+        response = Response(mimetype, content)
+        response.blank = blank
+        return response
+
+    def _encodeGrid(self, grid, layer):
+        return Response('application/json', self.mapfactory.utfgrid.encode(grid, layer))
+
+    def _requestKey(self, params, bbox=None):
+        """ A hashable key describing everything that affects the output
+            of a GetMap request.
+
+            @param bbox: Replaces the BBOX of the request in the key, for
+                         requests identified by their tile address instead.
+                         Tile addresses do not depend on the axis order,
+                         tiles requested either way share their key.
+        """
+        reversedaxes = False
+        if bbox is None:
+            bbox = tuple(params['bbox'])
+            reversedaxes = self._reversedAxes(params)
+        return (tuple(params['layers']), tuple(params.get('styles') or ()),
+                str(params['crs']), bbox, params['width'], params['height'],
+                params['format'], str(params.get('transparent')).upper(),
+                str(params.get('bgcolor')), reversedaxes)
+
+    def _reversedAxes(self, params):
+        """ Whether the BBOX of the request lists y before x. """
+        return False
 
     def GetFeatureInfo(self, params, querymethodname='query_point'):
-        m = self._buildMap(params)
-        if params['info_format'] == 'text/plain':
-            writer = TextFeatureInfo()
-        elif params['info_format'] == 'text/xml':
-            writer = XMLFeatureInfo()
-        if params['query_layers'] and params['query_layers'][0] == '__all__':
-            for layerindex, layer in enumerate(m.layers):
-                featureset = getattr(m, querymethodname)(layerindex, params['i'], params['j'])
-                features = featureset.features
+        """ Answer a GetFeatureInfo request by querying the datasources of
+            the query layers, without building a Map.
+
+            @param querymethodname: 'query_map_point' for requests whose
+                                    i and j are pixel positions,
+                                    'query_point' for map coordinates.
+        """
+        self._checkBBox(params)
+        writer = FEATURE_INFO_WRITERS[params['info_format']]()
+        # 1 by default as the specifications say, older versions ignored
+        # FEATURE_COUNT and returned every feature under the point
+        count = max(1, params.get('feature_count') or 1)
+        context = self._queryContext(params)
+        if querymethodname == 'query_map_point':
+            x, y = context.point(params['i'], params['j'])
+        else:
+            x, y = params['i'], params['j']
+        for layer in self._queryLayers(params):
+            for number, feature in enumerate(context.query(layer, x, y, count)):
+                if not number:
+                    writer.addlayer(layer.name)
+                geometry = None
+                if writer.geometries:
+                    geometry = feature_geometry(feature, layer.srs)
+                writer.addfeature(geometry)
+                for name, value in feature_attributes(feature):
+                    writer.addattribute(name, value)
+        return Response(params['info_format'], str(writer))
+
+    def GetFeatureInfoBatch(self, params):
+        """ Answer the GetFeatureInfoBatch vendor request, a GetFeatureInfo
+            for many points of the same map at once.  The points are
+            given as pixel positions in the PIXELS parameter or as map
+            coordinates in the POINTS parameter, both as in 'x1,y1;x2,y2'.
+            Map coordinates follow the axis order of the CRS, as the BBOX
+            does, both in the request and in the results.  The query
+            layers are queried in parallel.
+        """
+        self._checkBBox(params)
+        if bool(params.get('pixels')) == bool(params.get('points')):
+            raise OGCException('Either the PIXELS or the POINTS parameter is required.')
+        context = self._queryContext(params)
+        pixels = params.get('pixels')
+        reversedaxes = self._reversedAxes(params)
+        if pixels:
+            points = [context.point(i, j) for i, j in pixels]
+            requested = reversedaxes and [(y, x) for x, y in points] or points
+        else:
+            requested = params['points']
+            points = reversedaxes and [(x, y) for y, x in requested] or requested
+        count = max(1, params.get('feature_count') or 1)
+        layers = self._queryLayers(params)
+        def query(layer):
+            return [list(context.query(layer, x, y, count)) for x, y in points]
+        writers = [FEATURE_INFO_WRITERS[params['info_format']]() for point in points]
+        for layer, results in zip(layers, parallel_map(query, layers)):
+            for writer, features in zip(writers, results):
                 if features:
                     writer.addlayer(layer.name)
-                    for feat in features:
-                        writer.addfeature()
-                        if mapnik_version() >= 800:
-                            for prop in feat:
-                                writer.addattribute(prop[0], prop[1])                        
-                        else:
-                            for prop in feat.properties:
-                                writer.addattribute(prop[0], prop[1])
+                for feature in features:
+                    writer.addfeature()
+                    for name, value in feature_attributes(feature):
+                        writer.addattribute(name, value)
+        return Response(params['info_format'], batch_feature_info(params['info_format'], requested, pixels, writers))
+
+    def _queryContext(self, params):
+        bbox = params['bbox']
+        if self._reversedAxes(params):
+            bbox = (bbox[1], bbox[0], bbox[3], bbox[2])
+        return QueryContext(str(params['crs']), bbox, params['width'], params['height'],
+                            self.mapfactory.queryindexes)
+
+    def _queryLayers(self, params):
+        """ Resolve the QUERY_LAYERS of a GetFeatureInfo request by name,
+            leaving the other requested layers alone.
+        """
+        if params['query_layers'] and params['query_layers'][0] == '__all__':
+            return [layer for layer, styles in self._resolveLayers(params)]
+        layers = []
+        for layername in params['query_layers']:
+            if layername not in params['layers']:
+                raise OGCException('Requested query layer "%s" not in the LAYERS parameter.' % layername)
+            layer = self.mapfactory.layers.get(layername) or self.mapfactory.meta_layers.get(layername)
+            if not layer:
+                raise OGCException('Layer "%s" not defined.' % layername, 'LayerNotDefined')
+            if not layer.queryable:
+                raise OGCException('Requested query layer "%s" is not marked queryable.' % layername, 'LayerNotQueryable')
+            layers.append(layer)
+        return layers
+
+    def _buildMap(self, params, layers=None):
+        """ Build a Map for a request, from a pooled one if possible.
+
+            @param layers: The layers to draw, as returned by
+                           _resolveLayers.  Defaults to all requested
+                           layers.
+        """
+        self._checkBBox(params)
+
+        # relax this for now to allow for a set of specific layers (meta layers even)
+        # to be used without known their styles or putting the right # of commas...
+
+        #if params.has_key('styles') and len(params['styles']) != len(params['layers']):
+        #    raise OGCException('STYLES length does not match LAYERS length.')
+
+        background = self._background(params)
+        buffer_size = self._bufferSize(params)
+        if layers is None:
+            layers = self._resolveLayers(params)
+
+        # the pool hands out Maps that only differ from a freshly built
+        # one by their size and extent, which are set on every request
+        poolkey = (str(params['crs']),
+                   tuple([(layer.name, tuple([s[0] for s in styles])) for layer, styles in layers]),
+                   background and str(background),
+                   buffer_size)
+        m = self.mapfactory.mappool.checkout(poolkey)
+        if m:
+            m.resize(params['width'], params['height'])
         else:
-            for layerindex, layername in enumerate(params['query_layers']):
-                if layername in params['layers']:
-                    # TODO - pretty sure this is bogus, we can't pull from m.layers by the layerindex of the
-                    # 'query_layers' subset, need to pull from:
-                    # self.mapfactory.layers[layername]
-                    if m.layers[layerindex].queryable:
-                        featureset = getattr(m, querymethodname)(layerindex, params['i'], params['j'])
-                        features = featureset.features
-                        if features:
-                            writer.addlayer(m.layers[layerindex].name)
-                            for feat in features:
-                                writer.addfeature()
-                                if mapnik_version() >= 800:
-                                    for prop in feat:
-                                        writer.addattribute(prop[0], prop[1])                        
-                                else:
-                                    for prop in feat.properties:
-                                        writer.addattribute(prop[0], prop[1])
-                    else:
-                        raise OGCException('Requested query layer "%s" is not marked queryable.' % layername, 'LayerNotQueryable')
-                else:
-                    raise OGCException('Requested query layer "%s" not in the LAYERS parameter.' % layername)
-        return Response(params['info_format'], str(writer))
+            m = Map(params['width'], params['height'], '+init=%s' % params['crs'])
+            if background:
+                m.background = background
+            if buffer_size:
+                m.buffer_size = buffer_size
+            for layer_obj, styles in layers:
+                # if we don't copy the layer here we get
+                # duplicate layers added to the map because the
+                # layer is kept around and the styles "pile up"...
+                layer = copy_layer(layer_obj)
+                for stylename, style in styles:
+                    layer.styles.append(stylename)
+                    if style:
+                        m.append_style(stylename, style)
+                m.layers.append(layer)
+            m.poolkey = poolkey
+        m.zoom_to_box(Envelope(params['bbox'][0], params['bbox'][1], params['bbox'][2], params['bbox'][3]))
+        return m
 
-    def _buildMap(self, params):
+    def _checkBBox(self, params):
         if str(params['crs']) not in self.allowedepsgcodes:
             raise OGCException('Unsupported CRS "%s" requested.' % str(params['crs']).upper(), 'InvalidCRS')
         if params['bbox'][0] >= params['bbox'][2]:
@@ -368,72 +986,63 @@ class WMSBaseServiceHandler(BaseServiceHandler):
         if params['bbox'][1] >= params['bbox'][3]:
             raise OGCException("BBOX values don't make sense.  miny is greater than maxy.")
 
-        # relax this for now to allow for a set of specific layers (meta layers even)
-        # to be used without known their styles or putting the right # of commas...
-
-        #if params.has_key('styles') and len(params['styles']) != len(params['layers']):
-        #    raise OGCException('STYLES length does not match LAYERS length.')
-        m = Map(params['width'], params['height'], '+init=%s' % params['crs'])
-
+    def _background(self, params):
         if params.has_key('transparent') and params['transparent'] in ('FALSE','False','false'):
-            if params['bgcolor']:
-                m.background = params['bgcolor']
+            return params['bgcolor']
         elif not params.has_key('transparent') and self.mapfactory.map_attributes.get('bgcolor'):
-            m.background = self.mapfactory.map_attributes['bgcolor']
+            return self.mapfactory.map_attributes['bgcolor']
         else:
-            m.background = Color(0, 0, 0, 0)
+            return Color(0, 0, 0, 0)
 
+    def _bufferSize(self, params):
         if params.has_key('buffer_size'):
-            if params['buffer_size']:
-                m.buffer_size = params['buffer_size']
-        else:
-            buffer_ = self.mapfactory.map_attributes.get('buffer_size')
-            if buffer_:
-                m.buffer_size = self.mapfactory.map_attributes['buffer_size']
+            return params['buffer_size']
+        return self.mapfactory.map_attributes.get('buffer_size')
+
+    def _releaseMap(self, m):
+        """ Return a Map obtained from _buildMap to the pool once the
+            request no longer needs it.
+        """
+        self.mapfactory.mappool.checkin(m.poolkey, m)
 
+    def _resolveLayers(self, params):
+        """ Resolve the requested layers and styles against the map factory.
+
+            @return: A list of (layer, styles) tuples in drawing order, where
+                     styles is a list of (stylename, style) tuples.  style is
+                     None for style names that are attached to the layer but
+                     not registered with the factory.
+        """
+        layers = []
         # haiti spec tmp hack! show meta layers without having
         # to request huge string to avoid some client truncating it!
         if params['layers'] and params['layers'][0] in ('osm_haiti_overlay','osm_haiti_overlay_900913'):
-            for layer_obj in self.mapfactory.ordered_layers:
-                layer = copy_layer(layer_obj)
-                if not hasattr(layer,'meta_style'):
-                    pass
-                else:
-                    layer.styles.append(layer.meta_style)
-                    m.append_style(layer.meta_style, self.mapfactory.meta_styles[layer.meta_style])
-                    m.layers.append(layer)        
+            for layer in self.mapfactory.ordered_layers:
+                if hasattr(layer,'meta_style'):
+                    layers.append((layer, [(layer.meta_style, self.mapfactory.meta_styles[layer.meta_style])]))
         # a non WMS spec way of requesting all layers
         # uses orderedlayers that preserves original ordering in XML mapfile
         elif params['layers'] and params['layers'][0] == '__all__':
-            for layer_obj in self.mapfactory.ordered_layers:
-                # if we don't copy the layer here we get
-                # duplicate layers added to the map because the
-                # layer is kept around and the styles "pile up"...
-                layer = copy_layer(layer_obj)
+            for layer in self.mapfactory.ordered_layers:
                 if hasattr(layer,'meta_style'):
                     continue
                 reqstyle = layer.wmsdefaultstyle
                 if reqstyle in self.mapfactory.aggregatestyles.keys():
-                    for stylename in self.mapfactory.aggregatestyles[reqstyle]:
-                        layer.styles.append(stylename)
+                    stylenames = self.mapfactory.aggregatestyles[reqstyle]
                 else:
-                    layer.styles.append(reqstyle)
-                for stylename in layer.styles:
-                    if stylename in self.mapfactory.styles.keys():
-                        m.append_style(stylename, self.mapfactory.styles[stylename])
-                m.layers.append(layer)
+                    stylenames = [reqstyle]
+                layers.append((layer, [(stylename, self.mapfactory.styles.get(stylename)) for stylename in stylenames]))
         else:
             for layerindex, layername in enumerate(params['layers']):
                 if layername in self.mapfactory.meta_layers:
-                    layer = copy_layer(self.mapfactory.meta_layers[layername])
-                    layer.styles.append(layername)
-                    m.append_style(layername, self.mapfactory.meta_styles[layername])
+                    layer = self.mapfactory.meta_layers[layername]
+                    layers.append((layer, [(layername, self.mapfactory.meta_styles[layername])]))
                 else:
                     try:
                         # uses unordered dict of layers
                         # order based on params['layers'] request which
                         # should be originally informed by order of GetCaps response
-                        layer = copy_layer(self.mapfactory.layers[layername])
+                        layer = self.mapfactory.layers[layername]
                     except KeyError:
                         raise OGCException('Layer "%s" not defined.' % layername, 'LayerNotDefined')
                     try:
@@ -445,20 +1054,18 @@ class WMSBaseServiceHandler(BaseServiceHandler):
                     if not reqstyle:
                         reqstyle = layer.wmsdefaultstyle
                     if reqstyle in self.mapfactory.aggregatestyles.keys():
-                        for stylename in self.mapfactory.aggregatestyles[reqstyle]:
-                            layer.styles.append(stylename)
+                        stylenames = self.mapfactory.aggregatestyles[reqstyle]
                     else:
-                        layer.styles.append(reqstyle)
+                        stylenames = [reqstyle]
 
-                    for stylename in layer.styles:
+                    styles = []
+                    for stylename in stylenames:
                         if stylename in self.mapfactory.styles.keys():
-                            m.append_style(stylename, self.mapfactory.styles[stylename])
+                            styles.append((stylename, self.mapfactory.styles[stylename]))
                         else:
                             raise ServerConfigurationError('Layer "%s" refers to non-existent style "%s".' % (layername, stylename))
-                
-                m.layers.append(layer)
-        m.zoom_to_box(Envelope(params['bbox'][0], params['bbox'][1], params['bbox'][2], params['bbox'][3]))
-        return m
+                    layers.append((layer, styles))
+        return layers
 
 class BaseExceptionHandler:
 
@@ -468,6 +1075,12 @@ class BaseExceptionHandler:
         self.home_html = home_html
 
     def getresponse(self, params):
+        response = self._getresponse(params)
+        # exceptions may be transient, they must not be revalidated
+        response.conditional = False
+        return response
+
+    def _getresponse(self, params):
         code = ''
         message = '\n'
         if self.base and not params:
@@ -511,6 +1124,8 @@ class BaseExceptionHandler:
         return Response(self.xmlmimetype, ElementTree.tostring(ogcexcetree,pretty_print=True))
 
     def inimagehandler(self, code, message, params):
+        if params.get('format') not in PIL_TYPE_MAPPING:
+            return self.xmlhandler(code, message, params)
         im = new('RGBA', (int(params['width']), int(params['height'])))
         im.putalpha(new('1', (int(params['width']), int(params['height']))))
         draw = Draw(im)
@@ -520,9 +1135,11 @@ class BaseExceptionHandler:
         format = PIL_TYPE_MAPPING[params['format']].replace('256','')
         im.save(fh, format)
         fh.seek(0)
-        return Response(params['format'].replace('8',''), fh.read())
+        return Response('image/%s' % format, fh.read())
 
     def blankhandler(self, code, message, params):
+        if params.get('format') not in PIL_TYPE_MAPPING:
+            return self.xmlhandler(code, message, params)
         bgcolor = params.get('bgcolor', '#FFFFFF')
         bgcolor = bgcolor.replace('0x', '#')
         transparent = params.get('transparent', 'FALSE')
@@ -535,63 +1152,566 @@ class BaseExceptionHandler:
         format = PIL_TYPE_MAPPING[params['format']].replace('256','')
         im.save(fh, format)
         fh.seek(0)
-        return Response(params['format'].replace('8',''), fh.read())
+        return Response('image/%s' % format, fh.read())
 
 class Projection(MapnikProjection):
     
     def epsgstring(self):
         return self.params().split('=')[1].upper()
 
+_projections = {}
+_projectionslock = threading.Lock()
+
+def get_projection(proj4):
+    """ The Projection of a proj4 string, such as '+init=epsg:4326',
+        shared by all threads of the process so that each string is only
+        parsed once.
+    """
+    projection = _projections.get(proj4)
+    if projection is None:
+        _projectionslock.acquire()
+        try:
+            projection = _projections.get(proj4)
+            if projection is None:
+                projection = _projections[proj4] = Projection(proj4)
+        finally:
+            _projectionslock.release()
+    return projection
+
+WGS84 = '+init=epsg:4326'
+
+# spherical mercator, transformed to and from WGS84 without proj
+MERCATOR = ('+init=epsg:900913', '+init=epsg:3857', '+init=epsg:3785', '+init=epsg:102100', '+init=epsg:102113')
+
+EARTH_RADIUS = 6378137.0
+
+# the latitude at which spherical mercator is square
+MERCATOR_MAXLAT = 85.0511287798066
+
+def transform_points(source, target, xs, ys):
+    """ Reproject many coordinates in one call, such as the corners and
+        edge points of a box.  Transforms between WGS84 and spherical
+        mercator are computed directly, with NumPy if it is installed,
+        others go through the shared projections point by point.
+        Latitudes are clamped to the range of spherical mercator.
+
+        @param source: The proj4 string of the projection of the points.
+        @type source: String.
+
+        @param target: The proj4 string of the projection to transform the
+                       points to.
+        @type target: String.
+
+        @param xs: The x coordinates, or longitudes.
+        @type xs: Sequence or NumPy array of floats.
+
+        @param ys: The y coordinates, or latitudes.
+        @type ys: Sequence or NumPy array of floats.
+
+        @return: The transformed x and y coordinates, as NumPy arrays if
+                 NumPy is installed and as lists otherwise.  Points that
+                 cannot be transformed are nan.
+    """
+    if numpy is not None:
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        if source == target:
+            return xs.copy(), ys.copy()
+        if source == WGS84 and target in MERCATOR:
+            lats = numpy.radians(numpy.clip(ys, -MERCATOR_MAXLAT, MERCATOR_MAXLAT))
+            return (numpy.radians(xs) * EARTH_RADIUS,
+                    numpy.log(numpy.tan(math.pi / 4 + lats / 2)) * EARTH_RADIUS)
+        if source in MERCATOR and target == WGS84:
+            return (numpy.degrees(xs / EARTH_RADIUS),
+                    numpy.degrees(2 * numpy.arctan(numpy.exp(ys / EARTH_RADIUS)) - math.pi / 2))
+        newxs, newys = _transform_each(source, target, xs, ys)
+        return numpy.array(newxs, dtype=float), numpy.array(newys, dtype=float)
+    if source == target:
+        return list(xs), list(ys)
+    if source == WGS84 and target in MERCATOR:
+        lats = [math.radians(max(-MERCATOR_MAXLAT, min(MERCATOR_MAXLAT, y))) for y in ys]
+        return ([math.radians(x) * EARTH_RADIUS for x in xs],
+                [math.log(math.tan(math.pi / 4 + lat / 2)) * EARTH_RADIUS for lat in lats])
+    if source in MERCATOR and target == WGS84:
+        return ([math.degrees(x / EARTH_RADIUS) for x in xs],
+                [math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi / 2) for y in ys])
+    return _transform_each(source, target, xs, ys)
+
+def finite(values):
+    """ Whether none of the values is nan or infinite. """
+    return not [v for v in values if math.isinf(v) or math.isnan(v)]
+
+def wgs84_bounds(source, env):
+    """ The bounds of an envelope in WGS84, for the bounding boxes of the
+        capabilities.  Infinite coordinates are clamped to the world.
+
+        @param source: The proj4 string of the projection of the envelope.
+        @type source: String.
+
+        @param env: The envelope to transform.
+        @type env: Envelope.
+
+        @return: The (minlon, minlat, maxlon, maxlat) bounds, or None if the
+                 envelope cannot be transformed.
+    """
+    if not finite((env.minx, env.miny, env.maxx, env.maxy)):
+        return None
+    lons, lats = transform_points(source, WGS84, (env.minx, env.maxx), (env.miny, env.maxy))
+    bounds = [float(lons[0]), float(lats[0]), float(lons[1]), float(lats[1])]
+    if [v for v in bounds if math.isnan(v)]:
+        return None
+    return (max(-180.0, min(180.0, bounds[0])), max(-90.0, min(90.0, bounds[1])),
+            max(-180.0, min(180.0, bounds[2])), max(-90.0, min(90.0, bounds[3])))
+
+def _transform_each(source, target, xs, ys):
+    sourceproj = get_projection(source)
+    targetproj = get_projection(target)
+    newxs, newys = [], []
+    for x, y in zip(xs, ys):
+        try:
+            point = targetproj.forward(sourceproj.inverse(Coord(float(x), float(y))))
+            newxs.append(point.x)
+            newys.append(point.y)
+        except Exception:
+            newxs.append(float('nan'))
+            newys.append(float('nan'))
+    return newxs, newys
+
+# the mapnik API for the attributes and geometries of features, resolved
+# once instead of for every feature
+if mapnik_version() >= 800:
+    def feature_attributes(feature):
+        """ The (name, value) attributes of a feature. """
+        return feature
+else:
+    def feature_attributes(feature):
+        """ The (name, value) attributes of a feature. """
+        return feature.properties
+
+if mapnik_version() >= 300000:
+    def _geometries(feature):
+        return [feature.geometry]
+elif mapnik_version() >= 200100:
+    def _geometries(feature):
+        return feature.geometries()
+else:
+    def _geometries(feature):
+        # geometries cannot be written as GeoJSON before mapnik 2.1
+        return []
+
+def iter_features(featureset, count=None):
+    """ Iterate over the features of a featureset, up to count of them,
+        without reading the rest as featureset.features does.
+    """
+    number = 0
+    while count is None or number < count:
+        try:
+            feature = featureset.next()
+        except StopIteration:
+            return
+        # older mapnik versions mark the end with None
+        if feature is None:
+            return
+        yield feature
+        number += 1
+
+def feature_geometry(feature, srs):
+    """ The geometry of a feature as a GeoJSON geometry object in WGS84.
+
+        @param srs: The proj4 string of the projection of the layer of
+                    feature.
+        @type srs: String.
+
+        @return: A dict, or None if the geometry is missing or cannot be
+                 transformed.
+    """
+    try:
+        geometries = [json.loads(geometry.to_geojson()) for geometry in _geometries(feature)]
+    except Exception:
+        return None
+    if not geometries:
+        return None
+    if len(geometries) == 1:
+        return reproject_geometry(geometries[0], srs)
+    return reproject_geometry({'type': 'GeometryCollection', 'geometries': geometries}, srs)
+
+def reproject_geometry(geometry, srs):
+    """ Transform a GeoJSON geometry object from a projection to WGS84, in
+        place.
+
+        @return: geometry, or None if it cannot be transformed.
+    """
+    if srs == WGS84:
+        return geometry
+    positions = []
+    _positions(geometry, positions)
+    xs, ys = transform_points(srs, WGS84, [position[0] for position in positions],
+                              [position[1] for position in positions])
+    for position, x, y in zip(positions, xs, ys):
+        if math.isinf(x) or math.isnan(x) or math.isinf(y) or math.isnan(y):
+            return None
+        position[0], position[1] = float(x), float(y)
+    return geometry
+
+def _positions(geometry, positions):
+    # the [x, y] lists of a GeoJSON geometry, nested at any depth
+    if geometry['type'] == 'GeometryCollection':
+        for part in geometry['geometries']:
+            _positions(part, positions)
+        return
+    stack = [geometry['coordinates']]
+    while stack:
+        coordinates = stack.pop()
+        if coordinates and isinstance(coordinates[0], (int, long, float)):
+            positions.append(coordinates)
+        else:
+            stack.extend(coordinates)
+
+# the pixels around a query point within which features are hit, as in
+# mapnik's Map.query_point
+QUERY_TOLERANCE = 3
+
+class QueryContext:
+
+    def __init__(self, crs, bbox, width, height, indexes=None):
+        """ The extent and pixel size of the map of a GetFeatureInfo
+            request, for querying the datasources of its layers directly.
+
+            @param crs: The CRS of bbox, as in 'epsg:4326'.
+            @type crs: String.
+
+            @param bbox: The (minx, miny, maxx, maxy) of the map, grown to
+                         the aspect ratio of width and height as mapnik
+                         does.
+            @type bbox: Sequence of floats.
+
+            @param indexes: Layers queried through an index instead of
+                            their datasource, see queryindex.
+            @type indexes: Dict of ShapefileIndexes by layer name.
+        """
+        self.indexes = indexes or {}
+        self.proj4 = '+init=%s' % crs
+        minx, miny, maxx, maxy = [float(v) for v in bbox]
+        ratio = float(width) / height
+        centerx, centery = (minx + maxx) / 2, (miny + maxy) / 2
+        if (maxx - minx) / (maxy - miny) > ratio:
+            half = (maxx - minx) / ratio / 2
+            miny, maxy = centery - half, centery + half
+        else:
+            half = (maxy - miny) * ratio / 2
+            minx, maxx = centerx - half, centerx + half
+        self.extent = (minx, miny, maxx, maxy)
+        self.resolution = (maxx - minx) / width
+        self.tolerance = self.resolution * QUERY_TOLERANCE
+
+    def point(self, i, j):
+        """ The map coordinates of a pixel position. """
+        return self.extent[0] + i * self.resolution, self.extent[3] - j * self.resolution
+
+    def query(self, layer, x, y, count=None):
+        """ Iterate over the features of a layer hit at a point, up to count
+            of them.
+
+            @param x, y: The point, in map coordinates.
+        """
+        datasource = layer.datasource
+        if not datasource:
+            return
+        if layer.srs == self.proj4:
+            tolerance = self.tolerance
+        else:
+            xs, ys = transform_points(self.proj4, layer.srs, (x, x + self.tolerance), (y, y))
+            if [v for v in list(xs) + list(ys) if math.isinf(v) or math.isnan(v)]:
+                return
+            x, y = float(xs[0]), float(ys[0])
+            tolerance = abs(float(xs[1]) - x)
+        index = self.indexes.get(getattr(layer, 'wms_source', layer.name))
+        if index:
+            for feature in index.query(x, y, tolerance, count):
+                yield feature
+            return
+        hits = 0
+        for feature in iter_features(features_at_point(datasource, x, y, tolerance)):
+            if feature_hit(feature, x, y, tolerance):
+                yield feature
+                hits += 1
+                if hits == count:
+                    return
+
+# the most threads a request queries its layers with
+MAXQUERYTHREADS = 4
+
+def parallel_map(function, items, maxthreads=MAXQUERYTHREADS):
+    """ map(function, items), spread over up to maxthreads threads, the
+        calling one included.  The first exception raised by function is
+        raised again once all items are done.
+    """
+    results = [None] * len(items)
+    errors = []
+    threads = max(1, min(len(items), maxthreads))
+    def run(start):
+        for index in range(start, len(items), threads):
+            try:
+                results[index] = function(items[index])
+            except Exception:
+                errors.append(exc_info())
+    workers = [threading.Thread(target=run, args=(start,)) for start in range(1, threads)]
+    for worker in workers:
+        worker.start()
+    run(0)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def features_at_point(datasource, x, y, tolerance):
+    """ The featureset of the features of datasource whose bounding box
+        is within tolerance of a point, in the coordinates of datasource.
+    """
+    global _tolerant
+    if _tolerant:
+        try:
+            return datasource.features_at_point(Coord(x, y), tolerance)
+        except TypeError:
+            # mapnik before 2.1 takes no tolerance
+            _tolerant = False
+    return datasource.features_at_point(Coord(x, y))
+
+_tolerant = True
+
+def feature_hit(feature, x, y, tolerance):
+    """ Whether the geometry of a feature is hit by a query at a point,
+        for points and lines within tolerance of it, for polygons when
+        they contain it.  Features whose geometry cannot be read are taken
+        to be hit, as the datasource found their bounding box hit.
+    """
+    try:
+        geometries = [json.loads(geometry.to_geojson()) for geometry in _geometries(feature)]
+    except Exception:
+        return True
+    if not geometries:
+        return True
+    for geometry in geometries:
+        if hit_test(geometry, x, y, tolerance):
+            return True
+    return False
+
+def hit_test(geometry, x, y, tolerance):
+    """ Whether a GeoJSON geometry object is hit by a query at a point. """
+    kind = geometry['type']
+    if kind == 'GeometryCollection':
+        return bool([part for part in geometry['geometries'] if hit_test(part, x, y, tolerance)])
+    coordinates = geometry['coordinates']
+    if kind == 'Point':
+        coordinates, kind = [coordinates], 'MultiPoint'
+    elif kind in ('LineString', 'Polygon'):
+        coordinates, kind = [coordinates], 'Multi' + kind
+    for part in coordinates:
+        if kind == 'MultiPoint':
+            if math.hypot(part[0] - x, part[1] - y) <= tolerance:
+                return True
+        elif kind == 'MultiLineString':
+            for (x1, y1), (x2, y2) in zip([p[:2] for p in part[:-1]], [p[:2] for p in part[1:]]):
+                if _segment_distance(x, y, x1, y1, x2, y2) <= tolerance:
+                    return True
+        elif kind == 'MultiPolygon':
+            if _inside(part, x, y):
+                return True
+    return False
+
+def _segment_distance(x, y, x1, y1, x2, y2):
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length:
+        t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length))
+    return math.hypot(x1 + t * dx - x, y1 + t * dy - y)
+
+def _inside(rings, x, y):
+    # even-odd rule over all rings, so that holes are left out
+    inside = False
+    for ring in rings:
+        for (x1, y1), (x2, y2) in zip([p[:2] for p in ring], [p[:2] for p in ring[1:] + ring[:1]]):
+            if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / float(y2 - y1) + x1:
+                inside = not inside
+    return inside
+
+def _text(value):
+    if isinstance(value, basestring):
+        return to_unicode(value)
+    return unicode(value)
+
+def _utf8(value):
+    return _text(value).encode('utf-8')
+
 class TextFeatureInfo:
 
+    # whether addfeature is passed the geometry of each feature
+    geometries = False
+
     def __init__(self):
-        self.buffer = ''
+        self.chunks = []
 
     def addlayer(self, name):
-        self.buffer += '\n[%s]\n' % name
+        self.chunks.append('\n[%s]\n' % _utf8(name))
 
-    def addfeature(self):
-        pass#self.buffer += '\n'
+    def addfeature(self, geometry=None):
+        pass
 
     def addattribute(self, name, value):
-        self.buffer += '%s=%s\n' % (name, str(value))
+        self.chunks.append('%s=%s\n' % (_utf8(name), _utf8(value)))
 
     def __str__(self):
-        return self.buffer
+        return ''.join(self.chunks)
 
 class XMLFeatureInfo:
 
-    basexml = """<?xml version="1.0"?>
-    <resultset>
-    </resultset>
-    """
+    geometries = False
 
     def __init__(self):
-        self.rootelement = ElementTree.fromstring(self.basexml)
+        self.chunks = []
+        self.closing = []
 
     def addlayer(self, name):
-        layer = ElementTree.Element('layer')
-        layer.set('name', name)
-        self.rootelement.append(layer)
-        self.currentlayer = layer
-
-    def addfeature(self):
-        feature = ElementTree.Element('feature')
-        self.currentlayer.append(feature)
-        self.currentfeature = feature
-    
+        self._close(0)
+        self.chunks.append('<layer name=%s>' % _utf8(quoteattr(_text(name))))
+        self.closing.append('</layer>')
+
+    def addfeature(self, geometry=None):
+        self._close(1)
+        self.chunks.append('<feature>')
+        self.closing.append('</feature>')
+
     def addattribute(self, name, value):
-        attribute = ElementTree.Element('attribute')
-        attname = ElementTree.Element('name')
-        attname.text = name
-        attvalue = ElementTree.Element('value')
-        attvalue.text = unicode(value)
-        attribute.append(attname)
-        attribute.append(attvalue)
-        self.currentfeature.append(attribute)
-    
+        self.chunks.append('<attribute><name>%s</name><value>%s</value></attribute>' %
+                           (_utf8(escape(_text(name))), _utf8(escape(_text(value)))))
+
+    def _close(self, depth):
+        while len(self.closing) > depth:
+            self.chunks.append(self.closing.pop())
+
+    def body(self):
+        """ The layer elements written so far. """
+        return ''.join(self.chunks + self.closing[::-1])
+
     def __str__(self):
-        return '<?xml version="1.0"?>\n' + ElementTree.tostring(self.rootelement)
+        return '<?xml version="1.0"?>\n<resultset>%s</resultset>' % self.body()
+
+class JSONFeatureInfo:
+
+    geometries = False
+
+    def __init__(self):
+        self.chunks = []
+        self.closing = []
+        self.first = True
+        self.attributes = 0
+
+    def addlayer(self, name):
+        self._close(0)
+        if self.chunks:
+            self.chunks.append(', ')
+        self.chunks.append('{"name": %s, "features": [' % json.dumps(_text(name)))
+        self.closing.append(']}')
+        self.first = True
+
+    def addfeature(self, geometry=None):
+        self._close(1)
+        if not self.first:
+            self.chunks.append(', ')
+        self.first = False
+        self.chunks.append('{')
+        self.closing.append('}')
+        self.attributes = 0
+
+    def addattribute(self, name, value):
+        if self.attributes:
+            self.chunks.append(', ')
+        self.attributes += 1
+        self.chunks.append('%s: %s' % (json.dumps(_text(name)), _json(value)))
+
+    def _close(self, depth):
+        while len(self.closing) > depth:
+            self.chunks.append(self.closing.pop())
+
+    def body(self):
+        """ The layer objects written so far, without the array around
+            them.
+        """
+        return ''.join(self.chunks + self.closing[::-1])
+
+    def __str__(self):
+        return '{"layers": [%s]}' % self.body()
+
+class GeoJSONFeatureInfo:
+
+    geometries = True
+
+    def __init__(self):
+        self.chunks = ['{"type": "FeatureCollection", "features": [']
+        self.layer = None
+        self.open = False
+        self.attributes = 0
+
+    def addlayer(self, name):
+        self.layer = json.dumps(_text(name))
+
+    def addfeature(self, geometry=None):
+        if self.open:
+            self.chunks.append('}}, ')
+        self.open = True
+        self.chunks.append('{"type": "Feature", "layer": %s, "geometry": %s, "properties": {' %
+                           (self.layer, json.dumps(geometry)))
+        self.attributes = 0
+
+    def addattribute(self, name, value):
+        if self.attributes:
+            self.chunks.append(', ')
+        self.attributes += 1
+        self.chunks.append('%s: %s' % (json.dumps(_text(name)), _json(value)))
+
+    def __str__(self):
+        return ''.join(self.chunks + (self.open and ['}}'] or []) + [']}'])
+
+def _json(value):
+    if isinstance(value, str):
+        value = to_unicode(value)
+    elif isinstance(value, float) and (math.isinf(value) or math.isnan(value)):
+        # not allowed in JSON
+        return 'null'
+    try:
+        return json.dumps(value)
+    except TypeError:
+        return json.dumps(unicode(value))
+
+def batch_feature_info(format, points, pixels, writers):
+    """ The document answering a GetFeatureInfoBatch request, with the
+        results of each point in the order of the request.
+
+        @param points: The points queried, in map coordinates in the axis
+                       order of the request.
+        @param pixels: The pixel positions of the points, if they were
+                       requested by those.
+        @param writers: The JSONFeatureInfo or XMLFeatureInfo of each point.
+    """
+    results = []
+    for index, ((x, y), writer) in enumerate(zip(points, writers)):
+        if format == 'application/json':
+            pixel = pixels and ', "pixel": %s' % json.dumps(list(pixels[index])) or ''
+            results.append('{"point": %s%s, "layers": [%s]}' % (json.dumps([x, y]), pixel, writer.body()))
+        else:
+            pixel = pixels and ' i=%s j=%s' % tuple([quoteattr(repr(v)) for v in pixels[index]]) or ''
+            results.append('<resultset x=%s y=%s%s>%s</resultset>' % (quoteattr(repr(x)), quoteattr(repr(y)),
+                                                                      pixel, writer.body()))
+    if format == 'application/json':
+        return '{"results": [%s]}' % ', '.join(results)
+    return '<?xml version="1.0"?>\n<resultsets>%s</resultsets>' % ''.join(results)
+
+FEATURE_INFO_WRITERS = {'text/plain': TextFeatureInfo,
+                        'text/xml': XMLFeatureInfo,
+                        'application/json': JSONFeatureInfo,
+                        'application/geo+json': GeoJSONFeatureInfo}
 
 def to_unicode(obj, encoding='utf-8'):
     if isinstance(obj, basestring):
@@ -0,0 +1,317 @@
+"""Configurable mapnik image encoders for the GetMap output formats."""
+
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+try:
+    from mapnik2 import Image
+except ImportError:
+    try:
+        from mapnik import Image
+    except ImportError:
+        Image = None
+
+from ogcserver.exceptions import ServerConfigurationError
+
+# requested format -> (mapnik format, content type of the response)
+FORMATS = {'image/png': ('png', 'image/png'),
+           'image/png8': ('png256', 'image/png'),
+           'image/jpeg': ('jpeg', 'image/jpeg'),
+           'image/webp': ('webp', 'image/webp'),
+           # only used where an image/auto map cannot be inspected
+           'image/auto': ('png', 'image/png'),
+           # grids are encoded by ogcserver.utfgrid
+           'application/utfgrid': ('utf', 'application/json')}
+
+AUTO_FORMAT = 'image/auto'
+
+# number of encoded blank maps kept for sharing, one per size, format and color
+MAXBLANKS = 256
+
+QUANTIZERS = {'octree': 'o', 'hextree': 'h'}
+
+STRATEGIES = ('default', 'filtered', 'huff', 'rle')
+
+# options of which the highest value of the requested layers wins, for
+# the others the first requested layer setting them does
+QUALITY_OPTIONS = ('jpegquality', 'pngcolors', 'webpquality')
+
+def _bounded(minimum, maximum):
+    def cast(value):
+        value = int(value)
+        if not minimum <= value <= maximum:
+            raise ValueError
+        return value
+    return cast
+
+def _choice(choices):
+    def cast(value):
+        if value not in choices:
+            raise ValueError
+        return value
+    return cast
+
+OPTIONS = {'jpegquality': _bounded(0, 100),
+           'pngcolors': _bounded(2, 256),
+           'pngquantizer': _choice(QUANTIZERS),
+           'zlevel': _bounded(-1, 9),
+           'zstrategy': _choice(STRATEGIES),
+           'webpquality': _bounded(0, 100)}
+
+def _encodes(mapnikformat):
+    """ Whether the mapnik in use encodes images in mapnikformat, which
+        for webp depends on the libraries it was built with.
+    """
+    try:
+        return bool(Image(1, 1).tostring(mapnikformat))
+    except Exception:
+        return False
+
+# probed once, the mapnik of a process does not change
+WEBP = Image is not None and _encodes('webp')
+
+def content_type(format):
+    """ The content type of the responses to requests for format. """
+    return FORMATS[format][1]
+
+def sniff_content_type(content):
+    """ The content type of an encoded image/auto map. """
+    if content.startswith('\xff\xd8'):
+        return 'image/jpeg'
+    if content.startswith('RIFF') and content[8:12] == 'WEBP':
+        return 'image/webp'
+    return 'image/png'
+
+class Encoder:
+
+    def __init__(self, options=None, layeroptions=None, auto=False, autojpegcolors=4096):
+        """ Builds the mapnik format strings images are encoded with, from
+            the encoder options of the server and of the requested layers,
+            and encodes maps with them.
+
+            @param options: Encoder options of the [server] section, by
+                            option name.
+            @type options: Dict.
+
+            @param layeroptions: Encoder options of the [layer_<name>]
+                                 sections, overriding those of the server,
+                                 by layer name and option name.
+            @type layeroptions: Dict of dicts.
+
+            @param auto: Whether maps may be requested as image/auto, which
+                         encodes every map or tile in the format suiting its
+                         content best.
+            @type auto: Boolean.
+
+            @param autojpegcolors: The number of colors from which opaque
+                                   image/auto maps are taken to be
+                                   photographic and encoded as JPEG.
+            @type autojpegcolors: Integer.
+        """
+        self.options = options or {}
+        self.layeroptions = layeroptions or {}
+        self.auto = auto
+        self.webp = WEBP
+        self.autojpegcolors = autojpegcolors
+        self.lock = threading.Lock()
+        self.choices = {}
+        self.blanks = OrderedDict()
+        self.blankhits = 0
+
+    def settings(self, layernames=()):
+        """ The encoder options applying to a request for some layers. """
+        settings = dict(self.options)
+        if '__all__' in layernames:
+            layernames = sorted(self.layeroptions.keys())
+        chosen = {}
+        for name in layernames:
+            for option, value in self.layeroptions.get(name, {}).items():
+                if option not in chosen or (option in QUALITY_OPTIONS and value > chosen[option]):
+                    chosen[option] = value
+        settings.update(chosen)
+        return settings
+
+    def format(self, format, layernames=()):
+        """ The mapnik format string to encode a map for format with, as
+            in 'png256:c=64:m=h:z=9' or 'jpeg85'.
+        """
+        settings = self.settings(layernames)
+        mapnikformat = FORMATS[format][0]
+        if mapnikformat == 'jpeg':
+            if 'jpegquality' in settings:
+                mapnikformat += str(settings['jpegquality'])
+            return mapnikformat
+        if mapnikformat == 'webp':
+            if 'webpquality' in settings:
+                mapnikformat += ':quality=%d' % settings['webpquality']
+            return mapnikformat
+        options = []
+        if mapnikformat == 'png256':
+            if 'pngcolors' in settings:
+                options.append('c=%d' % settings['pngcolors'])
+            if 'pngquantizer' in settings:
+                options.append('m=%s' % QUANTIZERS[settings['pngquantizer']])
+        if 'zlevel' in settings:
+            options.append('z=%d' % settings['zlevel'])
+        if 'zstrategy' in settings:
+            options.append('s=%s' % settings['zstrategy'])
+        return ':'.join([mapnikformat] + options)
+
+    def encode(self, image, format, layernames=()):
+        """ Encode a rendered mapnik Image or image view.
+
+            Maps of a single color are only encoded once per size, format
+            and color, later ones share the content of the first.
+
+            @return: A (content type, content, blank) tuple.  blank
+                     identifies the shared content of a map of a single
+                     color, it is None for other maps.
+        """
+        auto = format == AUTO_FORMAT
+        # the first, middle and last pixels rule out most maps without
+        # copying all of their pixels, which image/auto inspects anyway
+        uniform = auto or self._corners(image)
+        if uniform:
+            raw = image.tostring()
+            pixel = raw[:4]
+            uniform = raw.count(pixel) * 4 == len(raw)
+        if auto and not uniform:
+            format, content = self.choose(image, raw, layernames)
+            self._record(format, len(content))
+            return content_type(format), content, None
+        if auto:
+            format = 'image/png8'
+        mapnikformat = self.format(format, layernames)
+        blank = None
+        if uniform:
+            blank = hashlib.sha1('%dx%d:%s:%s' % (image.width(), image.height(), mapnikformat,
+                                                  pixel.encode('hex'))).hexdigest()
+            self.lock.acquire()
+            try:
+                content = self.blanks.get(blank)
+                if content is not None:
+                    self.blankhits += 1
+            finally:
+                self.lock.release()
+            if content is None:
+                content = self.share(blank, image.tostring(mapnikformat))
+        else:
+            content = image.tostring(mapnikformat)
+        if auto:
+            self._record(format, len(content))
+        return content_type(format), content, blank
+
+    def _corners(self, image):
+        """ Whether the first, middle and last pixels of an image are of
+            the same color, or True where they cannot be read one by one.
+        """
+        width, height = image.width(), image.height()
+        try:
+            pixels = [image.view(x, y, 1, 1).tostring() for x, y in
+                      ((0, 0), (width // 2, height // 2), (width - 1, height - 1))]
+        except AttributeError:
+            # image views cannot be viewed in turn
+            return True
+        return pixels[0] == pixels[1] == pixels[2]
+
+    def share(self, blank, content):
+        """ The one copy of the content of a blank map kept by this process,
+            content itself unless another copy is already kept.
+        """
+        self.lock.acquire()
+        try:
+            shared = self.blanks.pop(blank, None)
+            if shared is None:
+                shared = content
+            self.blanks[blank] = shared
+            while len(self.blanks) > MAXBLANKS:
+                self.blanks.popitem(False)
+            return shared
+        finally:
+            self.lock.release()
+
+    def choose(self, image, raw, layernames=()):
+        """ Encode an image/auto map in every format that keeps it intact
+            enough and return the smallest encoding: 32 bit PNG always,
+            PNG8 for maps with no more colors than its palette holds, and
+            JPEG for opaque maps with many colors, which are photographic.
+
+            @param raw: The RGBA pixels of the map.
+            @type raw: String.
+
+            @return: A (format, content) tuple.
+        """
+        # every pixel is counted, a single one left out of the palette
+        # would be drawn in the wrong color
+        colors = len(set(array('I', raw)))
+        candidates = ['image/png']
+        if colors <= self.settings(layernames).get('pngcolors', 256):
+            candidates.insert(0, 'image/png8')
+        elif colors >= self.autojpegcolors and set(raw[3::4]) == set(['\xff']):
+            candidates.append('image/jpeg')
+        encoded = []
+        for format in candidates:
+            content = image.tostring(self.format(format, layernames))
+            # the first of equally small encodings, PNG8 before PNG
+            encoded.append((len(content), len(encoded), format, content))
+        size, order, format, content = min(encoded)
+        return format, content
+
+    def _record(self, format, size):
+        # power of two buckets of the encoded sizes
+        bucket = 1 << max(0, size - 1).bit_length()
+        self.lock.acquire()
+        try:
+            if format not in self.choices:
+                self.choices[format] = {'count': 0, 'bytes': 0, 'sizes': {}}
+            choice = self.choices[format]
+            choice['count'] += 1
+            choice['bytes'] += size
+            choice['sizes'][bucket] = choice['sizes'].get(bucket, 0) + 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """ The formats chosen for image/auto maps by this process, with
+            their number, total size and the distribution of their sizes
+            over power of two byte buckets, and the number of blank maps
+            that were not encoded again.
+        """
+        self.lock.acquire()
+        try:
+            return {'auto': dict([(format, {'count': choice['count'],
+                                            'bytes': choice['bytes'],
+                                            'sizes': dict(choice['sizes'])})
+                                  for format, choice in self.choices.items()]),
+                    'blanks': len(self.blanks),
+                    'blankhits': self.blankhits}
+        finally:
+            self.lock.release()
+
+def _read_options(conf, section):
+    options = {}
+    for option, cast in OPTIONS.items():
+        if conf.has_option_with_value(section, option):
+            try:
+                options[option] = cast(conf.get(section, option))
+            except ValueError:
+                raise ServerConfigurationError('Invalid value for "%s" in the [%s] section.' % (option, section))
+    return options
+
+def load_encoder(conf):
+    """ Read the encoder options of the [server] and [layer_<name>]
+        sections of ogcserver.conf.
+    """
+    layeroptions = {}
+    for section in conf.sections():
+        if section.startswith('layer_'):
+            options = _read_options(conf, section)
+            if options:
+                layeroptions[section[len('layer_'):]] = options
+    auto = conf.has_option_with_value('server', 'autoformat') and conf.getboolean('server', 'autoformat')
+    autojpegcolors = 4096
+    if conf.has_option_with_value('server', 'autojpegcolors'):
+        autojpegcolors = int(conf.get('server', 'autojpegcolors'))
+    return Encoder(_read_options(conf, 'server'), layeroptions, auto, autojpegcolors)
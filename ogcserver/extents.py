@@ -0,0 +1,160 @@
+"""Precomputed layer extents, to leave out the layers a request does not show."""
+
+import bisect
+import threading
+
+from ogcserver.common import WGS84, finite, transform_points
+
+# points along each edge of an extent transformed to another CRS
+EDGE_POINTS = 16
+
+def _singular_points(source, extent):
+    """ The longitudes and latitudes of the poles and of the points of the
+        antimeridian within an extent, each on both sides of the
+        antimeridian.  The edges of the extent do not bound where it
+        reaches around them in other projections.
+    """
+    lats = [-90.0 + 180.0 * i / EDGE_POINTS for i in range(EDGE_POINTS + 1)]
+    try:
+        xs, ys = transform_points(WGS84, source, [180.0] * len(lats), lats)
+    except Exception:
+        return []
+    minx, miny, maxx, maxy = extent
+    points = []
+    for lat, x, y in zip(lats, xs, ys):
+        if finite((x, y)) and minx < x < maxx and miny < y < maxy:
+            points.extend(((-180.0, lat), (180.0, lat)))
+            if abs(lat) == 90.0:
+                # a pole, of all longitudes
+                points.append((0.0, lat))
+    return points
+
+def transform_extent(source, target, extent):
+    """ Transform an extent between two projections through points along
+        its edges, so that curved edges are enclosed too, and through the
+        poles and the points of the antimeridian within it.
+
+        @param source: The proj4 string of the projection of extent.
+        @type source: String.
+
+        @param target: The proj4 string of the projection to transform
+                       extent to.
+        @type target: String.
+
+        @return: The enclosing (minx, miny, maxx, maxy) in the target
+                 projection, or None if the extent cannot be transformed
+                 or is unbounded there, as where it holds a pole the
+                 target projection cannot represent.
+    """
+    minx, miny, maxx, maxy = extent
+    xs, ys = [], []
+    for i in range(EDGE_POINTS + 1):
+        x = minx + (maxx - minx) * i / EDGE_POINTS
+        y = miny + (maxy - miny) * i / EDGE_POINTS
+        xs.extend((x, x, minx, maxx))
+        ys.extend((miny, maxy, y, y))
+    try:
+        xs, ys = transform_points(source, target, xs, ys)
+        xs, ys = list(xs), list(ys)
+        if source != target:
+            singular = _singular_points(source, extent)
+            if singular:
+                lons, lats = transform_points(WGS84, target, [p[0] for p in singular], [p[1] for p in singular])
+                xs.extend(lons)
+                ys.extend(lats)
+    except Exception:
+        return None
+    # nan compares false to everything, min and max would skip it
+    if not finite(xs + ys):
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+class ExtentIndex:
+
+    def __init__(self, layers, crss):
+        """ The extents of the data of some layers in each CRS served,
+            indexed by their minimum x.  The extents are only computed for
+            a CRS once a request in it needs them.
+
+            Layers whose extent is unknown or cannot be transformed to a
+            CRS are taken to cover all of it.
+
+            @param layers: The layers to index, by name.
+            @type layers: Dict of mapnik Layers.
+
+            @param crss: The CRSs served, as in 'epsg:4326'.
+            @type crss: List of strings.
+        """
+        self.layers = layers
+        self.crss = set(crss)
+        self.extents = {}
+        self.indexes = {}
+        self.sources = None
+        self.lock = threading.Lock()
+
+    def indexed(self, crs):
+        """ The extents of the indexed layers in a CRS, None for layers
+            covering all of it.
+
+            @return: A dict of (minx, miny, maxx, maxy) tuples by layer
+                     name, or None if the CRS is not served.
+        """
+        if crs not in self.crss:
+            return None
+        extents = self.extents.get(crs)
+        if extents is None:
+            self.lock.acquire()
+            try:
+                if crs not in self.extents:
+                    self._index(crs)
+                extents = self.extents[crs]
+            finally:
+                self.lock.release()
+        return extents
+
+    def _index(self, crs):
+        if self.sources is None:
+            # the datasources are only asked for their envelope once
+            self.sources = {}
+            for name, layer in self.layers.items():
+                try:
+                    env = layer.envelope()
+                    extent = (env.minx, env.miny, env.maxx, env.maxy)
+                except Exception:
+                    continue
+                if extent[0] > extent[2] or extent[1] > extent[3]:
+                    continue
+                self.sources[name] = layer.srs, extent
+        target = '+init=%s' % crs
+        extents = {}
+        for name in self.layers:
+            if name not in self.sources:
+                extents[name] = None
+                continue
+            srs, extent = self.sources[name]
+            extents[name] = transform_extent(srs, target, extent)
+        bounded = sorted([(extent[0], name) for name, extent in extents.items() if extent])
+        unbounded = set([name for name, extent in extents.items() if not extent])
+        self.indexes[crs] = ([minx for minx, name in bounded], [name for minx, name in bounded], unbounded)
+        # set last, it tells the index of the CRS is complete
+        self.extents[crs] = extents
+
+    def intersecting(self, crs, bbox):
+        """ The names of the indexed layers with data within a box.
+
+            @param crs: The CRS of bbox, as in 'epsg:4326'.
+            @type crs: String.
+
+            @return: A set of layer names, or None if the CRS is not
+                     indexed.
+        """
+        extents = self.indexed(crs)
+        if extents is None:
+            return None
+        minxs, names, unbounded = self.indexes[crs]
+        found = set(unbounded)
+        for name in names[:bisect.bisect_right(minxs, bbox[2])]:
+            extent = extents[name]
+            if extent[2] >= bbox[0] and extent[1] <= bbox[3] and extent[3] >= bbox[1]:
+                found.add(name)
+        return found
@@ -0,0 +1,40 @@
+"""Removal of the cached responses of layers whose data changed."""
+
+import sys
+from optparse import OptionParser
+
+from ogcserver.renderpool import _initworker, _worker
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] <ogcserver.conf> <map.xml>',
+                          description='Remove the cached responses of layers whose data changed, '
+                                      'or the expired responses, from the response cache.  Running '
+                                      'servers drop their copies in memory on their next use.')
+    parser.add_option('-l', '--layers', help='comma separated layers whose responses are removed')
+    parser.add_option('-c', '--crs', help='CRS of the BBOX, as in EPSG:4326')
+    parser.add_option('-b', '--bbox', help='minx,miny,maxx,maxy, only remove the responses intersecting it')
+    parser.add_option('-e', '--expired', action='store_true', default=False,
+                      help='remove the responses older than the ttl of their layers instead')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('expected the configuration file and the mapfile')
+    if not options.layers and not options.expired:
+        parser.error('choose the layers with --layers, or --expired')
+    if options.bbox and not options.crs:
+        parser.error('the CRS of the BBOX is missing, set it with --crs')
+    configpath, mapfile = args
+
+    _initworker(configpath, mapfile, None)
+    mapfactory = _worker['mapfactory']
+    if not mapfactory.cache:
+        parser.error('no response cache configured, set cachedir in the [server] section')
+
+    if options.expired:
+        removed = mapfactory.cache.gc()
+    else:
+        bbox = None
+        if options.bbox:
+            bbox = map(float, options.bbox.split(','))
+        removed = mapfactory.invalidate(options.layers.split(','), options.crs, bbox)
+    sys.stdout.write('Removed %d cached responses.\n' % removed)
+    return 0
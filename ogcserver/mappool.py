@@ -0,0 +1,82 @@
+"""Bounded, thread-safe pool of fully configured mapnik Map objects."""
+
+import threading
+from collections import OrderedDict
+
+class MapPool:
+
+    def __init__(self, maxsize=16):
+        """ A pool of idle Map objects, grouped by the key describing
+            their configuration (CRS, layers and styles, background,
+            buffer size).
+
+            A Map is removed from the pool while a request is using it,
+            so a checked out Map is never shared between threads.
+
+            @param maxsize: Maximum number of idle Maps kept across all
+                            keys.  The least recently used keys are
+                            evicted first.  0 disables pooling.
+            @type maxsize: Integer.
+        """
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.idle = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def checkout(self, key):
+        """ Return an idle Map configured for key, or None on a miss. """
+        self.lock.acquire()
+        try:
+            maps = self.idle.get(key)
+            if not maps:
+                self.misses += 1
+                return None
+            m = maps.pop()
+            if not maps:
+                del self.idle[key]
+            self.size -= 1
+            self.hits += 1
+            return m
+        finally:
+            self.lock.release()
+
+    def checkin(self, key, m):
+        """ Give a Map back to the pool once a request is done with it. """
+        if self.maxsize <= 0:
+            return
+        self.lock.acquire()
+        try:
+            # re-insert the key so it becomes the most recently used
+            maps = self.idle.pop(key, [])
+            maps.append(m)
+            self.idle[key] = maps
+            self.size += 1
+            while self.size > self.maxsize:
+                oldkey = next(iter(self.idle))
+                oldmaps = self.idle[oldkey]
+                oldmaps.pop(0)
+                if not oldmaps:
+                    del self.idle[oldkey]
+                self.size -= 1
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.idle.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'size': self.size,
+                'maxsize': self.maxsize,
+                'keys': len(self.idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
@@ -0,0 +1,254 @@
+"""Metatile rendering of GetMap requests aligned to configured tile grids."""
+
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from ogcserver.exceptions import ServerConfigurationError
+
+class TileGrid:
+
+    def __init__(self, name, crs, extent, resolutions, tilesize=256, metatile=(1, 1)):
+        """ A tile pyramid that GetMap requests can be aligned to.
+
+            @param name: Name of the grid, taken from its [grid_<name>]
+                         configuration section.
+            @type name: String.
+
+            @param crs: The CRS of the grid, as in 'epsg:900913'.
+            @type crs: String.
+
+            @param extent: minx, miny, maxx, maxy of the grid.  Tiles are
+                           counted from the lower left corner.
+            @type extent: A sequence of 4 floats.
+
+            @param resolutions: Map units per pixel of each zoom level.
+            @type resolutions: A sequence of floats.
+
+            @param metatile: Number of tiles across and down rendered
+                             together for any tile of this grid.
+            @type metatile: A (columns, rows) tuple.
+        """
+        self.name = name
+        self.crs = crs.lower()
+        self.extent = tuple(extent)
+        self.resolutions = tuple(resolutions)
+        self.tilesize = tilesize
+        self.metatile = tuple(metatile)
+
+    def match(self, crs, bbox, width, height):
+        """ Find the tile matching a request.
+
+            @return: A (zoom, column, row) tuple or None if the request is
+                     not aligned to this grid.
+        """
+        if str(crs) != self.crs or width != self.tilesize or height != self.tilesize:
+            return None
+        res = float(bbox[2] - bbox[0]) / width
+        for z, gridres in enumerate(self.resolutions):
+            if abs(res - gridres) / gridres < 1e-3:
+                break
+        else:
+            return None
+        if abs(float(bbox[3] - bbox[1]) / height - gridres) / gridres > 1e-3:
+            return None
+        span = gridres * self.tilesize
+        col = (bbox[0] - self.extent[0]) / span
+        row = (bbox[1] - self.extent[1]) / span
+        if abs(col - round(col)) > 1e-3 or abs(row - round(row)) > 1e-3:
+            return None
+        col, row = int(round(col)), int(round(row))
+        cols, rows = self.size(z)
+        if col < 0 or row < 0 or col >= cols or row >= rows:
+            return None
+        return z, col, row
+
+    def size(self, z):
+        """ Number of tile columns and rows covering the grid at zoom z. """
+        span = self.resolutions[z] * self.tilesize
+        cols = int(math.ceil((self.extent[2] - self.extent[0]) / span - 1e-6))
+        rows = int(math.ceil((self.extent[3] - self.extent[1]) / span - 1e-6))
+        return cols, rows
+
+    def tilebbox(self, z, col, row, cols=1, rows=1):
+        span = self.resolutions[z] * self.tilesize
+        minx = self.extent[0] + col * span
+        miny = self.extent[1] + row * span
+        return [minx, miny, minx + cols * span, miny + rows * span]
+
+    def metatilefor(self, z, col, row):
+        """ The metatile enclosing a tile, clipped to the grid.
+
+            @return: A (column, row, columns, rows) tuple giving the lower
+                     left tile of the metatile and its size in tiles.
+        """
+        gridcols, gridrows = self.size(z)
+        mcol = col - col % self.metatile[0]
+        mrow = row - row % self.metatile[1]
+        return (mcol, mrow,
+                min(self.metatile[0], gridcols - mcol),
+                min(self.metatile[1], gridrows - mrow))
+
+def load_grids(conf):
+    """ Read the [grid_<name>] sections of ogcserver.conf. """
+    grids = []
+    for section in conf.sections():
+        if not section.startswith('grid_'):
+            continue
+        name = section[len('grid_'):]
+        try:
+            crs = conf.get(section, 'crs')
+            extent = map(float, conf.get(section, 'bbox').split(','))
+            if len(extent) != 4:
+                raise ValueError
+            if conf.has_option_with_value(section, 'tilesize'):
+                tilesize = int(conf.get(section, 'tilesize'))
+            else:
+                tilesize = 256
+            if conf.has_option_with_value(section, 'resolutions'):
+                resolutions = map(float, conf.get(section, 'resolutions').split(','))
+            else:
+                levels = int(conf.get(section, 'levels'))
+                maxres = max(extent[2] - extent[0], extent[3] - extent[1]) / tilesize
+                resolutions = [maxres / 2 ** z for z in range(levels)]
+            if conf.has_option_with_value(section, 'metatile'):
+                metatile = tuple(map(int, conf.get(section, 'metatile').split(',')))
+                if len(metatile) == 1:
+                    metatile = metatile * 2
+            else:
+                metatile = (1, 1)
+        except Exception:
+            raise ServerConfigurationError('Tile grid [%s] is not properly configured.' % section)
+        grids.append(TileGrid(name, crs, extent, resolutions, tilesize, metatile))
+    return grids
+
+class MetaTiler:
+
+    def __init__(self, grids, maxtiles=1024):
+        """ Renders requests that match a tile grid as a whole metatile and
+            keeps the encoded sibling tiles until they are requested, their
+            layers' ttl passes or they are invalidated by any process.
+
+            @param maxtiles: Number of encoded tiles kept in memory.  The
+                             least recently used ones are dropped first.
+            @type maxtiles: Integer.
+        """
+        self.grids = grids
+        self.maxtiles = maxtiles
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.renders = 0
+
+    def match(self, params):
+        """ @return: A (grid, zoom, column, row) tuple or None. """
+        for grid in self.grids:
+            tile = grid.match(params['crs'], params['bbox'], params['width'], params['height'])
+            if tile:
+                return (grid,) + tile
+        return None
+
+    def tilekey(self, handler, params, match, col=None, row=None):
+        """ The request key of a tile, identifying it by its address in
+            the grid rather than its BBOX.
+        """
+        grid, z = match[:2]
+        if col is None:
+            col, row = match[2:]
+        return handler._requestKey(params, (grid.name, z, col, row))
+
+    def gettile(self, handler, params, match, refresh=False):
+        """ Return the tile matched by a request, rendering its metatile
+            if the tile is not in the store.  Every tile of a rendered
+            metatile is also written to the response cache, if any.
+
+            @param refresh: Render the metatile even if the tile is in the
+                            store, to replace stale tiles.
+            @type refresh: Boolean.
+        """
+        grid, z, col, row = match
+        if not refresh:
+            response = self._get(self.tilekey(handler, params, match), handler.mapfactory)
+            if response:
+                return response
+        mcol, mrow, cols, rows = grid.metatilefor(z, col, row)
+        metaparams = dict(params)
+        bbox = grid.tilebbox(z, mcol, mrow, cols, rows)
+        if handler._reversedAxes(params):
+            # in the axis order of the request, as the handler renders it
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+        metaparams['bbox'] = bbox
+        metaparams['width'] = cols * grid.tilesize
+        metaparams['height'] = rows * grid.tilesize
+        # requests for different tiles of the same metatile render it once
+        metakey = handler._requestKey(metaparams, (grid.name, z, mcol, mrow, cols, rows))
+        if handler.mapfactory.singleflight:
+            tiles = handler.mapfactory.singleflight.do(metakey, self._render, handler, params, match, metaparams)
+        else:
+            tiles = self._render(handler, params, match, metaparams)
+        return tiles[(col - mcol, row - mrow)]
+
+    def _render(self, handler, params, match, metaparams):
+        """ Render the metatile of a tile and store all of its tiles.  Of
+            coalesced requests only the one rendering gets here.
+        """
+        grid, z, col, row = match
+        mcol, mrow, cols, rows = grid.metatilefor(z, col, row)
+        tiles = handler._dispatch('_renderMetaTile', metaparams, grid.tilesize, cols, rows)
+        self.lock.acquire()
+        self.renders += 1
+        self.lock.release()
+        ttl = handler.mapfactory._ttl(params['layers'])
+        items = []
+        for (dx, dy), tile in tiles.items():
+            key = self.tilekey(handler, params, match, mcol + dx, mrow + dy)
+            self._put(key, tile, ttl)
+            items.append((key, tile))
+        if handler.mapfactory.cache:
+            handler.mapfactory.cache.putmany(items)
+        return tiles
+
+    def _get(self, key, mapfactory):
+        # tiles invalidated by other processes are only known from the
+        # stamp of the shared cache
+        invalidated = mapfactory.cache and mapfactory.cache.invalidated() or 0
+        self.lock.acquire()
+        try:
+            entry = self.tiles.pop(key, None)
+            if not entry:
+                return None
+            response, stored, expires = entry
+            if stored < invalidated or (expires and expires < time.time()):
+                return None
+            self.tiles[key] = entry
+            self.hits += 1
+            return response
+        finally:
+            self.lock.release()
+
+    def _put(self, key, response, ttl=None):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.tiles.pop(key, None)
+            self.tiles[key] = (response, now, ttl and now + ttl or 0)
+            while len(self.tiles) > self.maxtiles:
+                self.tiles.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, selection):
+        """ Drop the stored tiles selected by an Invalidation. """
+        self.lock.acquire()
+        try:
+            for key in [key for key in self.tiles if selection.matches(key)]:
+                del self.tiles[key]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'tiles': len(self.tiles),
+                'maxtiles': self.maxtiles,
+                'hits': self.hits,
+                'renders': self.renders}
@@ -3,10 +3,13 @@
 import sys
 from mod_python import apache, util
 
-from ogcserver.common import Version
+from ogcserver.cache import query_key
+from ogcserver.common import Version, CONDITIONAL_REQUESTS, cache_control, conditional_headers, entity_tag, http_date, \
+                             not_modified, variant_tag
 from ogcserver.configparser import SafeConfigParser
 from ogcserver.wms111 import ExceptionHandler as ExceptionHandler111
 from ogcserver.wms130 import ExceptionHandler as ExceptionHandler130
+from ogcserver.WMTS import RESTPREFIXES, dispatch_path, path_request
 from ogcserver.exceptions import OGCException, ServerConfigurationError
 
 
@@ -25,69 +28,115 @@ class ModHandler(object):
             self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')()
         else:
             raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
+        self.mapfactory.configure(conf)
+        self.mapfactory.prepare_capabilities(conf)
         if conf.has_option('server', 'debug'):
             self.debug = int(conf.get('server', 'debug'))
         else:
             self.debug = 0
         if self.conf.has_option_with_value('server', 'maxage'):
-            self.max_age = 'max-age=%d' % self.conf.get('server', 'maxage')
+            self.max_age = 'max-age=%d' % int(self.conf.get('server', 'maxage'))
         else:
             self.max_age = None
 
     def __call__(self, apacheReq):
+        etag = None
         try:
             reqparams = util.FieldStorage(apacheReq,keep_blank_values=1)
-            if not reqparams:
+            path = apacheReq.path_info or ''
+            lowered = lowerparams(reqparams)
+            conditional = path.startswith(RESTPREFIXES) or lowered.get('request') in CONDITIONAL_REQUESTS
+            request = path.startswith(RESTPREFIXES) and path_request(path) or lowered.get('request')
+            if path.startswith(RESTPREFIXES):
+                port = apacheReq.connection.local_addr[1]
+                resturl = 'http://%s:%s%s' % (apacheReq.hostname, port, apacheReq.subprocess_env['SCRIPT_NAME'])
+                response = dispatch_path(self.conf, self.mapfactory, resturl, apacheReq.path_info, headers(apacheReq))
+                apacheReq.content_type = response.content_type
+                apacheReq.status = apache.HTTP_OK
+            elif not reqparams:
                 eh = ExceptionHandler130(self.debug)
                 response = eh.getresponse(reqparams)
                 apacheReq.content_type = response.content_type
             else:
-                reqparams = lowerparams(reqparams)
-                port = apacheReq.connection.local_addr[1]
-                onlineresource = 'http://%s:%s%s?' % (apacheReq.hostname, port, apacheReq.subprocess_env['SCRIPT_NAME'])             
-                if not reqparams.has_key('request'):
-                    raise OGCException('Missing Request parameter.')
-                request = reqparams['request']
-                del reqparams['request']
-                if request == 'GetCapabilities' and not reqparams.has_key('service'):
-                    raise OGCException('Missing service parameter.')
-                if request in ['GetMap', 'GetFeatureInfo']:
-                    service = 'WMS'
-                else:
-                    service = reqparams['service']
-                if reqparams.has_key('service'):
-                    del reqparams['service']
-                try:
-                    ogcserver = __import__('ogcserver.' + service)
-                except:
-                    raise OGCException('Unsupported service "%s".' % service)
-                ServiceHandlerFactory = getattr(ogcserver, service).ServiceHandlerFactory
-                servicehandler = ServiceHandlerFactory(self.conf, self.mapfactory, onlineresource, reqparams.get('version', None))
-                if reqparams.has_key('version'):
-                    del reqparams['version']
-                if request not in servicehandler.SERVICE_PARAMS.keys():
-                    raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
-        
-                # Get parameters and pass to WMSFactory in custom "setup" method
-                ogcparams = servicehandler.processParameters(request, reqparams)
-                try:
-                    requesthandler = getattr(servicehandler, request)
-                except:
-                    raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
-                
-                response = requesthandler(ogcparams)
+                reqparams = lowered
+                memkey = None
+                response = None
+                if self.mapfactory.memcache and reqparams.get('request') in ('GetMap', 'GetFeatureInfo', 'GetFeatureInfoBatch', 'GetTile'):
+                    memkey = query_key(reqparams, apacheReq.headers_in.get('User-Agent', ''))
+                    response = self.mapfactory.memcache.get(memkey)
+                if not response:
+                    response = self.dispatch(apacheReq, reqparams)
+                    if memkey and not response.notmodified:
+                        self.mapfactory.memcache.put(memkey, response)
                 apacheReq.content_type = response.content_type
                 apacheReq.status = apache.HTTP_OK
         except Exception, E:
             return self.traceback(apacheReq,E)
 
-        if self.max_age:
-            apacheReq.headers_out.add('Cache-Control', max_age)
-        apacheReq.headers_out.add('Content-Length', str(len(response.content)))
+        compressor = self.mapfactory.compressor
+        encoding = compressor.encoding(response, apacheReq.headers_in.get('Accept-Encoding'))
+        # the headers a 304 Not Modified response repeats
+        cachecontrol = cache_control(self.max_age, self.mapfactory, request, response)
+        if cachecontrol:
+            apacheReq.headers_out.add('Cache-Control', cachecontrol)
+        if compressor.compressible(response.content_type):
+            apacheReq.headers_out.add('Vary', 'Accept-Encoding')
+        if conditional and response.conditional:
+            etag = entity_tag(response)
+            apacheReq.headers_out.add('ETag', response.variant or variant_tag(etag, encoding))
+            if response.modified is not None:
+                apacheReq.headers_out.add('Last-Modified', http_date(response.modified))
+            # maps are revalidated before rendering them, other responses
+            # once they are known
+            if response.notmodified or not_modified(etag, apacheReq.headers_in.get('If-None-Match'), response.modified,
+                                                    apacheReq.headers_in.get('If-Modified-Since')):
+                return apache.HTTP_NOT_MODIFIED
+        content, encoding = compressor.compress(response, apacheReq.headers_in.get('Accept-Encoding'))
+        if encoding:
+            apacheReq.headers_out.add('Content-Encoding', encoding)
+        apacheReq.headers_out.add('Content-Length', str(len(content)))
         apacheReq.send_http_header()
-        apacheReq.write(response.content)
+        apacheReq.write(content)
         return apache.OK
 
+    def dispatch(self, apacheReq, reqparams):
+        port = apacheReq.connection.local_addr[1]
+        onlineresource = 'http://%s:%s%s?' % (apacheReq.hostname, port, apacheReq.subprocess_env['SCRIPT_NAME'])             
+        if not reqparams.has_key('request'):
+            raise OGCException('Missing Request parameter.')
+        request = reqparams['request']
+        del reqparams['request']
+        if request == 'GetCapabilities' and not reqparams.has_key('service'):
+            raise OGCException('Missing service parameter.')
+        if request in ['GetMap', 'GetFeatureInfo', 'GetFeatureInfoBatch']:
+            service = 'WMS'
+        else:
+            service = reqparams['service']
+        if reqparams.has_key('service'):
+            del reqparams['service']
+        try:
+            ogcserver = __import__('ogcserver.' + service)
+        except:
+            raise OGCException('Unsupported service "%s".' % service)
+        ServiceHandlerFactory = getattr(ogcserver, service).ServiceHandlerFactory
+        servicehandler = ServiceHandlerFactory(self.conf, self.mapfactory, onlineresource, reqparams.get('version', None))
+        if reqparams.has_key('version'):
+            del reqparams['version']
+        if request not in servicehandler.SERVICE_PARAMS.keys():
+            raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
+
+        # Get parameters and pass to WMSFactory in custom "setup" method
+        ogcparams = servicehandler.processParameters(request, reqparams)
+        try:
+            requesthandler = getattr(servicehandler, request)
+        except:
+            raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
+
+        # the validators of the client's copy, for maps to be revalidated
+        # without rendering them
+        ogcparams.update(headers(apacheReq))
+        return requesthandler(ogcparams)
+
     def traceback(self, apacheReq,E):
         reqparams = lowerparams(util.FieldStorage(apacheReq))
         version = reqparams.get('version', None)
@@ -106,6 +155,11 @@ class ModHandler(object):
         apacheReq.write(response.content)
         return apache.OK
 
+def headers(apacheReq):
+    """ The conditional headers of a request, named as in CGI environs. """
+    return conditional_headers({'HTTP_IF_NONE_MATCH': apacheReq.headers_in.get('If-None-Match'),
+                                'HTTP_IF_MODIFIED_SINCE': apacheReq.headers_in.get('If-Modified-Since')})
+
 def lowerparams(params):
     reqparams = {}
     for key, value in params.items():
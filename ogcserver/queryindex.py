@@ -0,0 +1,461 @@
+"""Packed R-trees over the features of shapefile layers, answering
+GetFeatureInfo point queries without scanning the datasource."""
+
+import os
+import re
+import sys
+import json
+import math
+import struct
+import threading
+from array import array
+
+from ogcserver.common import hit_test
+from ogcserver.exceptions import ServerConfigurationError
+
+# entries per node of the trees
+NODESIZE = 16
+
+# first line of the sidecar files the trees of shapefiles are kept in
+SIDECAR_MAGIC = 'ogcserver-queryindex 2\n'
+
+# .shp shape types by their XY layout, the Z and M variants only add to it
+POINT_TYPES = (1, 11, 21)
+MULTIPOINT_TYPES = (8, 18, 28)
+POLYLINE_TYPES = (3, 13, 23)
+POLYGON_TYPES = (5, 15, 25)
+
+class STRTree:
+
+    def __init__(self, ids, minxs, minys, maxxs, maxys, packed=False, nodesize=NODESIZE):
+        """ A static R-tree packed with the Sort-Tile-Recursive algorithm,
+            kept in flat arrays: the bounding boxes of every level and the
+            ids of the leaves.
+
+            @param ids: The ids of the boxes.
+            @type ids: array('l').
+
+            @param minxs, minys, maxxs, maxys: The boxes.
+            @type minxs, minys, maxxs, maxys: array('d').
+
+            @param packed: Whether the boxes are in packing order already,
+                           as they are in self.ids and self.levels[0].
+            @type packed: Boolean.
+        """
+        self.nodesize = nodesize
+        if not packed:
+            order = self._order(minxs, minys, maxxs, maxys)
+            ids = array('l', [ids[i] for i in order])
+            minxs, minys, maxxs, maxys = [array('d', [values[i] for i in order])
+                                          for values in (minxs, minys, maxxs, maxys)]
+        self.ids = ids
+        # levels[0] are the boxes themselves, every next level the bounds of
+        # nodesize consecutive boxes of the one below
+        self.levels = [(minxs, minys, maxxs, maxys)]
+        while len(self.levels[-1][0]) > nodesize:
+            below = self.levels[-1]
+            level = (array('d'), array('d'), array('d'), array('d'))
+            for start in range(0, len(below[0]), nodesize):
+                end = start + nodesize
+                level[0].append(min(below[0][start:end]))
+                level[1].append(min(below[1][start:end]))
+                level[2].append(max(below[2][start:end]))
+                level[3].append(max(below[3][start:end]))
+            self.levels.append(level)
+
+    def _order(self, minxs, minys, maxxs, maxys):
+        # sorted by x into vertical slices of about sqrt(nodes) nodes each,
+        # and by y within each slice
+        count = len(minxs)
+        nodes = int(math.ceil(float(count) / self.nodesize))
+        slicesize = self.nodesize * int(math.ceil(math.sqrt(nodes) or 1))
+        order = sorted(range(count), key=lambda i: minxs[i] + maxxs[i])
+        packed = []
+        for start in range(0, count, slicesize):
+            packed.extend(sorted(order[start:start + slicesize], key=lambda i: minys[i] + maxys[i]))
+        return packed
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, minx, miny, maxx, maxy):
+        """ The ids of the boxes intersecting a box. """
+        nodes = range(len(self.levels[-1][0]))
+        for depth in range(len(self.levels) - 1, -1, -1):
+            minxs, minys, maxxs, maxys = self.levels[depth]
+            hits = [i for i in nodes
+                    if minxs[i] <= maxx and maxxs[i] >= minx and minys[i] <= maxy and maxys[i] >= miny]
+            if not depth:
+                return [self.ids[i] for i in hits]
+            nodes = []
+            count = len(self.levels[depth - 1][0])
+            for i in hits:
+                nodes.extend(range(i * self.nodesize, min((i + 1) * self.nodesize, count)))
+        return []
+
+# the arrays of the sidecar files are little endian, of 4 byte ints and
+# 8 byte doubles, whatever the platform writing or reading them
+def _tofile(values, sidecar):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(sidecar)
+
+def _fromfile(typecode, sidecar, count):
+    values = array(typecode)
+    values.fromfile(sidecar, count)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+class ShapefileIndex:
+
+    def __init__(self, path, encoding='utf-8', sidecar=True):
+        """ An STRTree over the records of a shapefile, whose attributes
+            and geometries are only read for the records a query hits.
+
+            The tree is read from a sidecar file next to the shapefile,
+            <path>.ogcindex, when that was written for the .shp and .shx
+            files of the same size and modification time.  Otherwise it is
+            built from the shapefile and written to the sidecar where
+            possible.
+
+            @param path: The path of the shapefile, with or without the
+                         .shp extension.
+            @type path: String.
+
+            @param encoding: The encoding of the text attributes.
+            @type encoding: String.
+
+            @param sidecar: Whether to read and write the sidecar file.
+            @type sidecar: Boolean.
+        """
+        self.root = re.sub('\.shp$', '', path)
+        self.encoding = encoding
+        self.fields = self._fields()
+        self.tree = sidecar and self._read() or None
+        if self.tree is None:
+            self.tree = self._build()
+            if sidecar:
+                self._write()
+
+    def query(self, x, y, tolerance, count=None):
+        """ The records hit by a query at a point, in the coordinates of the
+            shapefile: points and lines within tolerance of it, polygons
+            containing it.
+
+            @return: A list of up to count IndexedFeatures.
+        """
+        features = []
+        ids = self.tree.search(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+        if not ids:
+            return features
+        shx, shp, dbf = [open(self.root + extension, 'rb') for extension in ('.shx', '.shp', '.dbf')]
+        try:
+            for record in sorted(ids):
+                geometry = self._geometry(shx, shp, record)
+                if geometry and hit_test(geometry, x, y, tolerance):
+                    features.append(IndexedFeature(record, self._attributes(dbf, record), geometry))
+                    if len(features) == count:
+                        break
+        finally:
+            shx.close()
+            shp.close()
+            dbf.close()
+        return features
+
+    def _sidecar(self):
+        return self.root + '.ogcindex'
+
+    def _stamp(self):
+        """ The sizes and modification times of the .shp and .shx files,
+            which the sidecar is only valid for.  Those of a copied or
+            restored shapefile can be older than its sidecar.
+        """
+        stamp = []
+        for extension in ('.shp', '.shx'):
+            st = os.stat(self.root + extension)
+            stamp.append('%d %r' % (st.st_size, st.st_mtime))
+        return ' '.join(stamp) + '\n'
+
+    def _read(self):
+        try:
+            stamp = self._stamp()
+            sidecar = open(self._sidecar(), 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            if sidecar.readline() != SIDECAR_MAGIC or sidecar.readline() != stamp:
+                return None
+            count = int(sidecar.readline())
+            ids = _fromfile('i', sidecar, count)
+            boxes = [_fromfile('d', sidecar, count) for i in range(4)]
+        except (ValueError, EOFError):
+            return None
+        finally:
+            sidecar.close()
+        return STRTree(ids, *boxes, packed=True)
+
+    def _write(self):
+        # written under another name first, so that no reader sees half of it
+        temporary = '%s.%d' % (self._sidecar(), os.getpid())
+        try:
+            sidecar = open(temporary, 'wb')
+            try:
+                sidecar.write(SIDECAR_MAGIC)
+                sidecar.write(self._stamp())
+                sidecar.write('%d\n' % len(self.tree))
+                _tofile(array('i', self.tree.ids), sidecar)
+                for values in self.tree.levels[0]:
+                    _tofile(values, sidecar)
+            finally:
+                sidecar.close()
+            os.rename(temporary, self._sidecar())
+        except (IOError, OSError):
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+    def _build(self):
+        ids = array('l')
+        boxes = (array('d'), array('d'), array('d'), array('d'))
+        shx = open(self.root + '.shx', 'rb')
+        shp = open(self.root + '.shp', 'rb')
+        try:
+            shx.seek(100)
+            offsets = shx.read()
+            for record in range(1, len(offsets) // 8 + 1):
+                offset = struct.unpack('>i', offsets[(record - 1) * 8:(record - 1) * 8 + 4])[0] * 2
+                shp.seek(offset + 8)
+                content = shp.read(36)
+                shapetype = struct.unpack('<i', content[:4])[0]
+                if shapetype in POINT_TYPES:
+                    x, y = struct.unpack('<2d', content[4:20])
+                    box = (x, y, x, y)
+                elif shapetype in MULTIPOINT_TYPES + POLYLINE_TYPES + POLYGON_TYPES:
+                    box = struct.unpack('<4d', content[4:36])
+                else:
+                    # null shapes
+                    continue
+                ids.append(record)
+                for values, value in zip(boxes, box):
+                    values.append(value)
+        finally:
+            shx.close()
+            shp.close()
+        return STRTree(ids, *boxes)
+
+    def _geometry(self, shx, shp, record):
+        """ The geometry of a record as a GeoJSON geometry object. """
+        shx.seek(100 + (record - 1) * 8)
+        offset, length = struct.unpack('>2i', shx.read(8))
+        shp.seek(offset * 2 + 8)
+        content = shp.read(length * 2)
+        shapetype = struct.unpack('<i', content[:4])[0]
+        if shapetype in POINT_TYPES:
+            return {'type': 'Point', 'coordinates': list(struct.unpack('<2d', content[4:20]))}
+        if shapetype in MULTIPOINT_TYPES:
+            count = struct.unpack('<i', content[36:40])[0]
+            values = struct.unpack('<%dd' % (count * 2), content[40:40 + count * 16])
+            return {'type': 'MultiPoint', 'coordinates': [list(values[i:i + 2]) for i in range(0, len(values), 2)]}
+        if shapetype in POLYLINE_TYPES + POLYGON_TYPES:
+            partcount, pointcount = struct.unpack('<2i', content[36:44])
+            starts = struct.unpack('<%di' % partcount, content[44:44 + partcount * 4])
+            begin = 44 + partcount * 4
+            values = struct.unpack('<%dd' % (pointcount * 2), content[begin:begin + pointcount * 16])
+            points = [list(values[i:i + 2]) for i in range(0, len(values), 2)]
+            parts = [points[start:end] for start, end in zip(starts, starts[1:] + (pointcount,))]
+            if shapetype in POLYLINE_TYPES:
+                return {'type': 'MultiLineString', 'coordinates': parts}
+            # outer rings run clockwise and start a polygon, holes run
+            # counterclockwise and belong to the polygon before them
+            polygons = []
+            for ring in parts:
+                if not polygons or _area(ring) < 0:
+                    polygons.append([ring])
+                else:
+                    polygons[-1].append(ring)
+            if len(polygons) == 1:
+                return {'type': 'Polygon', 'coordinates': polygons[0]}
+            return {'type': 'MultiPolygon', 'coordinates': polygons}
+        return None
+
+    def _fields(self):
+        """ The (name, type, offset, length, decimals) of the fields of the
+            .dbf file, and the size of its header and records.
+        """
+        dbf = open(self.root + '.dbf', 'rb')
+        try:
+            header = dbf.read(32)
+            self.headersize, self.recordsize = struct.unpack('<2H', header[8:12])
+            fields = []
+            offset = 1
+            while True:
+                descriptor = dbf.read(32)
+                if not descriptor or descriptor[0] == '\r':
+                    break
+                name = descriptor[:11].split('\0')[0].decode(self.encoding, 'replace')
+                length, decimals = ord(descriptor[16]), ord(descriptor[17])
+                fields.append((name, descriptor[11], offset, length, decimals))
+                offset += length
+            return fields
+        finally:
+            dbf.close()
+
+    def _attributes(self, dbf, record):
+        dbf.seek(self.headersize + (record - 1) * self.recordsize)
+        record = dbf.read(self.recordsize)
+        attributes = []
+        for name, fieldtype, offset, length, decimals in self.fields:
+            value = record[offset:offset + length].strip()
+            if fieldtype in 'NF':
+                try:
+                    if fieldtype == 'N' and not decimals:
+                        value = int(value)
+                    else:
+                        value = float(value)
+                except ValueError:
+                    value = None
+            elif fieldtype == 'L':
+                value = value in ('T', 't', 'Y', 'y')
+            else:
+                value = value.decode(self.encoding, 'replace')
+            attributes.append((name, value))
+        return attributes
+
+def _area(ring):
+    # the signed area of a ring, negative for clockwise ones
+    return sum([x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1])]) / 2.0
+
+class _Geometry:
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+
+    def to_geojson(self):
+        return json.dumps(self.geometry)
+
+class IndexedFeature:
+
+    def __init__(self, record, attributes, geometry):
+        """ A record of an indexed shapefile, offering the parts of the
+            mapnik Feature API that GetFeatureInfo uses.
+
+            @param attributes: The (name, value) attributes of the record.
+            @type attributes: List of tuples.
+
+            @param geometry: A GeoJSON geometry object.
+            @type geometry: Dict.
+        """
+        self.record = record
+        self.properties = attributes
+        self.geometry = _Geometry(geometry)
+
+    def id(self):
+        return self.record
+
+    def __iter__(self):
+        return iter(self.properties)
+
+    def geometries(self):
+        return [self.geometry]
+
+def shapefile_path(layer):
+    """ The path of the shapefile of a layer, or None if its datasource is
+        not a shapefile.
+    """
+    try:
+        params = layer.datasource.params()
+        if params['type'] != 'shape':
+            return None
+        path = params['file']
+    except Exception:
+        return None
+    try:
+        path = os.path.join(params['base'], path)
+    except Exception:
+        pass
+    return path
+
+def _encoding(layer):
+    try:
+        return layer.datasource.params()['encoding']
+    except Exception:
+        return 'utf-8'
+
+class QueryIndexes:
+
+    def __init__(self, paths):
+        """ The ShapefileIndexes of the layers queried through one, each
+            read or built when a query first needs it.
+
+            @param paths: The shapefile and encoding of each indexed layer.
+            @type paths: Dict of (path, encoding) tuples by layer name.
+        """
+        self.paths = paths
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def get(self, name, default=None):
+        """ The ShapefileIndex of a layer, or default if it has none or
+            its index could not be built.
+        """
+        if name not in self.paths:
+            return default
+        index = self.indexes.get(name)
+        if index is None:
+            # one thread builds it, the others wait for it
+            self.lock.acquire()
+            try:
+                if name not in self.indexes:
+                    path, encoding = self.paths[name]
+                    try:
+                        self.indexes[name] = ShapefileIndex(path, encoding)
+                    except (IOError, OSError, struct.error), e:
+                        sys.stderr.write('Warning: the query index of layer "%s" could not be built: %s\n' % (name, e))
+                        self.indexes[name] = False
+                index = self.indexes[name]
+            finally:
+                self.lock.release()
+        return index or default
+
+    def reset(self, name):
+        """ Read or build the index of a layer again on its next query,
+            after its shapefile changed.
+        """
+        self.lock.acquire()
+        try:
+            self.indexes.pop(name, None)
+        finally:
+            self.lock.release()
+
+def load_query_indexes(conf, layers, names=None):
+    """ Find the layers whose [layer_<name>] section has queryindex on.
+
+        @param layers: The layers of the factory, by name.
+        @type layers: Dict of mapnik Layers.
+
+        @param names: Only index these layers.
+        @type names: Sequence of strings.
+
+        @return: A QueryIndexes, which reads or builds the index of each
+                 layer on first use.
+    """
+    paths = {}
+    for section in conf.sections():
+        if not section.startswith('layer_'):
+            continue
+        name = section[len('layer_'):]
+        if not conf.has_option_with_value(section, 'queryindex') or not conf.getboolean(section, 'queryindex'):
+            continue
+        if name not in layers or (names is not None and name not in names):
+            continue
+        path = shapefile_path(layers[name])
+        if not path:
+            raise ServerConfigurationError('The queryindex of [%s] needs a shapefile layer.' % section)
+        paths[name] = path, _encoding(layers[name])
+    return QueryIndexes(paths)
@@ -0,0 +1,152 @@
+"""Pool of worker processes rendering and encoding maps for the WSGI server."""
+
+import sys
+import threading
+import multiprocessing
+
+from ogcserver.exceptions import OGCException
+
+# state of a worker process, set up once by _initworker
+_worker = {}
+
+def _initworker(configpath, mapfile, fonts):
+    """ Load the same map factory as the front-end process. """
+    from ogcserver.wsgi import do_import
+    from ogcserver.WMS import BaseWMSFactory
+    from ogcserver.configparser import SafeConfigParser
+    try:
+        import mapnik2 as mapnik
+    except ImportError:
+        import mapnik
+
+    conf = SafeConfigParser()
+    conf.readfp(open(configpath))
+    if fonts:
+        mapnik.register_fonts(fonts)
+    if mapfile:
+        mapfactory = BaseWMSFactory(configpath)
+        mapfactory.loadXML(mapfile)
+        mapfactory.finalize()
+    else:
+        mapfactory = getattr(do_import(conf.get('server', 'module')), 'WMSFactory')()
+    mapfactory.configure(conf)
+    _worker['conf'] = conf
+    _worker['mapfactory'] = mapfactory
+
+def _run(modulename, classname, onlineresource, methodname, args):
+    """ Call a method of a service handler built in the worker process. """
+    __import__(modulename)
+    handlerclass = getattr(sys.modules[modulename], classname)
+    handler = handlerclass(_worker['conf'], _worker['mapfactory'], onlineresource)
+    return getattr(handler, methodname)(*args)
+
+class RenderPool:
+
+    def __init__(self, configpath, mapfile=None, fonts=None, processes=None,
+                 queuesize=None, maxrequests=None, timeout=60):
+        """ Dispatches the rendering and encoding of maps to worker
+            processes, each loading the map factory from the same mapfile
+            and configuration as the front-end.
+
+            @param processes: Number of worker processes.  Defaults to the
+                              number of CPUs.
+            @type processes: Integer.
+
+            @param queuesize: Maximum number of requests rendering or
+                              waiting for a worker.  Requests beyond that are
+                              refused.  Defaults to 4 per process.
+            @type queuesize: Integer.
+
+            @param maxrequests: Number of requests a worker serves before it
+                                is replaced by a fresh process, to cap memory
+                                growth.  None keeps workers forever.
+            @type maxrequests: Integer.
+
+            @param timeout: Seconds to wait for a worker to return a map.
+            @type timeout: Integer.
+        """
+        self.initargs = (configpath, mapfile, fonts)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.queuesize = queuesize or 4 * self.processes
+        self.maxrequests = maxrequests
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(self.queuesize)
+        self.lock = threading.Lock()
+        self.pool = None
+        # the thread building the capabilities documents, if any
+        self.warmup = None
+        self.requests = 0
+        self.refused = 0
+
+    def apply(self, handler, methodname, args):
+        """ Call methodname(*args) on a copy of handler in a worker process
+            and return its result.
+        """
+        if not self.slots.acquire(False):
+            self.lock.acquire()
+            self.refused += 1
+            self.lock.release()
+            raise OGCException('Server is too busy to render the map, try again later.')
+        pending = None
+        try:
+            self.lock.acquire()
+            self.requests += 1
+            self.lock.release()
+            result = self._getpool().apply_async(_run,
+                (handler.__module__, handler.__class__.__name__,
+                 handler.opsonlineresource, methodname, args))
+            try:
+                return result.get(self.timeout)
+            except multiprocessing.TimeoutError:
+                pending = result
+                raise OGCException('Rendering the map took too long.')
+        finally:
+            if pending:
+                # the worker is still busy with the map, its slot stays
+                # taken until the map is done
+                thread = threading.Thread(target=self._release, args=(pending,))
+                thread.setDaemon(True)
+                thread.start()
+            else:
+                self.slots.release()
+
+    def _release(self, result):
+        result.wait()
+        self.slots.release()
+
+    def _getpool(self):
+        # started on first use so that no process is forked before the
+        # WSGI container is done forking its own
+        self.lock.acquire()
+        try:
+            if not self.pool:
+                if self.warmup:
+                    # the workers are forked from this process, a lock the
+                    # build holds at that moment, such as the one of the
+                    # shared projections, would stay held in them for good
+                    self.warmup.join()
+                self.pool = multiprocessing.Pool(self.processes, _initworker,
+                                                 self.initargs, self.maxrequests)
+            return self.pool
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'processes': self.processes,
+                    'queuesize': self.queuesize,
+                    'requests': self.requests,
+                    'refused': self.refused}
+        finally:
+            self.lock.release()
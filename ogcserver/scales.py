@@ -0,0 +1,153 @@
+"""Precomputed scale ranges of layers and style rules, to leave out what a
+request is too large or too small scale to show."""
+
+import math
+import bisect
+import threading
+
+from ogcserver.common import get_projection
+
+# meters per degree at the equator, as used by mapnik for geographic maps
+METERS_PER_DEGREE = 6378137 * 2 * math.pi / 360
+
+# the pixel size mapnik assumes for scale denominators, 0.28 mm
+PIXEL_SIZE = 0.00028
+
+# style attributes that trimmed copies of a style keep, where supported
+STYLE_ATTRIBUTES = ('filter_mode', 'opacity', 'comp_op', 'image_filters', 'image_filters_inflate')
+
+def _widened(minscale, maxscale):
+    # mapnik allows 1e-6 around the limits, a little more here covers the
+    # rounding differences between its scale and ours
+    return (minscale - 1e-6 - abs(minscale) * 1e-9,
+            maxscale + 1e-6 + abs(maxscale) * 1e-9)
+
+class Intervals:
+
+    def __init__(self, ranges):
+        """ Splits the scale axis at the limits of some scale ranges, into
+            intervals within which the same ranges are active.
+
+            @param ranges: (minimum, maximum) scale denominators, a range is
+                           active from its minimum up to, not including,
+                           its maximum.
+            @type ranges: List of tuples.
+        """
+        self.bounds = sorted(set([bound for scalerange in ranges for bound in scalerange]))
+        self.active = []
+        # interval i spans bounds[i - 1] to bounds[i], the first and last
+        # are open ended
+        for i in range(len(self.bounds) + 1):
+            low, high = float('-inf'), float('inf')
+            if i > 0:
+                low = self.bounds[i - 1]
+            if i < len(self.bounds):
+                high = self.bounds[i]
+            self.active.append(tuple([index for index, (minimum, maximum) in enumerate(ranges)
+                                      if minimum <= low and high <= maximum]))
+
+    def find(self, scale):
+        """ @return: The index of the interval containing scale and the
+                     indexes of the ranges active within it.
+        """
+        i = bisect.bisect_right(self.bounds, scale)
+        return i, self.active[i]
+
+class ScaleIndex:
+
+    def __init__(self, layers, styles):
+        """ The scale ranges within which layers and the rules of styles
+            are drawn.
+
+            @param layers: The layers to index, by name.
+            @type layers: Dict of mapnik Layers.
+
+            @param styles: The styles to index, by name.
+            @type styles: Dict of mapnik Styles.
+        """
+        self.layers = {}
+        for name, layer in layers.items():
+            self.layers[name] = _widened(layer.minzoom, layer.maxzoom)
+        self.styles = {}
+        for name, style in styles.items():
+            rules = list(style.rules)
+            intervals = Intervals([_widened(rule.min_scale, rule.max_scale) for rule in rules])
+            self.styles[name] = (style, rules, intervals)
+        self.lock = threading.Lock()
+        self.variants = {}
+        self.geographic = {}
+
+    def denominator(self, crs, bbox, width, height):
+        """ The scale denominator mapnik renders a map at, with the BBOX
+            grown to the aspect ratio of the map.
+
+            @param crs: The CRS of bbox, as in 'epsg:4326'.
+            @type crs: String.
+        """
+        if crs not in self.geographic:
+            try:
+                self.geographic[crs] = get_projection('+init=%s' % crs).geographic
+            except Exception:
+                self.geographic[crs] = False
+        scale = max(float(bbox[2] - bbox[0]) / width, float(bbox[3] - bbox[1]) / height)
+        if self.geographic[crs]:
+            scale *= METERS_PER_DEGREE
+        return scale / PIXEL_SIZE
+
+    def active(self, layers, scale):
+        """ Leave out the layers and the style rules that are not drawn at
+            a scale.
+
+            @param layers: (layer, styles) tuples, as returned by
+                           WMSBaseServiceHandler._resolveLayers.
+
+            @return: The layers drawn at scale, each with the styles of
+                     which rules are drawn, trimmed to those rules.
+        """
+        drawn = []
+        for layer, styles in layers:
+            if layer.name in self.layers:
+                minimum, maximum = self.layers[layer.name]
+                if not minimum <= scale < maximum:
+                    continue
+            activestyles = []
+            for stylename, style in styles:
+                if style is None or stylename not in self.styles:
+                    activestyles.append((stylename, style))
+                    continue
+                variant = self.variant(stylename, scale)
+                if variant:
+                    activestyles.append(variant)
+            if activestyles:
+                drawn.append((layer, activestyles))
+        return drawn
+
+    def variant(self, stylename, scale):
+        """ The style with only the rules drawn at scale, under a name of
+            its own, or None if none of its rules is drawn.
+
+            @return: A (stylename, style) tuple or None.
+        """
+        style, rules, intervals = self.styles[stylename]
+        i, indexes = intervals.find(scale)
+        if not indexes:
+            return None
+        if len(indexes) == len(rules):
+            return stylename, style
+        key = (stylename, i)
+        self.lock.acquire()
+        try:
+            if key not in self.variants:
+                trimmed = style.__class__()
+                for attribute in STYLE_ATTRIBUTES:
+                    if hasattr(style, attribute):
+                        try:
+                            setattr(trimmed, attribute, getattr(style, attribute))
+                        except Exception:
+                            pass
+                for index in indexes:
+                    trimmed.rules.append(rules[index])
+                self.variants[key] = ('%s_scale%d' % (stylename, i), trimmed)
+            return self.variants[key]
+        finally:
+            self.lock.release()
@@ -0,0 +1,213 @@
+"""Pre-rendering of tile pyramids into the response cache."""
+
+import os
+import re
+import sys
+import math
+import time
+import multiprocessing
+from optparse import OptionParser
+
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse
+    from cgi import parse_qs
+
+from ogcserver.metatile import load_grids
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.renderpool import _initworker, _worker
+from ogcserver.utfgrid import UTFGRID_FORMAT
+
+def _seed(task):
+    """ Render one metatile in a worker process, through the GetMap
+        request of one of its tiles.
+    """
+    from ogcserver.WMS import ServiceHandlerFactory
+    address, ntiles, version, reqparams = task
+    try:
+        handler = ServiceHandlerFactory(_worker['conf'], _worker['mapfactory'], '', version)
+        params = handler.processParameters('GetMap', dict(reqparams))
+        params['HTTP_USER_AGENT'] = ''
+        handler.GetMap(params)
+    except Exception, e:
+        return task, 0, '%s: %s' % (e.__class__.__name__, e)
+    return task, ntiles, None
+
+def resume_key(task):
+    """ The line recording a finished task in a resume file, telling
+        apart the tasks of runs for other layers, styles or formats.
+    """
+    address, ntiles, version, reqparams = task
+    return repr((address, reqparams.get('layers'), reqparams.get('styles', ''),
+                 reqparams.get('format'), reqparams.get('transparent', 'FALSE')))
+
+def pyramid_tasks(grid, bbox, zooms, reqparams):
+    """ Yield a task for every metatile of the grid intersecting bbox, zoom
+        level by zoom level, in row and column order.
+    """
+    for z in zooms:
+        span = grid.resolutions[z] * grid.tilesize
+        cols, rows = grid.size(z)
+        mincol = max(0, int(math.floor((bbox[0] - grid.extent[0]) / span)))
+        minrow = max(0, int(math.floor((bbox[1] - grid.extent[1]) / span)))
+        maxcol = min(cols, int(math.ceil((bbox[2] - grid.extent[0]) / span)))
+        maxrow = min(rows, int(math.ceil((bbox[3] - grid.extent[1]) / span)))
+        for row in range(minrow - minrow % grid.metatile[1], maxrow, grid.metatile[1]):
+            for col in range(mincol - mincol % grid.metatile[0], maxcol, grid.metatile[0]):
+                mcol, mrow, mcols, mrows = grid.metatilefor(z, col, row)
+                params = dict(reqparams)
+                params['bbox'] = ','.join([repr(v) for v in grid.tilebbox(z, col, row)])
+                yield (grid.name, z, mcol, mrow), mcols * mrows, '1.1.1', params
+
+def reversed_axes(version, crs):
+    """ Whether the BBOX of a GetMap request lists y before x, as WMS 1.3.0
+        requests do in the EPSG codes from 4000 to 4999, see wms130.
+
+        @param crs: The CRS of the request, as in 'epsg:4326'.
+        @type crs: String.
+    """
+    if version != '1.3.0' or not crs.startswith('epsg:'):
+        return False
+    try:
+        return 4000 <= int(crs[len('epsg:'):]) < 5000
+    except ValueError:
+        return False
+
+def log_tasks(grids, logfile):
+    """ Read GetMap requests from an access log and return a task for every
+        metatile they hit, the most requested metatiles first.
+    """
+    requestline = re.compile('"(?:GET|HEAD) (\S+)')
+    counts = {}
+    tasks = {}
+    for line in open(logfile):
+        found = requestline.search(line)
+        if not found:
+            continue
+        reqparams = {}
+        for key, value in parse_qs(urlparse(found.group(1))[4], True).items():
+            reqparams[key.lower()] = value[0]
+        if reqparams.get('request') != 'GetMap':
+            continue
+        try:
+            crs = reqparams.get('crs', reqparams.get('srs', '')).lower()
+            bbox = map(float, reqparams['bbox'].split(','))
+            width, height = int(reqparams['width']), int(reqparams['height'])
+        except (KeyError, ValueError):
+            continue
+        if reversed_axes(reqparams.get('version', '1.1.1'), crs) and len(bbox) == 4:
+            # the grids list x before y
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+        for grid in grids:
+            tile = grid.match(crs, bbox, width, height)
+            if tile:
+                break
+        else:
+            continue
+        z, col, row = tile
+        mcol, mrow, mcols, mrows = grid.metatilefor(z, col, row)
+        version = reqparams.pop('version', '1.1.1')
+        for name in ('request', 'service', 'exceptions'):
+            reqparams.pop(name, None)
+        key = ((grid.name, z, mcol, mrow), version, tuple(sorted(reqparams.items())))
+        counts[key] = counts.get(key, 0) + 1
+        if key not in tasks:
+            tasks[key] = ((grid.name, z, mcol, mrow), mcols * mrows, version, reqparams)
+    return [tasks[key] for key in sorted(counts, key=counts.get, reverse=True)]
+
+def parse_zooms(value):
+    if '-' in value:
+        first, last = value.split('-')
+        return range(int(first), int(last) + 1)
+    return [int(value)]
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] <ogcserver.conf> <map.xml>',
+                          description='Pre-render the tiles of a tile grid configured in '
+                                      'ogcserver.conf into its response cache.')
+    parser.add_option('-g', '--grid', help='name of the [grid_<name>] section to seed')
+    parser.add_option('-b', '--bbox', help='minx,miny,maxx,maxy in the CRS of the grid, defaults to the whole grid')
+    parser.add_option('-z', '--zooms', default='0-5', help='zoom level or range of zoom levels, as in 0-5 (default)')
+    parser.add_option('-l', '--layers', default='__all__', help='comma separated layers (default: __all__)')
+    parser.add_option('-s', '--styles', default='', help='comma separated styles')
+    parser.add_option('-f', '--format', default='image/png', help='image format, or %s for UTFGrids (default: image/png)' % UTFGRID_FORMAT)
+    parser.add_option('-t', '--transparent', action='store_true', default=False, help='render transparent tiles')
+    parser.add_option('-p', '--processes', type='int', default=multiprocessing.cpu_count(),
+                      help='number of rendering processes (default: one per CPU)')
+    parser.add_option('-r', '--resume', metavar='FILE',
+                      help='record finished metatiles in FILE and skip those already recorded there')
+    parser.add_option('--from-log', metavar='FILE', dest='logfile',
+                      help='seed the metatiles requested in an access log, most requested first, '
+                           'instead of a pyramid')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('expected the configuration file and the mapfile')
+    configpath, mapfile = args
+
+    conf = SafeConfigParser()
+    conf.readfp(open(configpath))
+    if not conf.has_option_with_value('server', 'cachedir'):
+        parser.error('seeding needs a response cache, set cachedir in the [server] section')
+    grids = load_grids(conf)
+    if not grids:
+        parser.error('no tile grid configured, add a [grid_<name>] section')
+
+    if options.logfile:
+        tasks = log_tasks(grids, options.logfile)
+    else:
+        for grid in grids:
+            if grid.name == options.grid or (not options.grid and len(grids) == 1):
+                break
+        else:
+            parser.error('choose one of the tile grids with --grid: %s' % ', '.join([g.name for g in grids]))
+        if options.bbox:
+            bbox = map(float, options.bbox.split(','))
+        else:
+            bbox = grid.extent
+        reqparams = {'layers': options.layers,
+                     'styles': options.styles,
+                     'srs': grid.crs.upper(),
+                     'width': str(grid.tilesize),
+                     'height': str(grid.tilesize),
+                     'format': options.format,
+                     'transparent': options.transparent and 'TRUE' or 'FALSE'}
+        tasks = pyramid_tasks(grid, bbox, parse_zooms(options.zooms), reqparams)
+
+    done = set()
+    progress = None
+    if options.resume:
+        if os.path.exists(options.resume):
+            for line in open(options.resume):
+                done.add(line.strip())
+        progress = open(options.resume, 'a')
+    tasks = (task for task in tasks if resume_key(task) not in done)
+
+    pool = multiprocessing.Pool(options.processes, _initworker, (configpath, mapfile, None))
+    started = last = time.time()
+    ntiles = 0
+    failed = 0
+    try:
+        for task, count, error in pool.imap_unordered(_seed, tasks):
+            if error:
+                failed += 1
+                sys.stderr.write('Failed to seed metatile %r: %s\n' % (task[0], error))
+                continue
+            ntiles += count
+            if progress:
+                progress.write(resume_key(task) + '\n')
+                progress.flush()
+            now = time.time()
+            if now - last >= 5:
+                last = now
+                sys.stdout.write('%d tiles, %.1f tiles/s\n' % (ntiles, ntiles / (now - started)))
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.stderr.write('Interrupted, %d tiles seeded.\n' % ntiles)
+        return 1
+    pool.close()
+    pool.join()
+    elapsed = max(time.time() - started, 1e-6)
+    sys.stdout.write('Seeded %d tiles in %.1fs, %.1f tiles/s, %d metatiles failed.\n' % (ntiles, elapsed, ntiles / elapsed, failed))
+    return failed and 1 or 0
@@ -0,0 +1,113 @@
+"""Coalescing of identical requests running at the same time."""
+
+import sys
+import threading
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.excinfo = None
+
+class SingleFlight:
+
+    def __init__(self):
+        """ Lets only the first of several concurrent calls with the same
+            key do the work, the others wait for and share its result.
+        """
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.flights = 0
+        self.coalesced = 0
+
+    def do(self, key, function, *args):
+        """ Return function(*args), or the result of the identical call
+            already in progress for key.  Exceptions raised by that call are
+            raised again in every waiting thread.
+        """
+        self.lock.acquire()
+        call = self.calls.get(key)
+        if call:
+            self.coalesced += 1
+            self.lock.release()
+            call.done.wait()
+            if call.excinfo:
+                raise call.excinfo[0], call.excinfo[1], call.excinfo[2]
+            return call.result
+        call = _Call()
+        self.calls[key] = call
+        self.flights += 1
+        self.lock.release()
+        try:
+            call.result = function(*args)
+        except:
+            call.excinfo = sys.exc_info()
+            raise
+        finally:
+            self.lock.acquire()
+            del self.calls[key]
+            self.lock.release()
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        return {'inflight': len(self.calls),
+                'flights': self.flights,
+                'coalesced': self.coalesced}
+
+class Refresher:
+
+    def __init__(self, concurrency=2):
+        """ Renders stale cached responses again in background threads,
+            at most once at a time per key and concurrency at a time
+            overall.  Refreshes beyond that are dropped: the stale response
+            keeps being served and a later request tries again.
+        """
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.concurrency = concurrency
+        self.pending = set()
+        self.refreshed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def refresh(self, key, function, *args):
+        """ Call function(*args) in a background thread unless a refresh of
+            key is already running.
+
+            @return: Whether the refresh was started.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                return False
+            if not self.slots.acquire(False):
+                self.dropped += 1
+                return False
+            self.pending.add(key)
+        finally:
+            self.lock.release()
+        thread = threading.Thread(target=self._run, args=(key, function, args))
+        thread.setDaemon(True)
+        thread.start()
+        return True
+
+    def _run(self, key, function, args):
+        try:
+            function(*args)
+            self.refreshed += 1
+        except Exception:
+            self.failed += 1
+        finally:
+            self.lock.acquire()
+            self.pending.discard(key)
+            self.lock.release()
+            self.slots.release()
+
+    def stats(self):
+        return {'pending': len(self.pending),
+                'concurrency': self.concurrency,
+                'refreshed': self.refreshed,
+                'dropped': self.dropped,
+                'failed': self.failed}
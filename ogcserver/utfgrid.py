@@ -0,0 +1,107 @@
+"""UTFGrid interactivity grids of the queryable layers of GetMap requests,
+rendered with the grid renderer of mapnik."""
+
+import json
+
+try:
+    from mapnik2 import Grid, render_layer
+except ImportError:
+    try:
+        from mapnik import Grid, render_layer
+    except ImportError:
+        # mapnik before 2.0 renders no grids
+        Grid = render_layer = None
+
+from ogcserver.exceptions import ServerConfigurationError
+
+# without ';' or '+', which query strings take for a parameter separator and
+# a space
+UTFGRID_FORMAT = 'application/utfgrid'
+
+# the width and height in pixels of a grid cell unless configured otherwise
+RESOLUTION = 4
+
+def _resolution(conf, section):
+    if not conf.has_option_with_value(section, 'utfgridresolution'):
+        return None
+    try:
+        resolution = int(conf.get(section, 'utfgridresolution'))
+        if resolution < 1:
+            raise ValueError
+    except ValueError:
+        raise ServerConfigurationError('Invalid value for "utfgridresolution" in the [%s] section.' % section)
+    return resolution
+
+class UTFGridRenderer:
+
+    def __init__(self, resolution=RESOLUTION, layeroptions=None):
+        """ Renders the UTFGrid of a layer of a map and encodes it as JSON,
+            with the resolution and the attributes configured for the layer.
+
+            @param resolution: The width and height in pixels of the grid
+                               cells of the layers not configured otherwise.
+            @type resolution: Integer.
+
+            @param layeroptions: The (resolution, fields) of the
+                                 [layer_<name>] sections by layer name,
+                                 either is None where not set.
+            @type layeroptions: Dict of tuples.
+        """
+        self.defaultresolution = resolution
+        self.layeroptions = layeroptions or {}
+        self.available = Grid is not None
+
+    def resolution(self, layer):
+        return self.layeroptions.get(layer.name, (None, None))[0] or self.defaultresolution
+
+    def fields(self, layer):
+        """ The attributes the grid of a layer carries for each feature: the
+            configured ones, or else all fields of its datasource.
+        """
+        fields = self.layeroptions.get(layer.name, (None, None))[1]
+        if fields is not None:
+            return fields
+        try:
+            return list(layer.datasource.fields())
+        except Exception:
+            return []
+
+    def render(self, m, index, layer):
+        """ Render one layer of a Map into a grid of the size of the map.
+
+            @param index: The index of the layer within m.layers.
+            @type index: Integer.
+
+            @param layer: The layer the one of the map is a copy of.
+            @type layer: mapnik Layer.
+        """
+        grid = Grid(m.width, m.height)
+        render_layer(m, grid, layer=index, fields=self.fields(layer))
+        return grid
+
+    def empty(self, width, height):
+        return Grid(width, height)
+
+    def encode(self, grid, layer):
+        """ The UTFGrid JSON of a rendered mapnik Grid or grid view, with
+            the cell size configured for layer.
+        """
+        # sorted keys keep the content, and so the ETag, the same across processes
+        return json.dumps(grid.encode('utf', True, self.resolution(layer)), sort_keys=True)
+
+def load_utfgrid(conf):
+    """ Read the utfgridresolution of the [server] section and the
+        utfgridresolution and utfgridfields of the [layer_<name>] sections
+        of ogcserver.conf.
+    """
+    layeroptions = {}
+    for section in conf.sections():
+        if not section.startswith('layer_'):
+            continue
+        fields = None
+        if conf.has_option(section, 'utfgridfields'):
+            fields = [field.strip() for field in conf.get(section, 'utfgridfields').split(',') if field.strip()]
+        resolution = _resolution(conf, section)
+        if fields is not None or resolution:
+            layeroptions[section[len('layer_'):]] = (resolution, fields)
+    return UTFGridRenderer(_resolution(conf, 'server') or RESOLUTION, layeroptions)
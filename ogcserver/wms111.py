@@ -8,9 +8,10 @@ except ImportError:
 from lxml import etree as ElementTree
 
 from ogcserver.common import ParameterDefinition, Response, Version, ListFactory, \
-                   ColorFactory, CRSFactory, WMSBaseServiceHandler, CRS, \
-                   BaseExceptionHandler, Projection, to_unicode
+                   ColorFactory, CRSFactory, PointListFactory, WMSBaseServiceHandler, CRS, \
+                   BaseExceptionHandler, get_projection, finite, wgs84_bounds, to_unicode
 from ogcserver.exceptions import OGCException, ServerConfigurationError
+from ogcserver.utfgrid import UTFGRID_FORMAT
 
 
 class ServiceHandler(WMSBaseServiceHandler):
@@ -26,7 +27,7 @@ class ServiceHandler(WMSBaseServiceHandler):
             'bbox': ParameterDefinition(True, ListFactory(float)),
             'width': ParameterDefinition(True, int),
             'height': ParameterDefinition(True, int),
-            'format': ParameterDefinition(True, str, allowedvalues=('image/png','image/png8', 'image/jpeg')),
+            'format': ParameterDefinition(True, str, allowedvalues=('image/png','image/png8', 'image/jpeg', 'image/webp', 'image/auto', UTFGRID_FORMAT)),
             'transparent': ParameterDefinition(False, str, 'FALSE', ('TRUE', 'FALSE','true','True','false','False')),
             'bgcolor': ParameterDefinition(False, ColorFactory, ColorFactory('0xFFFFFF')),
             'exceptions': ParameterDefinition(False, str, 'application/vnd.ogc.se_xml', ('application/vnd.ogc.se_xml', 'application/vnd.ogc.se_inimage', 'application/vnd.ogc.se_blank','text/html'),True)
@@ -43,10 +44,30 @@ class ServiceHandler(WMSBaseServiceHandler):
             'bgcolor': ParameterDefinition(False, ColorFactory, ColorFactory('0xFFFFFF')),
             'exceptions': ParameterDefinition(False, str, 'application/vnd.ogc.se_xml', ('application/vnd.ogc.se_xml', 'application/vnd.ogc.se_inimage', 'application/vnd.ogc.se_blank','text/html'),True),
             'query_layers': ParameterDefinition(True, ListFactory(str)),
-            'info_format': ParameterDefinition(True, str, allowedvalues=('text/plain', 'text/xml')),
+            'info_format': ParameterDefinition(True, str, allowedvalues=('text/plain', 'text/xml', 'application/json', 'application/geo+json')),
             'feature_count': ParameterDefinition(False, int, 1),
             'x': ParameterDefinition(True, int),
             'y': ParameterDefinition(True, int)
+        },
+        'GetFeatureInfoBatch': {
+            'layers': ParameterDefinition(True, ListFactory(str)),
+            'styles': ParameterDefinition(False, ListFactory(str)),
+            'srs': ParameterDefinition(True, CRSFactory(['EPSG'])),
+            'bbox': ParameterDefinition(True, ListFactory(float)),
+            'width': ParameterDefinition(True, int),
+            'height': ParameterDefinition(True, int),
+            'exceptions': ParameterDefinition(False, str, 'application/vnd.ogc.se_xml', ('application/vnd.ogc.se_xml', 'application/vnd.ogc.se_inimage', 'application/vnd.ogc.se_blank','text/html'),True),
+            'query_layers': ParameterDefinition(True, ListFactory(str)),
+            'info_format': ParameterDefinition(True, str, allowedvalues=('application/json', 'text/xml')),
+            'feature_count': ParameterDefinition(False, int, 1),
+            'pixels': ParameterDefinition(False, PointListFactory),
+            'points': ParameterDefinition(False, PointListFactory)
+        },
+        'InvalidateCache': {
+            'token': ParameterDefinition(True, str),
+            'layers': ParameterDefinition(True, ListFactory(str)),
+            'srs': ParameterDefinition(False, CRSFactory(['EPSG'])),
+            'bbox': ParameterDefinition(False, ListFactory(float))
         }        
     }
 
@@ -91,6 +112,9 @@ class ServiceHandler(WMSBaseServiceHandler):
           </GetMap>
           <GetFeatureInfo>
             <Format>text/plain</Format>
+            <Format>text/xml</Format>
+            <Format>application/json</Format>
+            <Format>application/geo+json</Format>
             <DCPType>
               <HTTP>
                 <Get>
@@ -120,110 +144,134 @@ class ServiceHandler(WMSBaseServiceHandler):
             self.allowedepsgcodes = map(lambda code: 'epsg:%s' % code, self.conf.get('service', 'allowedepsgcodes').split(','))
         else:
             raise ServerConfigurationError('Allowed EPSG codes not properly configured.')
-        self.capabilities = None
 
     def GetCapabilities(self, params):
-        if not self.capabilities:
-            capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
-    
-            elements = capetree.findall('Capability//OnlineResource')
-            for element in elements:
-                element.set('{http://www.w3.org/1999/xlink}href', self.opsonlineresource)
-    
-            self.processServiceCapabilities(capetree)
-    
-            rootlayerelem = capetree.find('Capability/Layer')
+        return self.mapfactory.capabilities.get(('1.1.1', self.opsonlineresource), self.mapfactory.generation,
+                                                self._buildCapabilities)
 
-            rootlayername = ElementTree.Element('Name')
-            if self.conf.has_option('map', 'wms_name'):
-                rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
-            else:
-                rootlayername.text = '__all__'
-            rootlayerelem.append(rootlayername)
+    def _buildCapabilities(self):
+        capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
 
-            rootlayertitle = ElementTree.Element('Title')
-            if self.conf.has_option('map', 'wms_title'):
-                rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
-            else:
-                rootlayertitle.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayertitle)
+        elements = capetree.findall('Capability//OnlineResource')
+        for element in elements:
+            element.set('{http://www.w3.org/1999/xlink}href', self.opsonlineresource)
 
-            rootlayerabstract = ElementTree.Element('Abstract')
-            if self.conf.has_option('map', 'wms_abstract'):
-                rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
-            else:
-                rootlayerabstract.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayerabstract)
-    
-            for epsgcode in self.allowedepsgcodes:
-                rootlayercrs = ElementTree.Element('SRS')
-                rootlayercrs.text = epsgcode.upper()
-                rootlayerelem.append(rootlayercrs)
-    
-            for layer in self.mapfactory.ordered_layers:
-                layerproj = Projection(layer.srs)
-                layername = ElementTree.Element('Name')
-                layername.text = to_unicode(layer.name)
-                env = layer.envelope()
-                llp = layerproj.inverse(Coord(env.minx, env.miny))
-                urp = layerproj.inverse(Coord(env.maxx, env.maxy))
+        self.processServiceCapabilities(capetree)
+
+        getmapelem = capetree.find('Capability/Request/GetMap')
+        formats = []
+        if self.mapfactory.encoder.webp:
+            formats.append('image/webp')
+        if self.mapfactory.encoder.auto:
+            formats.append('image/auto')
+        if self.mapfactory.utfgrid.available:
+            formats.append(UTFGRID_FORMAT)
+        for format in formats:
+            formatelem = ElementTree.Element('Format')
+            formatelem.text = format
+            getmapelem.insert(len(getmapelem.findall('Format')), formatelem)
+
+        rootlayerelem = capetree.find('Capability/Layer')
+
+        rootlayername = ElementTree.Element('Name')
+        if self.conf.has_option('map', 'wms_name'):
+            rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
+        else:
+            rootlayername.text = '__all__'
+        rootlayerelem.append(rootlayername)
+
+        rootlayertitle = ElementTree.Element('Title')
+        if self.conf.has_option('map', 'wms_title'):
+            rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
+        else:
+            rootlayertitle.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayertitle)
+
+        rootlayerabstract = ElementTree.Element('Abstract')
+        if self.conf.has_option('map', 'wms_abstract'):
+            rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
+        else:
+            rootlayerabstract.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayerabstract)
+
+        for epsgcode in self.allowedepsgcodes:
+            rootlayercrs = ElementTree.Element('SRS')
+            rootlayercrs.text = epsgcode.upper()
+            rootlayerelem.append(rootlayercrs)
+
+        for layer in self.mapfactory.ordered_layers:
+            layerproj = get_projection(layer.srs)
+            layername = ElementTree.Element('Name')
+            layername.text = to_unicode(layer.name)
+            env = layer.envelope()
+            bounds = wgs84_bounds(layer.srs, env)
+            latlonbb = None
+            if bounds:
                 latlonbb = ElementTree.Element('LatLonBoundingBox')
-                latlonbb.set('minx', str(llp.x))
-                latlonbb.set('miny', str(llp.y))
-                latlonbb.set('maxx', str(urp.x))
-                latlonbb.set('maxy', str(urp.y))
-                layerbbox = ElementTree.Element('BoundingBox')
-                if layer.wms_srs:
-                    layerbbox.set('SRS', layer.wms_srs)
-                else:
-                    layerbbox.set('SRS', layerproj.epsgstring())
-                layerbbox.set('minx', str(env.minx))
-                layerbbox.set('miny', str(env.miny))
-                layerbbox.set('maxx', str(env.maxx))
-                layerbbox.set('maxy', str(env.maxy))
-                layere = ElementTree.Element('Layer')
-                layere.append(layername)
-                layertitle = ElementTree.Element('Title')
-                if hasattr(layer,'title'):
-                    layertitle.text = to_unicode(layer.title)
-                else:
-                    layertitle.text = to_unicode(layer.name)
-                layere.append(layertitle)
-                layerabstract = ElementTree.Element('Abstract')
-                if hasattr(layer,'abstract'):
-                    layerabstract.text = to_unicode(layer.abstract)
-                else:
-                    layerabstract.text = 'no abstract'                
-                layere.append(layerabstract)
-                if layer.queryable:
-                    layere.set('queryable', '1')                
+                latlonbb.set('minx', str(bounds[0]))
+                latlonbb.set('miny', str(bounds[1]))
+                latlonbb.set('maxx', str(bounds[2]))
+                latlonbb.set('maxy', str(bounds[3]))
+            layerbbox = ElementTree.Element('BoundingBox')
+            if layer.wms_srs:
+                layerbbox.set('SRS', layer.wms_srs)
+            else:
+                layerbbox.set('SRS', layerproj.epsgstring())
+            layerbbox.set('minx', str(env.minx))
+            layerbbox.set('miny', str(env.miny))
+            layerbbox.set('maxx', str(env.maxx))
+            layerbbox.set('maxy', str(env.maxy))
+            layere = ElementTree.Element('Layer')
+            layere.append(layername)
+            layertitle = ElementTree.Element('Title')
+            if hasattr(layer,'title'):
+                layertitle.text = to_unicode(layer.title)
+            else:
+                layertitle.text = to_unicode(layer.name)
+            layere.append(layertitle)
+            layerabstract = ElementTree.Element('Abstract')
+            if hasattr(layer,'abstract'):
+                layerabstract.text = to_unicode(layer.abstract)
+            else:
+                layerabstract.text = 'no abstract'                
+            layere.append(layerabstract)
+            if layer.queryable:
+                layere.set('queryable', '1')                
+            if latlonbb is not None:
                 layere.append(latlonbb)
+            if finite((env.minx, env.miny, env.maxx, env.maxy)):
                 layere.append(layerbbox)
-                if len(layer.wmsextrastyles) > 0:
-                    for extrastyle in [layer.wmsdefaultstyle] + list(layer.wmsextrastyles):
-                        style = ElementTree.Element('Style')
-                        stylename = ElementTree.Element('Name')
-                        stylename.text = to_unicode(extrastyle)
-                        styletitle = ElementTree.Element('Title')
-                        styletitle.text = to_unicode(extrastyle)
-                        style.append(stylename)
-                        style.append(styletitle)
-                        layere.append(style)
-                rootlayerelem.append(layere)
-            self.capabilities = '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n' + ElementTree.tostring(capetree,encoding='UTF-8',pretty_print=True)
-        response = Response('application/vnd.ogc.wms_xml', self.capabilities)
-        return response
+            if len(layer.wmsextrastyles) > 0:
+                for extrastyle in [layer.wmsdefaultstyle] + list(layer.wmsextrastyles):
+                    style = ElementTree.Element('Style')
+                    stylename = ElementTree.Element('Name')
+                    stylename.text = to_unicode(extrastyle)
+                    styletitle = ElementTree.Element('Title')
+                    styletitle.text = to_unicode(extrastyle)
+                    style.append(stylename)
+                    style.append(styletitle)
+                    layere.append(style)
+            rootlayerelem.append(layere)
+        return Response('application/vnd.ogc.wms_xml', '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n' + ElementTree.tostring(capetree,encoding='UTF-8',pretty_print=True))
 
     def GetMap(self, params):
         params['crs'] = params['srs']
         return WMSBaseServiceHandler.GetMap(self, params)
 
+    def InvalidateCache(self, params):
+        params['crs'] = params.get('srs')
+        return WMSBaseServiceHandler.InvalidateCache(self, params)
+
     def GetFeatureInfo(self, params):
         params['crs'] = params['srs']
         params['i'] = params['x']
         params['j'] = params['y']
         return WMSBaseServiceHandler.GetFeatureInfo(self, params, 'query_map_point')        
 
+    def GetFeatureInfoBatch(self, params):
+        params['crs'] = params['srs']
+        return WMSBaseServiceHandler.GetFeatureInfoBatch(self, params)
+
 class ExceptionHandler(BaseExceptionHandler):
 
     xmlmimetype = "application/vnd.ogc.se_xml"
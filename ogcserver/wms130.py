@@ -8,9 +8,10 @@ except ImportError:
 from lxml import etree as ElementTree
 
 from ogcserver.common import ParameterDefinition, Response, Version, ListFactory, \
-                   ColorFactory, CRSFactory, CRS, WMSBaseServiceHandler, \
-                   BaseExceptionHandler, Projection, Envelope, to_unicode
+                   ColorFactory, CRSFactory, PointListFactory, CRS, WMSBaseServiceHandler, \
+                   BaseExceptionHandler, Envelope, get_projection, finite, wgs84_bounds, to_unicode
 from ogcserver.exceptions import OGCException, ServerConfigurationError
+from ogcserver.utfgrid import UTFGRID_FORMAT
 
 class ServiceHandler(WMSBaseServiceHandler):
 
@@ -26,7 +27,7 @@ class ServiceHandler(WMSBaseServiceHandler):
             'bbox': ParameterDefinition(True, ListFactory(float)),
             'width': ParameterDefinition(True, int),
             'height': ParameterDefinition(True, int),
-            'format': ParameterDefinition(True, str, allowedvalues=('image/png','image/png8', 'image/jpeg')),
+            'format': ParameterDefinition(True, str, allowedvalues=('image/png','image/png8', 'image/jpeg', 'image/webp', 'image/auto', UTFGRID_FORMAT)),
             'transparent': ParameterDefinition(False, str, 'FALSE', ('TRUE', 'FALSE','true','True','false','False')),
             'bgcolor': ParameterDefinition(False, ColorFactory, ColorFactory('0xFFFFFF')),
             'exceptions': ParameterDefinition(False, str, 'XML', ('XML', 'INIMAGE', 'BLANK','HTML'),True),
@@ -43,12 +44,32 @@ class ServiceHandler(WMSBaseServiceHandler):
             'bgcolor': ParameterDefinition(False, ColorFactory, ColorFactory('0xFFFFFF')),
             'exceptions': ParameterDefinition(False, str, 'XML', ('XML', 'INIMAGE', 'BLANK','HTML'),True),
             'query_layers': ParameterDefinition(True, ListFactory(str)),
-            'info_format': ParameterDefinition(True, str, allowedvalues=('text/plain', 'text/xml')),
+            'info_format': ParameterDefinition(True, str, allowedvalues=('text/plain', 'text/xml', 'application/json', 'application/geo+json')),
             'feature_count': ParameterDefinition(False, int, 1),
             'i': ParameterDefinition(False, float),
             'j': ParameterDefinition(False, float),
             'y': ParameterDefinition(False, float),
             'x': ParameterDefinition(False, float)
+        },
+        'GetFeatureInfoBatch': {
+            'layers': ParameterDefinition(True, ListFactory(str)),
+            'styles': ParameterDefinition(False, ListFactory(str)),
+            'crs': ParameterDefinition(True, CRSFactory(['EPSG'])),
+            'bbox': ParameterDefinition(True, ListFactory(float)),
+            'width': ParameterDefinition(True, int),
+            'height': ParameterDefinition(True, int),
+            'exceptions': ParameterDefinition(False, str, 'XML', ('XML', 'INIMAGE', 'BLANK','HTML'),True),
+            'query_layers': ParameterDefinition(True, ListFactory(str)),
+            'info_format': ParameterDefinition(True, str, allowedvalues=('application/json', 'text/xml')),
+            'feature_count': ParameterDefinition(False, int, 1),
+            'pixels': ParameterDefinition(False, PointListFactory),
+            'points': ParameterDefinition(False, PointListFactory)
+        },
+        'InvalidateCache': {
+            'token': ParameterDefinition(True, str),
+            'layers': ParameterDefinition(True, ListFactory(str)),
+            'crs': ParameterDefinition(False, CRSFactory(['EPSG'])),
+            'bbox': ParameterDefinition(False, ListFactory(float))
         }
     }
 
@@ -98,6 +119,9 @@ class ServiceHandler(WMSBaseServiceHandler):
           </GetMap>
           <GetFeatureInfo>
             <Format>text/plain</Format>
+            <Format>text/xml</Format>
+            <Format>application/json</Format>
+            <Format>application/geo+json</Format>
             <DCPType>
               <HTTP>
                 <Get>
@@ -127,107 +151,123 @@ class ServiceHandler(WMSBaseServiceHandler):
             self.allowedepsgcodes = map(lambda code: 'epsg:%s' % code, self.conf.get('service', 'allowedepsgcodes').split(','))
         else:
             raise ServerConfigurationError('Allowed EPSG codes not properly configured.')
-        self.capabilities = None
 
     def GetCapabilities(self, params):
-        if not self.capabilities:
-            capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
-    
-            elements = capetree.findall('{http://www.opengis.net/wms}Capability//{http://www.opengis.net/wms}OnlineResource')
-            for element in elements:
-                element.set('{http://www.w3.org/1999/xlink}href', self.opsonlineresource)
-    
-            self.processServiceCapabilities(capetree)
-    
-            rootlayerelem = capetree.find('{http://www.opengis.net/wms}Capability/{http://www.opengis.net/wms}Layer')
+        return self.mapfactory.capabilities.get(('1.3.0', self.opsonlineresource), self.mapfactory.generation,
+                                                self._buildCapabilities)
 
-            rootlayername = ElementTree.Element('Name')
-            if self.conf.has_option('map', 'wms_name'):
-                rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
-            else:
-                rootlayername.text = '__all__'
-            rootlayerelem.append(rootlayername)
+    def _buildCapabilities(self):
+        capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
 
-            rootlayertitle = ElementTree.Element('Title')
-            if self.conf.has_option('map', 'wms_title'):
-                rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
-            else:
-                rootlayertitle.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayertitle)
+        elements = capetree.findall('{http://www.opengis.net/wms}Capability//{http://www.opengis.net/wms}OnlineResource')
+        for element in elements:
+            element.set('{http://www.w3.org/1999/xlink}href', self.opsonlineresource)
 
-            rootlayerabstract = ElementTree.Element('Abstract')
-            if self.conf.has_option('map', 'wms_abstract'):
-                rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
-            else:
-                rootlayerabstract.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayerabstract)
-    
-            for epsgcode in self.allowedepsgcodes:
-                rootlayercrs = ElementTree.Element('CRS')
-                rootlayercrs.text = epsgcode.upper()
-                rootlayerelem.append(rootlayercrs)
-    
-            for layer in self.mapfactory.ordered_layers:
-                layerproj = Projection(layer.srs)
-                layername = ElementTree.Element('Name')
-                layername.text = to_unicode(layer.name)
-                env = layer.envelope()
+        self.processServiceCapabilities(capetree)
+
+        getmapelem = capetree.find('{http://www.opengis.net/wms}Capability/{http://www.opengis.net/wms}Request/{http://www.opengis.net/wms}GetMap')
+        formats = []
+        if self.mapfactory.encoder.webp:
+            formats.append('image/webp')
+        if self.mapfactory.encoder.auto:
+            formats.append('image/auto')
+        if self.mapfactory.utfgrid.available:
+            formats.append(UTFGRID_FORMAT)
+        for format in formats:
+            formatelem = ElementTree.Element('{http://www.opengis.net/wms}Format')
+            formatelem.text = format
+            getmapelem.insert(len(getmapelem.findall('{http://www.opengis.net/wms}Format')), formatelem)
+
+        rootlayerelem = capetree.find('{http://www.opengis.net/wms}Capability/{http://www.opengis.net/wms}Layer')
+
+        rootlayername = ElementTree.Element('Name')
+        if self.conf.has_option('map', 'wms_name'):
+            rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
+        else:
+            rootlayername.text = '__all__'
+        rootlayerelem.append(rootlayername)
+
+        rootlayertitle = ElementTree.Element('Title')
+        if self.conf.has_option('map', 'wms_title'):
+            rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
+        else:
+            rootlayertitle.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayertitle)
+
+        rootlayerabstract = ElementTree.Element('Abstract')
+        if self.conf.has_option('map', 'wms_abstract'):
+            rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
+        else:
+            rootlayerabstract.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayerabstract)
+
+        for epsgcode in self.allowedepsgcodes:
+            rootlayercrs = ElementTree.Element('CRS')
+            rootlayercrs.text = epsgcode.upper()
+            rootlayerelem.append(rootlayercrs)
+
+        for layer in self.mapfactory.ordered_layers:
+            layerproj = get_projection(layer.srs)
+            layername = ElementTree.Element('Name')
+            layername.text = to_unicode(layer.name)
+            env = layer.envelope()
+            bounds = wgs84_bounds(layer.srs, env)
+            layerexgbb = None
+            if bounds:
                 layerexgbb = ElementTree.Element('EX_GeographicBoundingBox')
-                ll = layerproj.inverse(Coord(env.minx, env.miny))
-                ur = layerproj.inverse(Coord(env.maxx, env.maxy))
                 exgbb_wbl = ElementTree.Element('westBoundLongitude')
-                exgbb_wbl.text = str(ll.x)
+                exgbb_wbl.text = str(bounds[0])
                 layerexgbb.append(exgbb_wbl)
                 exgbb_ebl = ElementTree.Element('eastBoundLongitude')
-                exgbb_ebl.text = str(ur.x)
+                exgbb_ebl.text = str(bounds[2])
                 layerexgbb.append(exgbb_ebl)
                 exgbb_sbl = ElementTree.Element('southBoundLatitude')
-                exgbb_sbl.text = str(ll.y)
+                exgbb_sbl.text = str(bounds[1])
                 layerexgbb.append(exgbb_sbl)
                 exgbb_nbl = ElementTree.Element('northBoundLatitude')
-                exgbb_nbl.text = str(ur.y)
+                exgbb_nbl.text = str(bounds[3])
                 layerexgbb.append(exgbb_nbl)
-                layerbbox = ElementTree.Element('BoundingBox')
-                if layer.wms_srs:
-                    layerbbox.set('CRS', layer.wms_srs)
-                else:
-                    layerbbox.set('CRS', layerproj.epsgstring())
-                layerbbox.set('minx', str(env.minx))
-                layerbbox.set('miny', str(env.miny))
-                layerbbox.set('maxx', str(env.maxx))
-                layerbbox.set('maxy', str(env.maxy))
-                layere = ElementTree.Element('Layer')
-                layere.append(layername)
-                layertitle = ElementTree.Element('Title')
-                if hasattr(layer,'title'):
-                    layertitle.text = to_unicode(layer.title)
-                else:
-                    layertitle.text = to_unicode(layer.name)                    
-                layere.append(layertitle)
-                layerabstract = ElementTree.Element('Abstract')
-                if hasattr(layer,'abstract'):
-                    layerabstract.text = to_unicode(layer.abstract)
-                else:
-                    layerabstract.text = 'no abstract'                
-                layere.append(layerabstract)
-                if layer.queryable:
-                    layere.set('queryable', '1')
+            layerbbox = ElementTree.Element('BoundingBox')
+            if layer.wms_srs:
+                layerbbox.set('CRS', layer.wms_srs)
+            else:
+                layerbbox.set('CRS', layerproj.epsgstring())
+            layerbbox.set('minx', str(env.minx))
+            layerbbox.set('miny', str(env.miny))
+            layerbbox.set('maxx', str(env.maxx))
+            layerbbox.set('maxy', str(env.maxy))
+            layere = ElementTree.Element('Layer')
+            layere.append(layername)
+            layertitle = ElementTree.Element('Title')
+            if hasattr(layer,'title'):
+                layertitle.text = to_unicode(layer.title)
+            else:
+                layertitle.text = to_unicode(layer.name)                    
+            layere.append(layertitle)
+            layerabstract = ElementTree.Element('Abstract')
+            if hasattr(layer,'abstract'):
+                layerabstract.text = to_unicode(layer.abstract)
+            else:
+                layerabstract.text = 'no abstract'                
+            layere.append(layerabstract)
+            if layer.queryable:
+                layere.set('queryable', '1')
+            if layerexgbb is not None:
                 layere.append(layerexgbb)
+            if finite((env.minx, env.miny, env.maxx, env.maxy)):
                 layere.append(layerbbox)
-                if len(layer.wmsextrastyles) > 0:
-                    for extrastyle in [layer.wmsdefaultstyle] + list(layer.wmsextrastyles):
-                        style = ElementTree.Element('Style')
-                        stylename = ElementTree.Element('Name')
-                        stylename.text = to_unicode(extrastyle)
-                        styletitle = ElementTree.Element('Title')
-                        styletitle.text = to_unicode(extrastyle)
-                        style.append(stylename)
-                        style.append(styletitle)
-                        layere.append(style)
-                rootlayerelem.append(layere)
-            self.capabilities = '<?xml version="1.0" encoding="UTF-8"?>' + ElementTree.tostring(capetree,encoding='UTF-8',pretty_print=True)
-        response = Response('text/xml', self.capabilities)
-        return response
+            if len(layer.wmsextrastyles) > 0:
+                for extrastyle in [layer.wmsdefaultstyle] + list(layer.wmsextrastyles):
+                    style = ElementTree.Element('Style')
+                    stylename = ElementTree.Element('Name')
+                    stylename.text = to_unicode(extrastyle)
+                    styletitle = ElementTree.Element('Title')
+                    styletitle.text = to_unicode(extrastyle)
+                    style.append(stylename)
+                    style.append(styletitle)
+                    layere.append(style)
+            rootlayerelem.append(layere)
+        return Response('text/xml', '<?xml version="1.0" encoding="UTF-8"?>' + ElementTree.tostring(capetree,encoding='UTF-8',pretty_print=True))
 
     def GetMap(self, params):
         if params['width'] > int(self.conf.get('service', 'maxwidth')) or params['height'] > int(self.conf.get('service', 'maxheight')):
@@ -247,7 +287,7 @@ class ServiceHandler(WMSBaseServiceHandler):
             params['crs'] = params.get('srs')
         return WMSBaseServiceHandler.GetFeatureInfo(self, params, 'query_map_point')
             
-    def _buildMap(self, params):
+    def _buildMap(self, params, layers=None):
         """ Override _buildMap method to handle reverse axis ordering in WMS 1.3.0.
         
         More info: http://mapserver.org/development/rfc/ms-rfc-30.html
@@ -257,14 +297,18 @@ class ServiceHandler(WMSBaseServiceHandler):
         
         """
         # Call superclass method
-        m = WMSBaseServiceHandler._buildMap(self, params)
+        m = WMSBaseServiceHandler._buildMap(self, params, layers)
+        if self._reversedAxes(params):
+            bbox = params['bbox']
+            m.zoom_to_box(Envelope(bbox[1], bbox[0], bbox[3], bbox[2]))
+        return m    
+
+    def _reversedAxes(self, params):
         # for range of epsg codes reverse axis as per 1.3.0 spec
         if params['crs'].code >= 4000 and params['crs'].code < 5000:
-            bbox = params['bbox']
             # MapInfo Pro 10 does not "know" this is the way and gets messed up
-            if not 'mapinfo' in params['HTTP_USER_AGENT'].lower():
-                m.zoom_to_box(Envelope(bbox[1], bbox[0], bbox[3], bbox[2]))
-        return m    
+            return not 'mapinfo' in params.get('HTTP_USER_AGENT', '').lower()
+        return False
 
 class ExceptionHandler(BaseExceptionHandler):
 
@@ -15,9 +15,12 @@ try:
 except ImportError:
     import mapnik
     
-from ogcserver.common import Version
+from ogcserver.cache import query_key
+from ogcserver.common import Version, CONDITIONAL_REQUESTS, cache_control, conditional_headers, entity_tag, http_date, not_modified, variant_tag
 from ogcserver.WMS import BaseWMSFactory
+from ogcserver.WMTS import RESTPREFIXES, dispatch_path, path_request
 from ogcserver.configparser import SafeConfigParser
+from ogcserver.renderpool import RenderPool
 from ogcserver.wms111 import ExceptionHandler as ExceptionHandler111
 from ogcserver.wms130 import ExceptionHandler as ExceptionHandler130
 from ogcserver.exceptions import OGCException, ServerConfigurationError
@@ -58,14 +61,29 @@ class WSGIApp:
                 self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')()
             else:
                 raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
+        self.mapfactory.configure(conf)
+        warmup = self.mapfactory.prepare_capabilities(conf)
         if conf.has_option('server', 'debug'):
             self.debug = int(conf.get('server', 'debug'))
         else:
             self.debug = 0
         if self.conf.has_option_with_value('server', 'maxage'):
-            self.max_age = 'max-age=%d' % self.conf.get('server', 'maxage')
+            self.max_age = 'max-age=%d' % int(self.conf.get('server', 'maxage'))
         else:
             self.max_age = None
+        if conf.has_option_with_value('server', 'renderprocesses'):
+            queuesize = maxrequests = None
+            timeout = 60
+            if conf.has_option_with_value('server', 'renderqueuesize'):
+                queuesize = int(conf.get('server', 'renderqueuesize'))
+            if conf.has_option_with_value('server', 'rendermaxrequests'):
+                maxrequests = int(conf.get('server', 'rendermaxrequests'))
+            if conf.has_option_with_value('server', 'rendertimeout'):
+                timeout = int(conf.get('server', 'rendertimeout'))
+            self.mapfactory.renderpool = RenderPool(configpath, mapfile, fonts,
+                                                    int(conf.get('server', 'renderprocesses')),
+                                                    queuesize, maxrequests, timeout)
+            self.mapfactory.renderpool.warmup = warmup
 
     def __call__(self, environ, start_response):
         reqparams = {}
@@ -80,6 +98,47 @@ class WSGIApp:
             # if there is no baseurl in the config file try to guess a valid one
             onlineresource = 'http://%s%s%s?' % (environ['HTTP_HOST'], environ['SCRIPT_NAME'], environ['PATH_INFO'])
 
+        response = None
+        memkey = None
+        etag = None
+        rest = environ.get('PATH_INFO', '').startswith(RESTPREFIXES)
+        conditional = rest or reqparams.get('request') in CONDITIONAL_REQUESTS
+        request = rest and path_request(environ['PATH_INFO']) or reqparams.get('request')
+        if rest:
+            response = self.dispatchpath(environ)
+        elif self.mapfactory.memcache and reqparams.get('request') in ('GetMap', 'GetFeatureInfo', 'GetFeatureInfoBatch', 'GetTile'):
+            memkey = query_key(reqparams, environ.get('HTTP_USER_AGENT', ''))
+            response = self.mapfactory.memcache.get(memkey)
+        if not response:
+            response = self.dispatch(environ, reqparams, base, onlineresource, memkey)
+        compressor = self.mapfactory.compressor
+        encoding = compressor.encoding(response, environ.get('HTTP_ACCEPT_ENCODING'))
+        # the headers a 304 Not Modified response repeats
+        response_headers = []
+        if compressor.compressible(response.content_type):
+            response_headers.append(('Vary', 'Accept-Encoding'))
+        if conditional and response.conditional:
+            etag = entity_tag(response)
+            response_headers.append(('ETag', response.variant or variant_tag(etag, encoding)))
+            if response.modified is not None:
+                response_headers.append(('Last-Modified', http_date(response.modified)))
+        cachecontrol = cache_control(self.max_age, self.mapfactory, request, response)
+        if cachecontrol:
+            response_headers.append(('Cache-Control', cachecontrol))
+        # maps are revalidated before rendering them, other responses
+        # once they are known
+        if etag and (response.notmodified or not_modified(etag, environ.get('HTTP_IF_NONE_MATCH'), response.modified,
+                                                          environ.get('HTTP_IF_MODIFIED_SINCE'))):
+            start_response('304 Not Modified', response_headers)
+            return
+        content, encoding = compressor.compress(response, environ.get('HTTP_ACCEPT_ENCODING'))
+        response_headers[:0] = [('Content-Type', response.content_type),('Content-Length', str(len(content)))]
+        if encoding:
+            response_headers.insert(2, ('Content-Encoding', encoding))
+        start_response('200 OK', response_headers)
+        yield content
+
+    def dispatch(self, environ, reqparams, base, onlineresource, memkey=None):
         try:
             if not reqparams.has_key('request'):
                 raise OGCException('Missing request parameter.')
@@ -87,7 +146,7 @@ class WSGIApp:
             del reqparams['request']
             if request == 'GetCapabilities' and not reqparams.has_key('service'):
                 raise OGCException('Missing service parameter.')
-            if request in ['GetMap', 'GetFeatureInfo']:
+            if request in ['GetMap', 'GetFeatureInfo', 'GetFeatureInfoBatch']:
                 service = 'WMS'
             else:
                 try:
@@ -98,7 +157,7 @@ class WSGIApp:
             if reqparams.has_key('service'):
                 del reqparams['service']
             try:
-                ogcserver = do_import('ogcserver')
+                ogcserver = __import__('ogcserver.' + service)
             except:
                 raise OGCException('Unsupported service "%s".' % service)
             ServiceHandlerFactory = getattr(ogcserver, service).ServiceHandlerFactory
@@ -116,8 +175,13 @@ class WSGIApp:
             # stick the user agent in the request params
             # so that we can add ugly hacks for specific buggy clients
             ogcparams['HTTP_USER_AGENT'] = environ.get('HTTP_USER_AGENT', '')
+            # and the validators of the client's copy, for maps to be
+            # revalidated without rendering them
+            ogcparams.update(conditional_headers(environ))
 
             response = requesthandler(ogcparams)
+            if memkey and not response.notmodified:
+                self.mapfactory.memcache.put(memkey, response)
         except:
             version = reqparams.get('version', None)
             if not version:
@@ -129,11 +193,19 @@ class WSGIApp:
             else:
                 eh = ExceptionHandler111(self.debug,base,self.home_html)
             response = eh.getresponse(reqparams)
-        response_headers = [('Content-Type', response.content_type),('Content-Length', str(len(response.content)))]
-        if self.max_age:
-            response_headers.append(('Cache-Control', self.max_age))
-        start_response('200 OK', response_headers)
-        yield response.content
+        return response
+
+    def dispatchpath(self, environ):
+        """ Answer a RESTful WMTS or TMS request from its path. """
+        if self.conf.has_option_with_value('service', 'baseurl'):
+            resturl = self.conf.get('service', 'baseurl').rstrip('?')
+        else:
+            resturl = 'http://%s%s' % (environ['HTTP_HOST'], environ['SCRIPT_NAME'])
+        try:
+            return dispatch_path(self.conf, self.mapfactory, resturl, environ['PATH_INFO'], conditional_headers(environ))
+        except:
+            eh = ExceptionHandler111(self.debug)
+            return eh.getresponse({})
 
 
 #  PasteDeploy factories [kiorky kiorky@cryptelium.net]
@@ -161,7 +233,7 @@ class BasePasteWSGIApp(WSGIApp):
         else:
             self.debug=0
         if 'maxage' in kwargs:
-            self.max_age = 'max-age=%d' % kwargs.get('maxage')
+            self.max_age = 'max-age=%d' % int(kwargs.get('maxage'))
         else:
             self.max_age = None
 
@@ -179,6 +251,8 @@ class MapFilePasteWSGIApp(BasePasteWSGIApp):
         wms_factory = BaseWMSFactory(configpath)
         wms_factory.loadXML(mapfile)
         wms_factory.finalize()
+        wms_factory.configure(self.conf)
+        wms_factory.prepare_capabilities(self.conf)
         self.mapfactory = wms_factory
 
 class WMSFactoryPasteWSGIApp(BasePasteWSGIApp):
@@ -200,6 +274,8 @@ class WMSFactoryPasteWSGIApp(BasePasteWSGIApp):
             self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')(configpath)
         else:
             raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
+        self.mapfactory.configure(self.conf)
+        self.mapfactory.prepare_capabilities(self.conf)
 
 def ogcserver_base_factory(base, global_config, **local_config):
     """
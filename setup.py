@@ -37,6 +37,8 @@ if HAS_SETUPTOOLS:
         'paste.app_factory': ['mapfile=ogcserver.wsgi:ogcserver_map_factory',
                               'wms_factory=ogcserver.wsgi:ogcserver_wms_factory',
                              ],
+        'console_scripts': ['ogcserver-seed=ogcserver.seed:main',
+                            'ogcserver-invalidate=ogcserver.invalidate:main'],
     },
     install_requires = ['setuptools', 'PasteScript', 'WebOb', 'lxml', 'PIL']
     ))
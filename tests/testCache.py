@@ -0,0 +1,291 @@
+import nose
+
+def test_disk_cache():
+    import os
+    import shutil
+    import tempfile
+    from ogcserver.common import Response
+    from ogcserver.cache import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, 'fingerprint', maxbytes=600)
+        key = (('layer',), (), 'epsg:4326', (0.0, 0.0, 1.0, 1.0), 256, 256, 'image/png', 'FALSE', '', False)
+        assert cache.get(key) is None
+        cache.put(key, Response('image/png', 'x' * 300))
+        response = cache.get(key)
+        assert response.content_type == 'image/png'
+        assert response.content == 'x' * 300
+        # entries of another mapfile or configuration are not returned
+        assert DiskCache(directory, 'other').get(key) is None
+        # nor are corrupt ones
+        corrupt = key[:4] + (512,) + key[5:]
+        os.makedirs(os.path.dirname(cache.path(corrupt)))
+        open(cache.path(corrupt), 'wb').write('image/png\tgarbage\n')
+        assert cache.get(corrupt) is None
+        cache.delete(corrupt)
+
+        # make the first entry the least recently used one
+        os.utime(cache.path(key), (0, 0))
+        cache.put(key[:3] + ((1.0, 0.0, 2.0, 1.0),) + key[4:], Response('image/png', 'y' * 300))
+        cache.evict()
+        assert cache.get(key) is None
+        assert cache.stats()['evictions'] == 1
+    finally:
+        shutil.rmtree(directory)
+
+    return True
+
+def test_lfu_eviction():
+    import os
+    import shutil
+    import tempfile
+    from ogcserver.common import Response
+    from ogcserver.cache import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        key = (('layer',), (), 'epsg:4326', (0.0, 0.0, 1.0, 1.0), 256, 256, 'image/png', 'FALSE', '', False)
+        other = key[:3] + ((1.0, 0.0, 2.0, 1.0),) + key[4:]
+        # one process serves the entries, another evicts them
+        serving = DiskCache(directory, maxbytes=600, eviction='lfu')
+        evicting = DiskCache(directory, maxbytes=600, eviction='lfu')
+        serving.put(key, Response('image/png', 'x' * 300))
+        serving.put(other, Response('image/png', 'y' * 300))
+        # the less used entry is the more recent one
+        os.utime(serving.path(key), (0, 0))
+        for i in range(3):
+            serving.get(key)
+        serving.get(other)
+        assert evicting._hits(serving.path(key)) == 3
+        evicting.evict()
+        assert serving.get(other) is None
+        assert not os.path.exists(serving.path(other) + '.hits')
+        # the counts of the remaining entries are halved
+        assert evicting._hits(serving.path(key)) == 1
+        assert serving.get(key).content == 'x' * 300
+    finally:
+        shutil.rmtree(directory)
+
+    return True
+
+def test_disk_cache_maintenance():
+    import os
+    import shutil
+    import tempfile
+    from ogcserver.common import Response
+    from ogcserver.cache import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        key = (('layer',), (), 'epsg:4326', (0.0, 0.0, 1.0, 1.0), 256, 256, 'image/png', 'FALSE', '', False)
+        # a cache that cannot be written to does not fail the request
+        open(os.path.join(directory, 'file'), 'w').close()
+        DiskCache(os.path.join(directory, 'file'), maxbytes=600).put(key, Response('image/png', 'x' * 300))
+
+        walks = []
+        first = DiskCache(directory, maxbytes=600)
+        first.evict = lambda: walks.append(first)
+        second = DiskCache(directory, maxbytes=600)
+        second.evict = lambda: walks.append(second)
+        first.put(key, Response('image/png', 'x' * 300))
+        first.bytes = 700
+        first._maintain()
+        assert walks == [first]
+        # within the interval no process walks the entries again, they
+        # learn the size found by the last walk instead
+        first._maintain()
+        second._maintain()
+        assert walks == [first]
+        assert second.bytes == 700
+    finally:
+        shutil.rmtree(directory)
+
+    return True
+
+def test_memory_cache():
+    import time
+    from ogcserver.common import Compressor, Response
+    from ogcserver.cache import MemoryCache, query_key
+
+    cache = MemoryCache(100)
+    key = query_key({'request': 'GetMap', 'layers': 'world', 'bbox': '-180,-90,180,90'})
+    assert key == query_key({'bbox': '-180,-90,180,90', 'layers': 'world', 'request': 'GetMap'})
+    assert cache.get(key) is None
+    cache.put(key, Response('image/png', 'x' * 60))
+    assert cache.get(key).content == 'x' * 60
+    cache.put('other', Response('image/png', 'y' * 60))
+    # over budget, the least recently used response is dropped
+    assert cache.get(key) is None
+    stats = cache.stats()
+    assert stats['bytes'] == 60
+    assert stats['evictions'] == 1
+    assert stats['hitratio'] == 1.0 / 3
+
+    # the compressed copy of a response counts against the budget too
+    cache = MemoryCache(1000, compressor=Compressor(minsize=100))
+    xml = Response('text/xml', ''.join([str(i) for i in range(200)]))
+    cache.put(key, xml)
+    assert xml.gzipped
+    assert cache.stats()['bytes'] == len(xml.content) + len(xml.gzipped)
+    cache.delete(key)
+    assert cache.stats()['bytes'] == 0
+
+    # responses cached before an invalidation by another process are
+    # dropped, those cached after it are served
+    stamp = [0]
+    cache = MemoryCache(100, invalidated=lambda: stamp[0])
+    cache.put(key, Response('image/png', 'x'))
+    stamp[0] = time.time() + 1
+    assert cache.get(key) is None
+    assert cache.stats()['bytes'] == 0
+    stamp[0] = time.time() - 1
+    cache.put(key, Response('image/png', 'y'))
+    assert cache.get(key).content == 'y'
+
+    return True
+
+def test_mbtiles_cache():
+    import os
+    import shutil
+    import sqlite3
+    import tempfile
+    from ogcserver.common import Response
+    from ogcserver.cache import MBTilesCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = MBTilesCache(directory, 'fingerprint')
+        key = (('world',), (), 'epsg:900913', ('google', 3, 2, 5), 256, 256, 'image/png', 'TRUE', '', False)
+        assert cache.get(key) is None
+        cache.putmany([(key, Response('image/png', 'tile')),
+                       (key[:3] + (('google', 3, 3, 5),) + key[4:], Response('image/png', 'next'))])
+        response = cache.get(key)
+        assert response.content_type == 'image/png'
+        assert response.content == 'tile'
+        # requests not aligned to a grid are not cached
+        bboxkey = key[:3] + ((0.0, 0.0, 1.0, 1.0),) + key[4:]
+        cache.put(bboxkey, Response('image/png', 'map'))
+        assert cache.get(bboxkey) is None
+
+        filenames = os.listdir(directory)
+        assert len([f for f in filenames if f.endswith('.mbtiles')]) == 1
+        db = sqlite3.connect(os.path.join(directory, [f for f in filenames if f.endswith('.mbtiles')][0]))
+        assert db.execute('SELECT count(*) FROM tiles').fetchone()[0] == 2
+        assert dict(db.execute('SELECT name, value FROM metadata').fetchall())['format'] == 'png'
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    return True
+
+def test_invalidation():
+    from ogcserver.cache import Invalidation
+    from ogcserver.metatile import TileGrid
+
+    grid = TileGrid('test', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0))
+    selection = Invalidation(['roads', '__all__'], 'EPSG:900913', (-100.0, -100.0, 100.0, 100.0), [grid])
+    key = (('roads',), (), 'epsg:900913', (0.0, 0.0, 512.0, 512.0), 256, 256, 'image/png', 'FALSE', '', False)
+    assert selection.matches(key)
+    assert not selection.matches((('rivers',),) + key[1:])
+    assert not selection.matches(key[:3] + ((200.0, 0.0, 712.0, 512.0),) + key[4:])
+    # tiles are located through their grid
+    assert selection.matches(key[:3] + (('test', 2, 1, 1),) + key[4:])
+    assert not selection.matches(key[:3] + (('test', 2, 3, 3),) + key[4:])
+    assert selection.tilerange(grid, 2) == (1, 1, 2, 2)
+    assert Invalidation(['roads']).matches(key[:3] + ((200.0, 0.0, 712.0, 512.0),) + key[4:])
+
+    return True
+
+def test_ttl_and_invalidate():
+    import os
+    import time
+    import shutil
+    import sqlite3
+    import tempfile
+    from ogcserver.common import Response
+    from ogcserver.cache import DiskCache, MBTilesCache, MemoryCache, Invalidation, query_key
+
+    ttl = lambda layers: 'roads' in layers and 60 or None
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, ttl=ttl)
+        key = (('roads',), (), 'epsg:900913', (0.0, 0.0, 1.0, 1.0), 256, 256, 'image/png', 'FALSE', '', False)
+        other = (('rivers',),) + key[1:]
+        cache.put(key, Response('image/png', 'roads'))
+        cache.put(other, Response('image/png', 'rivers'))
+        assert cache.gc() == 0
+        assert cache.invalidated() == 0
+        assert cache.invalidate(Invalidation(['roads'])) == 1
+        assert cache.get(key) is None
+        # seen by every process, for their entity tags to change
+        assert DiskCache(directory).invalidated() > time.time() - 60
+        assert cache.get(other).content == 'rivers'
+        # age the entry past its ttl
+        cache.ttl = lambda layers: -1
+        cache.put(key, Response('image/png', 'roads'))
+        cache.stale = 60
+        assert cache.get(key).stale
+        assert not cache.get(other).stale
+        assert cache.gc() == 0
+        cache.stale = 0
+        assert cache.gc() == 1
+        assert cache.get(other).content == 'rivers'
+
+        tiles = MBTilesCache(os.path.join(directory, 'tiles'), ttl=ttl)
+        tilekey = key[:3] + (('test', 2, 1, 1),) + key[4:]
+        tiles.putmany([(tilekey, Response('image/png', 'a')),
+                       (key[:3] + (('test', 2, 3, 3),) + key[4:], Response('image/png', 'b'))])
+        assert tiles.get(tilekey).content == 'a'
+        assert tiles.gc() == 0
+        from ogcserver.metatile import TileGrid
+        grid = TileGrid('test', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0))
+        assert tiles.invalidate(Invalidation(['roads'], 'epsg:900913', (-100.0, -100.0, 100.0, 100.0), [grid])) == 1
+        assert tiles.get(tilekey) is None
+        assert tiles.get(key[:3] + (('test', 2, 3, 3),) + key[4:]).content == 'b'
+        assert tiles.invalidated() > time.time() - 60
+    finally:
+        shutil.rmtree(directory)
+
+    memcache = MemoryCache(100, ttl)
+    roads = query_key({'request': 'GetMap', 'layers': 'roads,rivers'})
+    rivers = query_key({'request': 'GetMap', 'layers': 'rivers'})
+    memcache.put(roads, Response('image/png', 'x'))
+    memcache.put(rivers, Response('image/png', 'y'))
+    assert memcache.expires.keys() == [roads]
+    assert memcache.invalidate(Invalidation(['roads'])) == 1
+    assert memcache.get(roads) is None
+    assert memcache.get(rivers).content == 'y'
+    # WMTS tiles name their layer in LAYER
+    tile = query_key({'request': 'GetTile', 'service': 'WMTS', 'layer': 'roads'})
+    memcache.put(tile, Response('image/png', 'z'))
+    assert tile in memcache.expires
+    assert memcache.invalidate(Invalidation(['roads'])) == 1
+    assert memcache.get(tile) is None
+
+    return True
+
+def test_capabilities_cache():
+    import gzip
+    from StringIO import StringIO
+    from ogcserver.common import Response
+    from ogcserver.cache import CapabilitiesCache
+
+    builds = []
+    def build():
+        builds.append(1)
+        return Response('text/xml', '<WMS_Capabilities/>' * 10)
+
+    cache = CapabilitiesCache(maxdocuments=2)
+    response = cache.get(('1.3.0', 'http://localhost/'), 1, build)
+    assert cache.get(('1.3.0', 'http://localhost/'), 1, build) is response
+    assert len(builds) == 1
+    assert gzip.GzipFile(fileobj=StringIO(response.gzipped)).read() == response.content
+    # a new generation of the factory builds the document again
+    assert cache.get(('1.3.0', 'http://localhost/'), 2, build) is not response
+    assert len(builds) == 2
+    cache.get(('1.1.1', 'http://localhost/'), 2, build)
+    cache.get(('1.1.1', 'http://otherhost/'), 2, build)
+    assert cache.stats() == {'documents': 1, 'hits': 1, 'builds': 4}
+
+    return True
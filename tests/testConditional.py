@@ -0,0 +1,155 @@
+import nose
+
+def test_not_modified():
+    from ogcserver.common import Response, entity_tag, not_modified
+
+    response = Response('image/png', 'map')
+    etag = entity_tag(response)
+    assert etag.startswith('"') and etag.endswith('"')
+    # the same content has the same tag in every process
+    assert etag == entity_tag(Response('image/png', 'map'))
+    assert response.etag == etag
+
+    assert not not_modified(etag)
+    assert not_modified(etag, etag)
+    assert not_modified(etag, '"other", W/%s' % etag)
+    assert not not_modified(etag, '"other"')
+    # the request is always processed to tell whether anything matches
+    assert not not_modified(etag, '*')
+
+    # the tag changes with the content, whatever changed it
+    assert entity_tag(Response('image/png', 'new map')) != etag
+
+    return True
+
+def test_if_modified_since():
+    from ogcserver.common import http_date, matching_tag, not_modified
+
+    etag = '"abc"'
+    assert not_modified(etag, None, 1000, http_date(1000))
+    assert not_modified(etag, None, 1000, http_date(2000))
+    assert not not_modified(etag, None, 2000, http_date(1000))
+    # unknown modification times and bad dates are never matched
+    assert not not_modified(etag, None, None, http_date(1000))
+    assert not not_modified(etag, None, 1000, 'yesterday')
+    # If-None-Match wins over If-Modified-Since
+    assert not not_modified(etag, '"other"', 1000, http_date(2000))
+
+    assert matching_tag(etag, '"other", W/"abc-gzip"') == '"abc-gzip"'
+    assert matching_tag(etag, '"other"') is None
+
+    return True
+
+def test_validated_before_rendering():
+    from ogcserver.common import Response, WMSBaseServiceHandler, http_date, variant_tag
+    from ogcserver.WMS import BaseWMSFactory
+
+    rendered = []
+    def render(params):
+        rendered.append(params)
+        return Response('image/png', 'map %d' % len(rendered))
+
+    handler = WMSBaseServiceHandler()
+    handler.mapfactory = BaseWMSFactory()
+    handler.mapfactory.configtime = 1000
+    handler._renderMap = render
+    request = {'layers': ['roads'], 'styles': [''], 'crs': 'epsg:4326', 'bbox': [0, 0, 10, 10],
+               'width': 256, 'height': 256, 'format': 'image/png'}
+    def getmap(**headers):
+        params = dict(request)
+        params.update(headers)
+        return handler.GetMap(params)
+
+    response = getmap()
+    assert len(rendered) == 1 and response.modified == 1000
+    etag = response.etag
+    # known from the request, the fingerprint and the times alone
+    assert (etag, 1000) == handler.mapfactory.validators(handler._requestKey(request), ['roads'])
+
+    # conditional GETs are answered without rendering
+    response = getmap(HTTP_IF_NONE_MATCH=etag)
+    assert response.notmodified and response.content == '' and response.etag == etag
+    response = getmap(HTTP_IF_NONE_MATCH=variant_tag(etag, 'gzip'))
+    assert response.notmodified and response.variant == variant_tag(etag, 'gzip')
+    assert getmap(HTTP_IF_MODIFIED_SINCE=http_date(1000)).notmodified
+    assert len(rendered) == 1
+
+    # new data changes the tag and the modification time
+    handler.mapfactory.mtimes['roads'] = 2000
+    response = getmap(HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=http_date(1000))
+    assert not response.notmodified and response.etag != etag and response.modified == 2000
+    assert len(rendered) == 2
+
+    # and so do invalidations and the start of a new ttl period
+    etag = response.etag
+    handler.mapfactory.invalidated['roads'] = 3000
+    response = getmap()
+    assert response.etag != etag and response.modified == 3000
+    handler.mapfactory.ttls['roads'] = 60
+    assert handler.mapfactory.lastmodified(['roads']) > 3000
+
+    # the validators are set on a copy, the response shared with other
+    # requests and the caches keeps its own
+    shared = Response('image/png', 'map')
+    validated = handler._validated(shared, '"abc"', 4000)
+    assert validated is not shared and validated.content is shared.content
+    assert (validated.etag, validated.modified) == ('"abc"', 4000)
+    assert shared.etag is None and shared.modified is None
+
+    return True
+
+def test_compression():
+    import zlib
+    import gzip
+    from StringIO import StringIO
+    from ogcserver.common import Compressor, Response, accepted_codings, not_modified, variant_tag
+
+    assert accepted_codings('gzip;q=0, deflate') == set(['deflate'])
+    assert accepted_codings(' GZIP ;q=0.5,identity') == set(['gzip', 'identity'])
+    assert accepted_codings(None) == set()
+
+    compressor = Compressor(level=6, minsize=100)
+    xml = Response('application/vnd.ogc.wms_xml', '<Layer/>' * 100)
+    content, encoding = compressor.compress(xml, 'deflate, gzip')
+    assert encoding == 'gzip'
+    assert gzip.GzipFile(fileobj=StringIO(content)).read() == xml.content
+    # kept with the response for the next request
+    assert compressor.compress(xml, 'gzip')[0] is content
+    content, encoding = compressor.compress(xml, 'deflate')
+    assert encoding == 'deflate' and zlib.decompress(content) == xml.content
+    assert compressor.compress(xml, 'br') == (xml.content, None)
+    # a coding refused by name stays refused where * is accepted
+    assert compressor.encoding(xml, 'gzip;q=0, *') == 'deflate'
+    assert compressor.encoding(xml, 'gzip;q=0, deflate;q=0, *') is None
+    assert compressor.encoding(xml, '*') == 'gzip'
+    # images and small responses are sent as they are
+    assert compressor.compress(Response('image/png', 'x' * 1000), 'gzip') == ('x' * 1000, None)
+    assert compressor.compress(Response('text/plain', 'x' * 10), 'gzip') == ('x' * 10, None)
+    assert not compressor.compressible('image/png')
+    assert not Compressor(level=0).compressible('text/xml')
+
+    etag = '"abc"'
+    assert variant_tag(etag, None) == etag
+    assert variant_tag(etag, 'gzip') == '"abc-gzip"'
+    assert not_modified(etag, variant_tag(etag, 'gzip'))
+
+    return True
+
+def test_cache_control():
+    from ogcserver.common import Response, cache_control
+
+    class Factory:
+        stale = 600
+
+    response = Response('image/png', 'map')
+    assert cache_control('max-age=60', Factory(), 'GetMap', response) == 'max-age=60, stale-while-revalidate=600'
+    assert cache_control(None, Factory(), 'GetTile', response) == 'stale-while-revalidate=600'
+    # only maps and tiles are served stale, never exceptions
+    assert cache_control('max-age=60', Factory(), 'GetCapabilities', response) == 'max-age=60'
+    response.conditional = False
+    assert cache_control('max-age=60', Factory(), 'GetMap', response) == 'max-age=60'
+    # nor without a response cache refreshing them
+    Factory.stale = 0
+    assert cache_control(None, Factory(), 'GetMap', Response('image/png', 'map')) is None
+
+    return True
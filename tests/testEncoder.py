@@ -0,0 +1,186 @@
+import nose
+import struct
+
+class FakeImage:
+
+    def __init__(self, pixels, width=None, sizes=None):
+        self.raw = ''.join([struct.pack('BBBB', *pixel) for pixel in pixels])
+        self.size = (width or len(pixels), len(pixels) // (width or len(pixels)))
+        # bytes added to the encodings, by mapnik format
+        self.sizes = sizes or {}
+        self.encoded = 0
+        self.copied = 0
+
+    def width(self):
+        return self.size[0]
+
+    def height(self):
+        return self.size[1]
+
+    def view(self, x, y, width, height):
+        offset = (y * self.size[0] + x) * 4
+        return FakeImage([struct.unpack('BBBB', self.raw[offset:offset + 4])])
+
+    def tostring(self, format=None):
+        if format is None:
+            self.copied += 1
+            return self.raw
+        self.encoded += 1
+        padding = '.' * self.sizes.get(format.split(':')[0], 0)
+        if format.startswith('jpeg'):
+            return '\xff\xd8' + format + padding
+        return '\x89PNG' + format + padding
+
+def test_encoder_formats():
+    from ogcserver.encoder import Encoder, content_type
+
+    encoder = Encoder()
+    # without options the formats are encoded as they always were
+    assert encoder.format('image/png') == 'png'
+    assert encoder.format('image/png8') == 'png256'
+    assert encoder.format('image/jpeg') == 'jpeg'
+    assert encoder.format('image/webp') == 'webp'
+    assert content_type('image/png8') == 'image/png'
+    # WebP is only offered where the mapnik in use encodes it
+    from ogcserver.encoder import WEBP, _encodes
+    assert encoder.webp == WEBP
+    assert not _encodes('nosuchformat')
+
+    encoder = Encoder({'jpegquality': 75, 'zlevel': 9, 'zstrategy': 'filtered'},
+                      {'imagery': {'jpegquality': 90},
+                       'roads': {'pngcolors': 64, 'pngquantizer': 'hextree', 'jpegquality': 60},
+                       'water': {'pngcolors': 16, 'zlevel': 6}})
+    assert encoder.format('image/png', ['other']) == 'png:z=9:s=filtered'
+    assert encoder.format('image/png8', ['roads']) == 'png256:c=64:m=h:z=9:s=filtered'
+    assert encoder.format('image/jpeg', ['other']) == 'jpeg75'
+    # the highest quality of the requested layers wins
+    assert encoder.format('image/jpeg', ['roads', 'imagery']) == 'jpeg90'
+    assert encoder.format('image/png8', ['water', 'roads']) == 'png256:c=64:m=h:z=6:s=filtered'
+    assert encoder.format('image/jpeg', ['__all__']) == 'jpeg90'
+
+    return True
+
+def test_load_encoder():
+    from ogcserver.configparser import SafeConfigParser
+    from ogcserver.encoder import load_encoder
+    from ogcserver.exceptions import ServerConfigurationError
+
+    conf = SafeConfigParser()
+    conf.add_section('server')
+    conf.set('server', 'webpquality', '80')
+    conf.add_section('layer_roads')
+    conf.set('layer_roads', 'pngcolors', '32')
+    encoder = load_encoder(conf)
+    assert encoder.format('image/webp', ['roads']) == 'webp:quality=80'
+    assert encoder.format('image/png8', ['roads']) == 'png256:c=32'
+
+    conf.set('layer_roads', 'pngquantizer', 'median')
+    try:
+        load_encoder(conf)
+    except ServerConfigurationError:
+        pass
+    else:
+        raise AssertionError('invalid encoder options must be refused')
+
+    return True
+
+def test_auto_format():
+    import random
+    from ogcserver.encoder import Encoder, sniff_content_type
+
+    rand = random.Random(1)
+    pixels = [(0, 0, 255, 255)] * 200 + [(0, 0, 0, 0)] * 56
+    flat = FakeImage(pixels, sizes={'png': 100, 'png256': 10})
+    photo = FakeImage([(rand.randrange(256), rand.randrange(256), rand.randrange(256), 255) for i in range(4096)],
+                      sizes={'png': 100})
+    # as many colors, but a smooth gradient PNG compresses better
+    gradient = FakeImage([(i % 256, i // 256, 0, 255) for i in range(4096)], sizes={'jpeg': 100})
+    overlay = FakeImage([(i % 256, i // 256, 0, i % 200) for i in range(4096)])
+    # more colors than a palette holds, but too few to be photographic
+    shaded = FakeImage([(i % 256, i // 256, 0, 255) for i in range(1024)], 32, sizes={'jpeg': -100})
+    # without partial transparency, but with too many colors as well
+    stencil = FakeImage([(i % 256, i // 256, 0, (i % 2) * 255) for i in range(4096)])
+    # a single pixel of a 257th color keeps the map out of the palette
+    speck = FakeImage([(i, 0, 0, 255) for i in range(256)] * 300 + [(0, 0, 1, 255)], sizes={'png': 100})
+
+    encoder = Encoder(auto=True)
+    assert encoder.encode(flat, 'image/auto') == ('image/png', '\x89PNGpng256' + '.' * 10, None)
+    assert flat.encoded == 2
+    # the smallest encoding wins, even where the palette would do
+    assert encoder.encode(FakeImage(pixels, sizes={'png256': 100}), 'image/auto') == ('image/png', '\x89PNGpng', None)
+    assert encoder.encode(photo, 'image/auto') == ('image/jpeg', '\xff\xd8jpeg', None)
+    assert encoder.encode(gradient, 'image/auto') == ('image/png', '\x89PNGpng', None)
+    assert encoder.encode(overlay, 'image/auto') == ('image/png', '\x89PNGpng', None)
+    assert overlay.encoded == 1
+    assert encoder.encode(shaded, 'image/auto') == ('image/png', '\x89PNGpng', None)
+    assert encoder.encode(stencil, 'image/auto') == ('image/png', '\x89PNGpng', None)
+    assert encoder.encode(speck, 'image/auto') == ('image/png', '\x89PNGpng' + '.' * 100, None)
+    # a smaller palette holds fewer colors
+    tricolor = FakeImage(pixels[:-1] + [(255, 0, 0, 255)], sizes={'png': 100, 'png256': 10})
+    assert Encoder({'pngcolors': 2}, auto=True).encode(tricolor, 'image/auto')[1] == '\x89PNGpng' + '.' * 100
+    assert encoder.encode(photo, 'image/png') == ('image/png', '\x89PNGpng' + '.' * 100, None)
+    stats = encoder.stats()['auto']
+    assert stats['image/jpeg'] == {'count': 1, 'bytes': 6, 'sizes': {8: 1}}
+    assert stats['image/png8']['count'] == 1
+    assert stats['image/png']['count'] == 6
+
+    assert sniff_content_type('\xff\xd8jpeg') == 'image/jpeg'
+    assert sniff_content_type('RIFF\0\0\0\0WEBPVP8 ') == 'image/webp'
+
+    return True
+
+def test_blank_maps():
+    import os
+    import shutil
+    import tempfile
+    from ogcserver.common import Response
+    from ogcserver.cache import DiskCache
+    from ogcserver.encoder import Encoder
+
+    encoder = Encoder()
+    first = FakeImage([(0, 0, 0, 0)] * 64, 8)
+    second = FakeImage([(0, 0, 0, 0)] * 64, 8)
+    content_type, content, blank = encoder.encode(first, 'image/png')
+    assert blank
+    # the second blank map is not encoded again and shares the content
+    again = encoder.encode(second, 'image/png')
+    assert again[1] is content and again[2] == blank
+    assert second.encoded == 0
+    # other sizes, formats and colors are other blank maps
+    assert encoder.encode(FakeImage([(0, 0, 0, 0)] * 64, 16), 'image/png')[2] != blank
+    assert encoder.encode(second, 'image/png8')[2] != blank
+    assert encoder.encode(FakeImage([(1, 0, 0, 255)] * 64, 8), 'image/png')[2] != blank
+    assert encoder.encode(FakeImage([(0, 0, 0, 0)] * 63 + [(1, 0, 0, 255)], 8), 'image/png')[2] is None
+    # maps of which a few pixels already differ are not copied to be checked
+    third = FakeImage([(0, 0, 0, 0)] * 32 + [(1, 0, 0, 255)] * 32, 8)
+    assert encoder.encode(third, 'image/png')[2] is None
+    assert third.copied == 0
+    assert encoder.stats()['blankhits'] == 1
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory)
+        key = (('world',), (), 'epsg:4326', (0.0, 0.0, 1.0, 1.0), 8, 8, 'image/png', 'TRUE', '', False)
+        response = Response(content_type, content)
+        response.blank = blank
+        cache.put(key, response)
+        cache.put(key[:3] + ((1.0, 0.0, 2.0, 1.0),) + key[4:], response)
+        # the entries only refer to the content
+        assert open(cache.path(key), 'rb').read().endswith('\t%s\n' % blank)
+        cached = DiskCache(directory).get(key)
+        assert cached.content == content
+        assert cached.blank == blank
+
+        # the content is removed with the last entry referring to it
+        blankpath = cache._blankpath(blank)
+        os.utime(blankpath, (0, 0))
+        cache.delete(key)
+        cache.gc()
+        assert os.path.exists(blankpath)
+        cache.delete(key[:3] + ((1.0, 0.0, 2.0, 1.0),) + key[4:])
+        cache.gc()
+        assert not os.path.exists(blankpath)
+    finally:
+        shutil.rmtree(directory)
+
+    return True
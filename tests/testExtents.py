@@ -0,0 +1,84 @@
+import nose
+
+class Envelope:
+
+    def __init__(self, minx, miny, maxx, maxy):
+        self.minx, self.miny, self.maxx, self.maxy = minx, miny, maxx, maxy
+
+class Layer:
+
+    def __init__(self, name, extent, srs='+init=epsg:4326'):
+        self.name = name
+        self.srs = srs
+        self.extent = extent
+        self.wmsdefaultstyle = 'default'
+
+    def envelope(self):
+        if not self.extent:
+            raise RuntimeError('no extent')
+        return Envelope(*self.extent)
+
+def test_extent_index():
+    from ogcserver.extents import ExtentIndex
+
+    layers = {'europe': Layer('europe', (-10.0, 35.0, 30.0, 70.0)),
+              'africa': Layer('africa', (-20.0, -35.0, 50.0, 35.0)),
+              'ocean': Layer('ocean', None)}
+    index = ExtentIndex(layers, ['epsg:4326'])
+    assert index.intersecting('epsg:4326', (0.0, 40.0, 10.0, 50.0)) == set(['europe', 'ocean'])
+    assert index.intersecting('epsg:4326', (0.0, 30.0, 10.0, 40.0)) == set(['europe', 'africa', 'ocean'])
+    assert index.intersecting('epsg:4326', (100.0, 0.0, 110.0, 10.0)) == set(['ocean'])
+    assert index.intersecting('epsg:900913', (0.0, 0.0, 1.0, 1.0)) is None
+
+    return True
+
+def test_lazy_extents():
+    from ogcserver.extents import ExtentIndex
+
+    calls = []
+    class Counted(Layer):
+        def envelope(self):
+            calls.append(self.name)
+            return Layer.envelope(self)
+
+    index = ExtentIndex({'europe': Counted('europe', (-10.0, 35.0, 30.0, 70.0))}, ['epsg:4326', 'epsg:3857'])
+    # the datasources are left alone until a request needs an extent
+    assert calls == [] and index.extents == {}
+    assert index.indexed('epsg:4326') == {'europe': (-10.0, 35.0, 30.0, 70.0)}
+    assert index.extents.keys() == ['epsg:4326']
+    assert index.indexed('epsg:900913') is None
+    assert index.intersecting('epsg:4326', (0.0, 40.0, 10.0, 50.0)) == set(['europe'])
+    assert calls == ['europe']
+
+    return True
+
+def test_visible_layers():
+    from ogcserver.common import CRS, WMSBaseServiceHandler
+    from ogcserver.extents import ExtentIndex
+
+    europe = Layer('europe', (-10.0, 35.0, 30.0, 70.0))
+    africa = Layer('africa', (-20.0, -35.0, 50.0, 35.0))
+
+    class Factory:
+        layers = {'europe': europe, 'africa': africa}
+        meta_layers = {}
+        styles = {'default': None}
+        aggregatestyles = {}
+        map_attributes = {'buffer_size': 64}
+        extents = ExtentIndex({'europe': europe}, ['epsg:4326'])
+        scales = None
+
+    handler = WMSBaseServiceHandler()
+    handler.mapfactory = Factory()
+    handler.allowedepsgcodes = ['epsg:4326']
+    params = {'crs': CRS('epsg', 4326), 'layers': ['europe', 'africa'], 'styles': [],
+              'bbox': [100.0, 0.0, 110.0, 10.0], 'width': 256, 'height': 256}
+    # africa is not indexed and always drawn
+    assert [layer for layer, styles in handler._visibleLayers(params)] == [africa]
+    # europe is drawn when its data is within buffer_size pixels
+    params['bbox'] = [-10.0, 71.0, 0.0, 81.0]
+    assert [layer for layer, styles in handler._visibleLayers(params)] == [europe, africa]
+    params['bbox'] = [-10.0, 75.0, 0.0, 85.0]
+    assert [layer for layer, styles in handler._visibleLayers(params)] == [africa]
+
+    return True
@@ -1,5 +1,16 @@
 import nose
 
+class Featureset:
+    """ A mapnik featureset, read with next until it is exhausted. """
+
+    def __init__(self, features):
+        self.features = list(features)
+
+    def next(self):
+        if not self.features:
+            raise StopIteration
+        return self.features.pop(0)
+
 def test_encoding():
     import os
     from ogcserver.configparser import SafeConfigParser
@@ -38,3 +49,148 @@ def test_encoding():
 
     return True
  
+
+def test_feature_info_writers():
+    import json
+    from ogcserver.common import FEATURE_INFO_WRITERS, iter_features, reproject_geometry
+
+    # only the requested number of features is read
+    featureset = Featureset(['a', 'b', 'c'])
+    assert list(iter_features(featureset, 2)) == ['a', 'b']
+    assert featureset.features == ['c']
+    assert list(iter_features(Featureset(['a', None, 'b']))) == ['a']
+
+    def write(format, geometry=None):
+        writer = FEATURE_INFO_WRITERS[format]()
+        writer.addlayer('roads')
+        writer.addfeature(geometry)
+        writer.addattribute('name', u'R\xfcbenweg')
+        writer.addattribute('lanes', 2)
+        writer.addfeature(geometry)
+        writer.addattribute('name', 'A & B')
+        writer.addlayer('rivers')
+        writer.addfeature(geometry)
+        return str(writer)
+
+    assert write('text/plain') == '\n[roads]\nname=R\xc3\xbcbenweg\nlanes=2\nname=A & B\n\n[rivers]\n'
+    assert write('text/xml') == ('<?xml version="1.0"?>\n<resultset><layer name="roads">'
+                                 '<feature><attribute><name>name</name><value>R\xc3\xbcbenweg</value></attribute>'
+                                 '<attribute><name>lanes</name><value>2</value></attribute></feature>'
+                                 '<feature><attribute><name>name</name><value>A &amp; B</value></attribute></feature>'
+                                 '</layer><layer name="rivers"><feature></feature></layer></resultset>')
+    assert json.loads(write('application/json')) == {'layers': [
+        {'name': 'roads', 'features': [{'name': u'R\xfcbenweg', 'lanes': 2}, {'name': 'A & B'}]},
+        {'name': 'rivers', 'features': [{}]}]}
+    point = {'type': 'Point', 'coordinates': [1.0, 2.0]}
+    collection = json.loads(write('application/geo+json', point))
+    assert collection['type'] == 'FeatureCollection'
+    assert [feature['layer'] for feature in collection['features']] == ['roads', 'roads', 'rivers']
+    assert collection['features'][0]['geometry'] == point
+    assert collection['features'][0]['properties'] == {'name': u'R\xfcbenweg', 'lanes': 2}
+    assert json.loads(str(FEATURE_INFO_WRITERS['application/geo+json']())) == {'type': 'FeatureCollection', 'features': []}
+
+    # geometries are written in WGS84
+    geometry = reproject_geometry({'type': 'GeometryCollection', 'geometries': [
+        {'type': 'LineString', 'coordinates': [[0, 0], [20037508.342789244, 0]]},
+        {'type': 'Point', 'coordinates': [0, 0]}]}, '+init=epsg:900913')
+    assert [[round(x, 6), round(y, 6)] for x, y in geometry['geometries'][0]['coordinates']] == [[0, 0], [180, 0]]
+    assert geometry['geometries'][1]['coordinates'] == [0, 0]
+
+    return True
+
+def test_query_context():
+    from ogcserver.common import QueryContext, hit_test
+
+    # the BBOX is grown to the aspect ratio of the map, around its center
+    context = QueryContext('epsg:4326', (0.0, 0.0, 10.0, 10.0), 200, 100)
+    assert context.extent == (-5.0, 0.0, 15.0, 10.0)
+    assert context.point(0, 0) == (-5.0, 10.0)
+    assert context.point(100, 50) == (5.0, 5.0)
+    assert round(context.tolerance, 9) == 0.3
+
+    point = {'type': 'Point', 'coordinates': [5.0, 5.0]}
+    assert hit_test(point, 5.2, 5.0, 0.3)
+    assert not hit_test(point, 5.4, 5.0, 0.3)
+    line = {'type': 'MultiLineString', 'coordinates': [[[0.0, 0.0], [10.0, 0.0]], [[0.0, 5.0], [10.0, 5.0]]]}
+    assert hit_test(line, 3.0, 5.1, 0.3)
+    assert not hit_test(line, 3.0, 2.5, 0.3)
+    polygon = {'type': 'Polygon', 'coordinates': [[[0.0, 0.0], [10.0, 0.0], [10.0, 10.0], [0.0, 10.0], [0.0, 0.0]],
+                                                  [[4.0, 4.0], [6.0, 4.0], [6.0, 6.0], [4.0, 6.0], [4.0, 4.0]]]}
+    assert hit_test(polygon, 2.0, 2.0, 0.3)
+    # in the hole
+    assert not hit_test(polygon, 5.0, 5.0, 0.3)
+    assert hit_test({'type': 'GeometryCollection', 'geometries': [point, polygon]}, 5.0, 5.0, 0.3)
+
+    class Datasource:
+        def features_at_point(self, coord, tolerance):
+            return Featureset(['a', 'b', 'c'])
+
+    class Layer:
+        name = 'points'
+        srs = '+init=epsg:4326'
+        datasource = Datasource()
+
+    assert list(context.query(Layer(), 5.0, 5.0, 2)) == ['a', 'b']
+
+    return True
+
+def test_feature_info_batch():
+    import os
+    import json
+    from ogcserver.configparser import SafeConfigParser
+    from ogcserver.wms111 import ServiceHandler as ServiceHandler111
+    from ogcserver.wms130 import ServiceHandler as ServiceHandler130
+
+    class Datasource:
+        def __init__(self, features):
+            self.features = features
+        def features_at_point(self, coord, tolerance):
+            # the features within tolerance of x, ignoring y
+            return Featureset([[('name', name)] for name, x in self.features if abs(x - coord.x) <= tolerance])
+
+    class Layer:
+        srs = '+init=epsg:4326'
+        queryable = True
+        def __init__(self, name, features):
+            self.name = name
+            self.datasource = Datasource(features)
+
+    class Factory:
+        layers = {'roads': Layer('roads', [('A1', 1.0), ('A2', 2.0)]),
+                  'rivers': Layer('rivers', [('Rhine', 2.0)])}
+        meta_layers = {}
+        queryindexes = {}
+
+    base_path, tail = os.path.split(__file__)
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+    handler = ServiceHandler111(conf, Factory(), 'localhost')
+    params = handler.processParameters('GetFeatureInfoBatch', {
+        'layers': 'roads,rivers', 'query_layers': 'roads,rivers', 'srs': 'EPSG:4326',
+        'bbox': '0,0,10,10', 'width': '100', 'height': '100', 'info_format': 'application/json',
+        'pixels': '10,50;20,50;55,50'})
+    result = json.loads(handler.GetFeatureInfoBatch(params).content)['results']
+    assert [r['point'] for r in result] == [[1.0, 5.0], [2.0, 5.0], [5.5, 5.0]]
+    assert result[0]['pixel'] == [10, 50]
+    assert result[0]['layers'] == [{'name': 'roads', 'features': [{'name': 'A1'}]}]
+    assert result[1]['layers'] == [{'name': 'roads', 'features': [{'name': 'A2'}]},
+                                   {'name': 'rivers', 'features': [{'name': 'Rhine'}]}]
+    assert result[2]['layers'] == []
+
+    params = handler.processParameters('GetFeatureInfoBatch', {
+        'layers': 'roads', 'query_layers': 'roads', 'srs': 'EPSG:4326', 'bbox': '0,0,10,10',
+        'width': '100', 'height': '100', 'info_format': 'text/xml', 'points': '1,5'})
+    assert handler.GetFeatureInfoBatch(params).content == (
+        '<?xml version="1.0"?>\n<resultsets><resultset x="1.0" y="5.0"><layer name="roads"><feature>'
+        '<attribute><name>name</name><value>A1</value></attribute></feature></layer></resultset></resultsets>')
+
+    # WMS 1.3.0 takes and returns the points of EPSG:4326 as latitude, longitude
+    handler = ServiceHandler130(conf, Factory(), 'localhost')
+    params = handler.processParameters('GetFeatureInfoBatch', {
+        'layers': 'roads', 'query_layers': 'roads', 'crs': 'EPSG:4326', 'bbox': '0,0,10,10',
+        'width': '100', 'height': '100', 'info_format': 'application/json', 'points': '5,2;5,1'})
+    result = json.loads(handler.GetFeatureInfoBatch(params).content)['results']
+    assert [r['point'] for r in result] == [[5.0, 2.0], [5.0, 1.0]]
+    assert [r['layers'][0]['features'] for r in result] == [[{'name': 'A2'}], [{'name': 'A1'}]]
+
+    return True
@@ -0,0 +1,35 @@
+import nose
+
+def test_checkout_checkin():
+    from ogcserver.mappool import MapPool
+
+    pool = MapPool(maxsize=2)
+    assert pool.checkout('a') is None
+    pool.checkin('a', 'map_a')
+    assert pool.checkout('a') == 'map_a'
+    # a checked out map is not handed out twice
+    assert pool.checkout('a') is None
+    stats = pool.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+
+    return True
+
+def test_lru_eviction():
+    from ogcserver.mappool import MapPool
+
+    pool = MapPool(maxsize=3)
+    pool.checkin('a', 'map_a')
+    pool.checkin('b', 'map_b')
+    pool.checkin('a', 'map_a2')
+    # 'b' is now the least recently used key
+    pool.checkin('c', 'map_c')
+    assert pool.checkout('b') is None
+    assert pool.checkout('c') == 'map_c'
+    assert pool.stats()['evictions'] == 1
+
+    pool = MapPool(maxsize=0)
+    pool.checkin('a', 'map_a')
+    assert pool.checkout('a') is None
+
+    return True
@@ -0,0 +1,200 @@
+import nose
+
+def test_grid_match():
+    from ogcserver.metatile import TileGrid
+
+    grid = TileGrid('test', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0), 256, (2, 2))
+    assert grid.size(0) == (1, 1)
+    assert grid.size(2) == (4, 4)
+    assert grid.match('epsg:900913', [-1024.0, -1024.0, 1024.0, 1024.0], 256, 256) == (0, 0, 0)
+    assert grid.match('epsg:900913', [0.0, -512.0, 512.0, 0.0], 256, 256) == (2, 2, 1)
+    # not aligned, wrong size or wrong crs
+    assert grid.match('epsg:900913', [1.0, -512.0, 513.0, 0.0], 256, 256) is None
+    assert grid.match('epsg:900913', [0.0, -512.0, 512.0, 0.0], 512, 512) is None
+    assert grid.match('epsg:4326', [0.0, -512.0, 512.0, 0.0], 256, 256) is None
+
+    assert grid.metatilefor(2, 3, 1) == (2, 0, 2, 2)
+    assert grid.tilebbox(2, 2, 0, 2, 2) == [0.0, -1024.0, 1024.0, 0.0]
+
+    return True
+
+def test_load_grids():
+    from StringIO import StringIO
+    from ogcserver.configparser import SafeConfigParser
+    from ogcserver.metatile import load_grids
+
+    conf = SafeConfigParser()
+    conf.readfp(StringIO('[grid_test]\ncrs=EPSG:900913\nbbox=-1024,-1024,1024,1024\nlevels=3\nmetatile=4\n'))
+    grids = load_grids(conf)
+    assert len(grids) == 1
+    assert grids[0].name == 'test'
+    assert grids[0].resolutions == (8.0, 4.0, 2.0)
+    assert grids[0].metatile == (4, 4)
+
+    return True
+
+def test_coalesced_metatile():
+    import time
+    import threading
+    from ogcserver.metatile import MetaTiler, TileGrid
+    from ogcserver.singleflight import SingleFlight
+
+    rendering = threading.Event()
+    proceed = threading.Event()
+
+    class Cache:
+        stored = []
+
+        def putmany(self, items):
+            self.stored.append(len(items))
+
+        def invalidated(self):
+            return 0
+
+    class Factory:
+        singleflight = SingleFlight()
+        cache = Cache()
+
+        def _ttl(self, layernames):
+            return None
+
+    class Handler:
+        mapfactory = Factory()
+
+        def _requestKey(self, params, bbox=None):
+            return (tuple(params['layers']), bbox)
+
+        def _reversedAxes(self, params):
+            return False
+
+        def _dispatch(self, methodname, params, tilesize, cols, rows):
+            rendering.set()
+            proceed.wait()
+            return dict([((dx, dy), (dx, dy)) for dx in range(cols) for dy in range(rows)])
+
+    grid = TileGrid('test', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0), 256, (2, 2))
+    tiler = MetaTiler([grid])
+    handler = Handler()
+    params = {'layers': ['roads']}
+    tiles = {}
+    def get(col, row):
+        tiles[(col, row)] = tiler.gettile(handler, params, (grid, 2, col, row))
+    first = threading.Thread(target=get, args=(2, 0))
+    first.start()
+    rendering.wait()
+    second = threading.Thread(target=get, args=(3, 1))
+    second.start()
+    while not Factory.singleflight.coalesced:
+        time.sleep(0.01)
+    proceed.set()
+    first.join()
+    second.join()
+    assert tiles == {(2, 0): (0, 0), (3, 1): (1, 1)}
+    # the waiting request neither counts a render nor stores the tiles again
+    assert tiler.renders == 1
+    assert Cache.stored == [4]
+
+    return True
+
+def test_reversed_axes():
+    from ogcserver.common import WMSBaseServiceHandler
+    from ogcserver.metatile import MetaTiler, TileGrid
+
+    grid = TileGrid('test', 'epsg:4326', (-180.0, -90.0, 180.0, 90.0), (0.703125, 0.3515625), 256, (2, 1))
+
+    class Factory:
+        metatiler = MetaTiler([grid])
+        singleflight = None
+        cache = None
+
+        def _ttl(self, layernames):
+            return None
+
+    rendered = []
+    class Handler(WMSBaseServiceHandler):
+        mapfactory = Factory()
+
+        def _reversedAxes(self, params):
+            return True
+
+        def _checkFormat(self, params):
+            pass
+
+        def _map(self, params, match):
+            return match
+
+        def _dispatch(self, methodname, params, tilesize, cols, rows):
+            rendered.append(params['bbox'])
+            return dict([((dx, dy), (dx, dy)) for dx in range(cols) for dy in range(rows)])
+
+    handler = Handler()
+    # a WMS 1.3.0 request in EPSG:4326 lists latitudes first
+    params = {'layers': ['roads'], 'crs': 'epsg:4326', 'bbox': [0.0, 0.0, 90.0, 90.0], 'width': 256, 'height': 256,
+              'format': 'image/png'}
+    match = handler.GetMap(params)
+    assert match[1:] == (1, 2, 1)
+    # the metatile is rendered in the axis order of the request
+    assert Factory.metatiler.gettile(handler, params, match) == (0, 0)
+    assert rendered == [[0.0, 0.0, 90.0, 180.0]]
+    # tiles are keyed by their address, whatever the axis order
+    assert handler._requestKey(params, ('test', 1, 2, 1))[-1] is False
+    assert handler._requestKey(params)[-1] is True
+
+    return True
+
+def test_tile_store_expiry():
+    import time
+    import shutil
+    import tempfile
+    from ogcserver.cache import DiskCache, Invalidation
+    from ogcserver.metatile import MetaTiler, TileGrid
+
+    grid = TileGrid('test', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0), 256, (2, 2))
+    directory = tempfile.mkdtemp()
+    try:
+        class Factory:
+            singleflight = None
+            cache = DiskCache(directory)
+            ttl = None
+
+            def _ttl(self, layernames):
+                return self.ttl
+
+        rendered = []
+        class Handler:
+            mapfactory = Factory()
+
+            def _requestKey(self, params, bbox=None):
+                return (tuple(params['layers']), (), grid.crs, bbox, 256, 256, 'image/png', 'FALSE', '', False)
+
+            def _reversedAxes(self, params):
+                return False
+
+            def _dispatch(self, methodname, params, tilesize, cols, rows):
+                rendered.append(1)
+                return dict([((dx, dy), len(rendered)) for dx in range(cols) for dy in range(rows)])
+
+        tiler = MetaTiler([grid])
+        handler = Handler()
+        params = {'layers': ['roads']}
+        match = (grid, 2, 2, 0)
+        # tiles past the ttl of their layers are rendered again
+        Factory.ttl = -1
+        assert tiler.gettile(handler, params, match) == 1
+        assert tiler.gettile(handler, params, match) == 2
+        assert tiler.hits == 0
+        Factory.ttl = 60
+        assert tiler.gettile(handler, params, match) == 3
+        assert tiler.gettile(handler, params, match) == 3
+        assert tiler.hits == 1
+
+        # an invalidation by another process is seen through the stamp of
+        # the shared cache, whose mtime may only count whole seconds
+        time.sleep(1)
+        DiskCache(directory).invalidate(Invalidation(['roads']))
+        assert tiler.gettile(handler, params, match) == 4
+        assert tiler.gettile(handler, params, match) == 4
+    finally:
+        shutil.rmtree(directory)
+
+    return True
@@ -0,0 +1,105 @@
+import nose
+
+def test_get_projection():
+    from ogcserver.common import get_projection
+
+    assert get_projection('+init=epsg:4326') is get_projection('+init=epsg:4326')
+    assert get_projection('+init=epsg:4326') is not get_projection('+init=epsg:900913')
+
+    return True
+
+def test_transform_points():
+    from ogcserver import common
+
+    numpy = common.numpy
+    try:
+        for module in set([numpy, None]):
+            common.numpy = module
+            xs, ys = common.transform_points(common.WGS84, '+init=epsg:900913', [-180.0, 0.0, 180.0], [-90.0, 0.0, 45.0])
+            assert [round(x, 2) for x in xs] == [-20037508.34, 0.0, 20037508.34]
+            # latitudes are clamped to the square of spherical mercator
+            assert [round(y, 2) for y in ys] == [-20037508.34, 0.0, 5621521.49]
+            lons, lats = common.transform_points('+init=epsg:3857', common.WGS84, xs, ys)
+            assert [round(lon, 6) for lon in lons] == [-180.0, 0.0, 180.0]
+            assert [round(lat, 6) for lat in lats] == [-85.051129, 0.0, 45.0]
+            same = common.transform_points(common.WGS84, common.WGS84, [1.0], [2.0])
+            assert list(same[0]) == [1.0] and list(same[1]) == [2.0]
+    finally:
+        common.numpy = numpy
+
+    return True
+
+def test_wgs84_bounds():
+    from ogcserver import common
+
+    class Env:
+        def __init__(self, minx, miny, maxx, maxy):
+            self.minx, self.miny, self.maxx, self.maxy = minx, miny, maxx, maxy
+
+    numpy = common.numpy
+    try:
+        for module in set([numpy, None]):
+            common.numpy = module
+            assert common.wgs84_bounds(common.WGS84, Env(-10.0, -20.0, 30.0, 40.0)) == (-10.0, -20.0, 30.0, 40.0)
+            # bounds past the world are clamped to it
+            assert common.wgs84_bounds(common.WGS84, Env(-200.0, -95.0, 200.0, 95.0)) == (-180.0, -90.0, 180.0, 90.0)
+            # bounds that cannot be transformed are left out
+            inf = float('inf')
+            assert common.wgs84_bounds(common.WGS84, Env(-inf, -inf, inf, inf)) is None
+            assert common.wgs84_bounds(common.WGS84, Env(float('nan'), 0.0, 1.0, 1.0)) is None
+    finally:
+        common.numpy = numpy
+    transform_points = common.transform_points
+    try:
+        common.transform_points = lambda source, target, xs, ys: ([float('nan')] * 2, [float('nan')] * 2)
+        assert common.wgs84_bounds('+init=epsg:3857', Env(0.0, 0.0, 1.0, 1.0)) is None
+    finally:
+        common.transform_points = transform_points
+
+    return True
+
+def test_transform_extent():
+    from ogcserver.extents import transform_extent
+
+    extent = transform_extent('+init=epsg:4326', '+init=epsg:900913', (-180.0, -90.0, 180.0, 90.0))
+    assert [round(v, 2) for v in extent] == [-20037508.34, -20037508.34, 20037508.34, 20037508.34]
+
+    return True
+
+def test_transform_polar_extent():
+    import math
+    from ogcserver import extents
+
+    # a north polar azimuthal projection, in degrees from the pole
+    def transform_points(source, target, xs, ys):
+        if source == target:
+            return list(xs), list(ys)
+        points = []
+        for x, y in zip(xs, ys):
+            if source == 'polar':
+                lon = math.degrees(math.atan2(y, x))
+                points.append((lon, 90.0 - math.hypot(x, y)))
+            elif target == 'polar':
+                points.append(((90.0 - y) * math.cos(math.radians(x)), (90.0 - y) * math.sin(math.radians(x))))
+            else:
+                # the poles are beyond spherical mercator
+                points.append((x, abs(y) < 90.0 and y or float('inf')))
+        return [p[0] for p in points], [p[1] for p in points]
+
+    original = extents.transform_points
+    extents.transform_points = transform_points
+    try:
+        # the pole is within the extent, its edges stay 10 degrees off it
+        extent = extents.transform_extent('polar', '+init=epsg:4326', (-10.0, -10.0, 10.0, 10.0))
+        assert extent[3] == 90.0
+        assert extent[0] < -179.0 and extent[2] > 179.0
+        # the antimeridian crosses the extent, not the pole
+        extent = extents.transform_extent('polar', '+init=epsg:4326', (-20.0, -10.0, -5.0, 10.0))
+        assert round(extent[3], 6) == 85.0
+        assert extent[0] < -179.0 and extent[2] > 179.0
+        # the pole is unbounded in spherical mercator
+        assert extents.transform_extent('polar', '+init=epsg:900913', (-10.0, -10.0, 10.0, 10.0)) is None
+    finally:
+        extents.transform_points = original
+
+    return True
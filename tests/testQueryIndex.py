@@ -0,0 +1,99 @@
+import nose
+
+def test_str_tree():
+    import random
+    from array import array
+    from ogcserver.queryindex import STRTree
+
+    rand = random.Random(1)
+    boxes = []
+    for i in range(1000):
+        x, y = rand.uniform(0, 1000), rand.uniform(0, 1000)
+        boxes.append((x, y, x + rand.uniform(0, 20), y + rand.uniform(0, 20)))
+    tree = STRTree(array('l', range(1000)), *[array('d', values) for values in zip(*boxes)])
+    assert len(tree) == 1000
+    # 1000 boxes, 63 nodes of 16, 4 of those and the root
+    assert [len(level[0]) for level in tree.levels] == [1000, 63, 4]
+    for i in range(50):
+        x, y = rand.uniform(0, 1000), rand.uniform(0, 1000)
+        query = (x, y, x + 30, y + 30)
+        expected = [id for id, box in enumerate(boxes)
+                    if box[0] <= query[2] and box[2] >= query[0] and box[1] <= query[3] and box[3] >= query[1]]
+        assert sorted(tree.search(*query)) == expected
+    assert STRTree(array('l'), array('d'), array('d'), array('d'), array('d')).search(0, 0, 1, 1) == []
+
+    return True
+
+def test_shapefile_index():
+    import os
+    import shutil
+    import tempfile
+    from ogcserver.queryindex import ShapefileIndex
+
+    base_path, tail = os.path.split(__file__)
+    directory = tempfile.mkdtemp()
+    try:
+        for extension in ('.shp', '.shx', '.dbf'):
+            shutil.copy(os.path.join(base_path, 'shape_iso8859-1_col' + extension), directory)
+        path = os.path.join(directory, 'shape_iso8859-1_col.shp')
+        index = ShapefileIndex(path, 'iso-8859-1')
+        assert os.path.exists(os.path.join(directory, 'shape_iso8859-1_col.ogcindex'))
+        assert len(index.tree) == 2
+
+        features = index.query(3.0725, 42.4040, 0.001)
+        assert [feature.id() for feature in features] == [2]
+        assert list(features[0]) == [(u't\xe8st', u'r\xf3w 2')]
+        assert features[0].geometry.geometry['type'] == 'Point'
+        assert index.query(3.0725, 42.4040, 0.00001) == []
+        assert len(index.query(3.065, 42.415, 0.02)) == 2
+        assert len(index.query(3.065, 42.415, 0.02, 1)) == 1
+
+        # the tree is read back from the sidecar file
+        reloaded = ShapefileIndex(path, 'iso-8859-1')
+        assert list(reloaded.tree.ids) == list(index.tree.ids)
+        assert [feature.id() for feature in reloaded.query(3.0725, 42.4040, 0.001)] == [2]
+        sidecar = open(os.path.join(directory, 'shape_iso8859-1_col.ogcindex'), 'rb').read()
+        assert len(sidecar.split('\n', 3)[3]) == 2 * 4 + 4 * 2 * 8
+
+        # a shapefile replaced by another one, older than the sidecar
+        shp = os.path.join(directory, 'shape_iso8859-1_col.shp')
+        mtime = os.stat(shp).st_mtime
+        os.utime(shp, (mtime - 3600, mtime - 3600))
+        assert index._read() is None
+        ShapefileIndex(path, 'iso-8859-1')
+        assert index._read() is not None
+        assert open(os.path.join(directory, 'shape_iso8859-1_col.ogcindex'), 'rb').read() != sidecar
+    finally:
+        shutil.rmtree(directory)
+
+    return True
+
+def test_lazy_indexes():
+    import os
+    import shutil
+    import tempfile
+    from ogcserver.queryindex import QueryIndexes
+
+    base_path, tail = os.path.split(__file__)
+    directory = tempfile.mkdtemp()
+    try:
+        for extension in ('.shp', '.shx', '.dbf'):
+            shutil.copy(os.path.join(base_path, 'shape_iso8859-1_col' + extension), directory)
+        path = os.path.join(directory, 'shape_iso8859-1_col.shp')
+        indexes = QueryIndexes({'points': (path, 'iso-8859-1'),
+                                'missing': (os.path.join(directory, 'missing.shp'), 'utf-8')})
+        # nothing is read before a query needs it
+        assert 'points' in indexes and 'other' not in indexes
+        assert not os.path.exists(os.path.join(directory, 'shape_iso8859-1_col.ogcindex'))
+        index = indexes.get('points')
+        assert len(index.tree) == 2
+        assert indexes.get('points') is index
+        assert indexes.get('other') is None
+        # a shapefile that cannot be indexed is queried through mapnik
+        assert indexes.get('missing') is None
+        indexes.reset('points')
+        assert indexes.get('points') is not index
+    finally:
+        shutil.rmtree(directory)
+
+    return True
@@ -0,0 +1,92 @@
+import nose
+import threading
+
+class FakeResult:
+
+    def __init__(self, value=None):
+        self.value = value
+        self.done = threading.Event()
+        if value is not None:
+            self.done.set()
+
+    def get(self, timeout=None):
+        import multiprocessing
+        if not self.done.wait(timeout):
+            raise multiprocessing.TimeoutError
+        return self.value
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+
+class FakePool:
+
+    def __init__(self):
+        self.results = []
+
+    def apply_async(self, function, args):
+        return self.results.pop(0)
+
+class Handler:
+    opsonlineresource = ''
+
+def test_render_pool_slots():
+    import time
+    from ogcserver.exceptions import OGCException
+    from ogcserver.renderpool import RenderPool
+
+    pool = RenderPool('ogcserver.conf', processes=1, queuesize=1, timeout=0.01)
+    pool.pool = FakePool()
+    slow = FakeResult()
+    pool.pool.results = [slow, FakeResult('map'), FakeResult('map')]
+
+    try:
+        pool.apply(Handler(), '_renderMap', ())
+    except OGCException, e:
+        assert 'too long' in str(e)
+    else:
+        raise AssertionError('a render past the timeout was not given up')
+    # the slow map still renders in the worker and keeps the only slot
+    try:
+        pool.apply(Handler(), '_renderMap', ())
+    except OGCException, e:
+        assert 'too busy' in str(e)
+    else:
+        raise AssertionError('a request beyond the queue size was not refused')
+    assert pool.stats()['refused'] == 1
+
+    # once it is done the slot is free again
+    slow.done.set()
+    for i in range(100):
+        if pool.slots.acquire(False):
+            pool.slots.release()
+            break
+        time.sleep(0.01)
+    assert pool.apply(Handler(), '_renderMap', ()) == 'map'
+    assert pool.apply(Handler(), '_renderMap', ()) == 'map'
+    assert pool.stats()['requests'] == 3
+
+    return True
+
+def test_fork_after_warmup():
+    import multiprocessing
+    from ogcserver.renderpool import RenderPool
+
+    built = threading.Event()
+    pool = RenderPool('ogcserver.conf', processes=1)
+    pool.warmup = threading.Thread(target=built.wait)
+    pool.warmup.start()
+    original = multiprocessing.Pool
+    multiprocessing.Pool = lambda *args: FakePool()
+    try:
+        starter = threading.Thread(target=pool._getpool)
+        starter.start()
+        starter.join(0.1)
+        # no worker is forked while the capabilities are built
+        assert pool.pool is None
+        built.set()
+        starter.join()
+        assert isinstance(pool.pool, FakePool)
+    finally:
+        multiprocessing.Pool = original
+
+    return True
@@ -0,0 +1,61 @@
+import nose
+
+class Rule:
+
+    def __init__(self, name, min_scale=0, max_scale=1.7976931348623157e308):
+        self.name = name
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+
+class Style:
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+class Layer:
+
+    def __init__(self, name, minzoom=0, maxzoom=1.7976931348623157e308):
+        self.name = name
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+
+def test_intervals():
+    from ogcserver.scales import Intervals
+
+    intervals = Intervals([(0, 1000), (500, 5000), (0, 1e308)])
+    assert intervals.find(100)[1] == (0, 2)
+    assert intervals.find(500)[1] == (0, 1, 2)
+    assert intervals.find(1000)[1] == (1, 2)
+    assert intervals.find(1e6)[1] == (2,)
+    assert intervals.find(-1)[1] == ()
+
+    return True
+
+def test_scale_index():
+    from ogcserver.scales import ScaleIndex
+
+    roads = Style([Rule('motorways'), Rule('streets', max_scale=25000), Rule('paths', max_scale=5000)])
+    labels = Style([Rule('names', max_scale=50000)])
+    streets, overview = Layer('streets', maxzoom=100000), Layer('overview', minzoom=100000)
+    index = ScaleIndex({'streets': streets, 'overview': overview},
+                       {'roads': roads, 'labels': labels})
+    layers = [(streets, [('roads', roads), ('labels', labels)]), (overview, [('roads', roads)])]
+
+    # all rules of the styles are drawn at large scales
+    assert index.active(layers, 1000) == [(streets, [('roads', roads), ('labels', labels)])]
+    # exactly at the limit, like mapnik
+    drawn = index.active(layers, 25000)
+    assert drawn[0][1][0][0] == 'roads_scale2'
+    assert [rule.name for rule in drawn[0][1][0][1].rules] == ['motorways', 'streets']
+    # trimmed styles are made once
+    assert index.active(layers, 20000)[0][1][0][1] is drawn[0][1][0][1]
+    drawn = index.active(layers, 60000)
+    assert [rule.name for rule in drawn[0][1][0][1].rules] == ['motorways']
+    assert len(drawn[0][1]) == 1
+    assert index.active(layers, 200000) == [(overview, [('roads_scale3', index.variants[('roads', 3)][1])])]
+
+    assert round(index.denominator('epsg:900913', (0, 0, 256 * 0.28, 128 * 0.28), 256, 256)) == 1000
+    index.geographic['epsg:4326'] = True
+    assert round(index.denominator('epsg:4326', (0, 0, 1, 1), 256, 256)) == 1553006
+
+    return True
@@ -0,0 +1,56 @@
+import nose
+
+def test_pyramid_tasks():
+    from ogcserver.metatile import TileGrid
+    from ogcserver.seed import pyramid_tasks
+
+    grid = TileGrid('test', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0), 256, (2, 2))
+    tasks = list(pyramid_tasks(grid, grid.extent, [0, 2], {'layers': 'world'}))
+    # one metatile at zoom 0, clipped to the single tile of the grid
+    assert tasks[0][:3] == (('test', 0, 0, 0), 1, '1.1.1')
+    assert tasks[0][3]['bbox'] == '-1024.0,-1024.0,1024.0,1024.0'
+    assert [task[0] for task in tasks[1:]] == [('test', 2, 0, 0), ('test', 2, 2, 0), ('test', 2, 0, 2), ('test', 2, 2, 2)]
+    assert sum([task[1] for task in tasks]) == 17
+
+    tasks = list(pyramid_tasks(grid, (0.0, 0.0, 100.0, 100.0), [2], {}))
+    assert [task[0] for task in tasks] == [('test', 2, 2, 2)]
+
+    return True
+
+def test_resume_key():
+    from ogcserver.seed import resume_key
+
+    task = (('test', 2, 0, 0), 4, '1.1.1', {'layers': 'world', 'styles': '', 'format': 'image/png'})
+    assert resume_key(task) == resume_key((task[0], 4, '1.1.1', dict(task[3], bbox='0,0,1,1')))
+    # runs for other layers or formats do not skip each other's tiles
+    assert resume_key(task) != resume_key((task[0], 4, '1.1.1', dict(task[3], layers='roads')))
+    assert resume_key(task) != resume_key((task[0], 4, '1.1.1', dict(task[3], format='image/jpeg')))
+
+    return True
+
+def test_log_tasks():
+    import os
+    import tempfile
+    from ogcserver.metatile import TileGrid
+    from ogcserver.seed import log_tasks, reversed_axes
+
+    grid = TileGrid('test', 'epsg:4326', (-180.0, -90.0, 180.0, 90.0), (0.703125, 0.3515625))
+    fd, logfile = tempfile.mkstemp()
+    try:
+        log = os.fdopen(fd, 'w')
+        log.write('1.2.3.4 - - [01/Jan/2012:00:00:00 +0000] "GET /?request=GetMap&version=1.1.1&srs=EPSG:4326'
+                  '&bbox=0,0,90,90&width=256&height=256&layers=roads HTTP/1.1" 200 100\n')
+        # the same tile as WMS 1.3.0 lists latitudes first
+        log.write('1.2.3.4 - - [01/Jan/2012:00:00:00 +0000] "GET /?request=GetMap&version=1.3.0&crs=EPSG:4326'
+                  '&bbox=0,0,90,90&width=256&height=256&layers=roads HTTP/1.1" 200 100\n')
+        log.close()
+        tasks = log_tasks([grid], logfile)
+        assert [(task[0], task[2]) for task in tasks] == [(('test', 1, 2, 1), '1.1.1'), (('test', 1, 2, 1), '1.3.0')]
+    finally:
+        os.unlink(logfile)
+
+    assert reversed_axes('1.3.0', 'epsg:4326')
+    assert not reversed_axes('1.1.1', 'epsg:4326')
+    assert not reversed_axes('1.3.0', 'epsg:900913')
+
+    return True
@@ -0,0 +1,83 @@
+import nose
+
+def test_coalesce():
+    import time
+    import threading
+    from ogcserver.singleflight import SingleFlight
+
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work(value):
+        calls.append(value)
+        started.set()
+        release.wait()
+        return value * 2
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', work, 21)))
+    leader.start()
+    started.wait()
+    waiters = [threading.Thread(target=lambda: results.append(flight.do('key', work, 21))) for i in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    while flight.coalesced < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join()
+
+    assert calls == [21]
+    assert results == [42, 42, 42, 42]
+    assert flight.stats() == {'inflight': 0, 'flights': 1, 'coalesced': 3}
+
+    return True
+
+def test_exception():
+    from ogcserver.singleflight import SingleFlight
+
+    def fail():
+        raise ValueError('failed')
+
+    flight = SingleFlight()
+    try:
+        flight.do('key', fail)
+    except ValueError:
+        pass
+    else:
+        raise Exception('exception not raised')
+    # a failed call is not remembered
+    assert flight.do('key', lambda: 1) == 1
+
+    return True
+
+def test_refresher():
+    import time
+    import threading
+    from ogcserver.singleflight import Refresher
+
+    refresher = Refresher(concurrency=2)
+    release = threading.Event()
+    calls = []
+
+    def work(value):
+        calls.append(value)
+        release.wait()
+
+    assert refresher.refresh('a', work, 1)
+    # a refresh of the same key is already running
+    assert not refresher.refresh('a', work, 1)
+    assert refresher.refresh('b', work, 2)
+    # no slot left
+    assert not refresher.refresh('c', work, 3)
+    release.set()
+    while refresher.stats()['pending']:
+        time.sleep(0.01)
+    assert sorted(calls) == [1, 2]
+    stats = refresher.stats()
+    assert stats['refreshed'] == 2
+    assert stats['dropped'] == 1
+
+    return True
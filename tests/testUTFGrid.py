@@ -0,0 +1,191 @@
+import nose
+
+class Envelope:
+
+    def __init__(self, minx, miny, maxx, maxy):
+        self.minx, self.miny, self.maxx, self.maxy = minx, miny, maxx, maxy
+
+class Datasource:
+
+    def fields(self):
+        return ['name', 'population']
+
+class Layer:
+
+    def __init__(self, name, extent, queryable=True):
+        self.name = name
+        self.srs = '+init=epsg:4326'
+        self.extent = extent
+        self.queryable = queryable
+        self.wmsdefaultstyle = 'default'
+        self.datasource = Datasource()
+
+    def envelope(self):
+        return Envelope(*self.extent)
+
+class FakeGrid:
+
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.encoded = []
+
+    def encode(self, encoding, features, resolution):
+        self.encoded.append((encoding, features, resolution))
+        return {'keys': [''], 'grid': [' ' * (self.size[0] // resolution)] * (self.size[1] // resolution), 'data': {}}
+
+def test_utfgrid_settings():
+    import json
+    from ogcserver.configparser import SafeConfigParser
+    from ogcserver.exceptions import ServerConfigurationError
+    from ogcserver.utfgrid import load_utfgrid
+
+    conf = SafeConfigParser()
+    conf.add_section('server')
+    conf.set('server', 'utfgridresolution', '8')
+    conf.add_section('layer_cities')
+    conf.set('layer_cities', 'utfgridfields', 'name, population')
+    conf.set('layer_cities', 'utfgridresolution', '2')
+    conf.add_section('layer_roads')
+    conf.set('layer_roads', 'utfgridfields', '')
+    renderer = load_utfgrid(conf)
+
+    cities, roads, rivers = Layer('cities', None), Layer('roads', None), Layer('rivers', None)
+    assert renderer.resolution(cities) == 2
+    assert renderer.resolution(roads) == 8
+    assert renderer.fields(cities) == ['name', 'population']
+    # left empty the grid only carries the feature ids
+    assert renderer.fields(roads) == []
+    # not set it carries all fields of the datasource
+    assert renderer.fields(rivers) == ['name', 'population']
+
+    grid = FakeGrid(256, 256)
+    assert json.loads(renderer.encode(grid, roads))['grid'] == [' ' * 32] * 32
+    assert grid.encoded == [('utf', True, 8)]
+
+    conf.set('layer_roads', 'utfgridresolution', '0')
+    try:
+        load_utfgrid(conf)
+    except ServerConfigurationError:
+        pass
+    else:
+        raise AssertionError('a resolution of 0 was accepted')
+
+    return True
+
+def test_render_grid():
+    from ogcserver.common import CRS, WMSBaseServiceHandler
+    from ogcserver.exceptions import OGCException
+    from ogcserver.extents import ExtentIndex
+
+    europe = Layer('europe', (-10.0, 35.0, 30.0, 70.0))
+    africa = Layer('africa', (-20.0, -35.0, 50.0, 35.0))
+    labels = Layer('labels', (-20.0, -35.0, 50.0, 70.0), queryable=False)
+
+    class Renderer:
+        available = True
+        rendered = []
+
+        def render(self, m, index, layer):
+            self.rendered.append((index, layer))
+            return FakeGrid(m.width, m.height)
+
+        def empty(self, width, height):
+            return FakeGrid(width, height)
+
+    class Map:
+        width = height = 256
+
+    class Factory:
+        layers = {'europe': europe, 'africa': africa, 'labels': labels}
+        meta_layers = {}
+        styles = {'default': None}
+        aggregatestyles = {}
+        map_attributes = {}
+        extents = ExtentIndex({'europe': europe, 'africa': africa, 'labels': labels}, ['epsg:4326'])
+        scales = None
+        utfgrid = Renderer()
+
+    handler = WMSBaseServiceHandler()
+    handler.mapfactory = Factory()
+    handler.allowedepsgcodes = ['epsg:4326']
+    handler._buildMap = lambda params, layers: Map()
+    handler._releaseMap = lambda m: None
+    params = {'crs': CRS('epsg', 4326), 'layers': ['africa', 'europe', 'labels'], 'styles': [],
+              'bbox': [0.0, 30.0, 10.0, 40.0], 'width': 256, 'height': 256}
+    # the grid is of the topmost queryable layer, labels are not queryable
+    grid, layer = handler._renderGrid(params)
+    assert layer is europe
+    assert Renderer.rendered == [(1, europe)]
+    # europe is left out south of its extent, africa is below it
+    params['bbox'] = [0.0, 0.0, 10.0, 10.0]
+    grid, layer = handler._renderGrid(params)
+    assert layer is africa
+    assert Renderer.rendered[-1] == (0, africa)
+    # without queryable data in the BBOX the grid is empty
+    params['bbox'] = [100.0, 60.0, 110.0, 70.0]
+    params['layers'] = ['europe', 'labels']
+    grid, layer = handler._renderGrid(params)
+    assert layer is europe and grid.size == (256, 256)
+    assert len(Renderer.rendered) == 2
+
+    # the Map goes back to the pool when rendering fails
+    released = []
+    handler._releaseMap = released.append
+    def fail(self, m, index, layer):
+        raise RuntimeError('render_layer failed')
+    Renderer.render = fail
+    params['layers'] = ['europe']
+    params['bbox'] = [0.0, 30.0, 10.0, 40.0]
+    try:
+        handler._renderGrid(params)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('the failure of the grid renderer was swallowed')
+    assert len(released) == 1
+
+    params['layers'] = ['labels']
+    try:
+        handler._renderGrid(params)
+    except OGCException, e:
+        assert e.args[1] == 'LayerNotQueryable'
+    else:
+        raise AssertionError('a grid of layers that are not queryable was rendered')
+
+    return True
+
+def test_format_in_query_string():
+    import os
+    import tempfile
+    from urlparse import parse_qs
+    from ogcserver.metatile import TileGrid
+    from ogcserver.seed import log_tasks
+    from ogcserver.utfgrid import UTFGRID_FORMAT
+    from ogcserver.wms111 import ServiceHandler as ServiceHandler111
+    from ogcserver.wms130 import ServiceHandler as ServiceHandler130
+
+    # clients send the format unencoded, parsed as the WSGI, CGI and
+    # mod_python handlers do
+    query = 'SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&SRS=EPSG:4326&BBOX=0,0,90,90&WIDTH=256&HEIGHT=256' \
+            '&LAYERS=cities&FORMAT=%s' % UTFGRID_FORMAT
+    reqparams = {}
+    for key, value in parse_qs(query, True).items():
+        reqparams[key.lower()] = value[0]
+    assert reqparams['format'] == UTFGRID_FORMAT
+    assert 'type' not in reqparams
+    for handler in (ServiceHandler111, ServiceHandler130):
+        assert UTFGRID_FORMAT in handler.SERVICE_PARAMS['GetMap']['format'].allowedvalues
+
+    # and so do the logged requests seeded
+    grid = TileGrid('test', 'epsg:4326', (-180.0, -90.0, 180.0, 90.0), (0.703125, 0.3515625))
+    fd, logfile = tempfile.mkstemp()
+    try:
+        log = os.fdopen(fd, 'w')
+        log.write('1.2.3.4 - - [01/Jan/2012:00:00:00 +0000] "GET /?%s HTTP/1.1" 200 100\n' % query)
+        log.close()
+        tasks = log_tasks([grid], logfile)
+        assert len(tasks) == 1 and tasks[0][3]['format'] == UTFGRID_FORMAT
+    finally:
+        os.unlink(logfile)
+
+    return True
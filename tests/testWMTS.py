@@ -0,0 +1,84 @@
+import nose
+
+def _handler():
+    from ogcserver.metatile import TileGrid, MetaTiler
+    from ogcserver.WMTS import ServiceHandler
+
+    class Layer:
+        name = 'roads'
+        wmsdefaultstyle = 'roads_style'
+
+    class MetaLayer:
+        # made by loadXML from named rules, without register_layer
+        name = 'roads:major-minor'
+        meta_style = 'roads:major-minor'
+        wms_source = 'roads'
+        defaultstyle = 'roads:major-minor'
+        wmsextrastyles = ()
+
+    class Factory:
+        layers = {'roads': Layer()}
+        meta_layers = {'roads:major-minor': MetaLayer()}
+        # the same tiles under two names
+        metatiler = MetaTiler([TileGrid('test', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0)),
+                               TileGrid('copy', 'epsg:900913', (-1024.0, -1024.0, 1024.0, 1024.0), (8.0, 4.0, 2.0))])
+
+    class Handler(ServiceHandler):
+        def _map(self, params, match):
+            return dict(params, match=match)
+
+    return Handler(None, Factory(), 'http://localhost/?', 'http://localhost')
+
+def test_gettile():
+    handler = _handler()
+    params = handler.GetTile({'layer': 'roads', 'style': 'default', 'format': 'image/png',
+                              'tilematrixset': 'test', 'tilematrix': 2, 'tilerow': 0, 'tilecol': 1})
+    # rows are counted from the top in WMTS
+    assert params['bbox'] == [-512.0, 512.0, 0.0, 1024.0]
+    assert params['styles'] == ['']
+    assert params['transparent'] == 'TRUE'
+    assert str(params['crs']) == 'epsg:900913'
+    # the tile is addressed in the grid requested, not found by its BBOX
+    grid, z, col, row = params['match']
+    assert (grid.name, z, col, row) == ('test', 2, 1, 3)
+    params = handler.GetTile({'layer': 'roads', 'style': '', 'format': 'image/png',
+                              'tilematrixset': 'copy', 'tilematrix': 2, 'tilerow': 0, 'tilecol': 1})
+    assert params['match'][0].name == 'copy'
+    assert handler.mapfactory.metatiler.match(params)[0].name == 'test'
+    key = handler.mapfactory.metatiler.tilekey(handler, params, params['match'])
+    assert key[3] == ('copy', 2, 1, 3)
+    # meta layers have no wmsdefaultstyle
+    params = handler.GetTile({'layer': 'roads:major-minor', 'style': 'roads:major-minor', 'format': 'image/png',
+                              'tilematrixset': 'test', 'tilematrix': 2, 'tilerow': 0, 'tilecol': 1})
+    assert params['layers'] == ['roads:major-minor']
+    assert params['styles'] == ['']
+    return True
+
+def test_dispatch_path():
+    from ogcserver import WMTS
+    from ogcserver.exceptions import OGCException
+
+    factory = _handler().mapfactory
+    getmap = WMTS.ServiceHandler._map
+    WMTS.ServiceHandler._map = lambda self, params, match: dict(params, match=match)
+    try:
+        # RESTful WMTS and TMS address the same tile
+        wmts = WMTS.dispatch_path(None, factory, 'http://localhost', '/wmts/1.0.0/roads/default/test/2/0/1.png')
+        tms = WMTS.dispatch_path(None, factory, 'http://localhost', '/tms/1.0.0/roads@test@png/2/1/3.png')
+        assert wmts['bbox'] == tms['bbox'] == [-512.0, 512.0, 0.0, 1024.0]
+        assert wmts['match'][1:] == tms['match'][1:] == (2, 1, 3)
+        assert WMTS.dispatch_path(None, factory, 'http://localhost', '/tms/1.0.0/roads@test@jpg/0/0/0.jpg')['format'] == 'image/jpeg'
+        meta = WMTS.dispatch_path(None, factory, 'http://localhost', '/wmts/1.0.0/roads:major-minor/default/test/2/0/1.png')
+        assert meta['layers'] == ['roads:major-minor'] and meta['styles'] == ['']
+        for path in ('/tms/1.0.0/roads@test@png/2/4/0.png', '/tms/1.0.0/roads@test@png/3/0/0.png',
+                     '/tms/1.0.0/rivers@test@png/0/0/0.png', '/wmts/1.0.0/roads/default/other/0/0/0.png',
+                     '/wmts/1.0.0/roads/default/test/0/0/0.gif', '/tms/unknown'):
+            try:
+                WMTS.dispatch_path(None, factory, 'http://localhost', path)
+            except OGCException:
+                pass
+            else:
+                raise Exception('%s should be refused' % path)
+    finally:
+        WMTS.ServiceHandler._map = getmap
+    return True